@@ -3,6 +3,7 @@ import underworld as uw
 import numpy as np
 from mpi4py import MPI
 from scipy.interpolate import interp1d, interp2d
+from ..Underworld_extended import get_structured_topology
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
@@ -27,6 +28,10 @@ class LecodeIsostasy(object):
         self.maskedMat = list(maskedMat) if maskedMat else list()
         self.initialized = False
 
+        # Basal velocities of the last solve and their relative change
+        self._basal_velocities = None
+        self.basal_velocity_change = np.inf
+
         # Make the class aware of the conditions on the vertical walls
         if vertical_walls_conditions:
             if not isinstance(vertical_walls_conditions, dict):
@@ -52,6 +57,22 @@ class LecodeIsostasy(object):
         if self.mesh.dim == 3:
             self._lecode_tools_isostasy3D()
 
+    def _record_basal_velocities(self, basal_velocities):
+        """ Store the basal velocities and their maximum change relative to
+        the previous solve. The velocities are global (identical on all
+        the processors) so no communication is needed."""
+        previous = self._basal_velocities
+        if previous is None or previous.shape != basal_velocities.shape:
+            self.basal_velocity_change = np.inf
+        else:
+            scale = np.abs(basal_velocities).max()
+            change = np.abs(basal_velocities - previous).max()
+            if scale > 0.:
+                self.basal_velocity_change = change / scale
+            else:
+                self.basal_velocity_change = change
+        self._basal_velocities = np.copy(basal_velocities)
+
     def _check_all_defined(self):
         if not self.mesh:
             raise ValueError("Please link a Mesh to the Isostasy solver")
@@ -119,6 +140,8 @@ class LecodeIsostasy(object):
         if self.average:
             basal_velocities = np.ones((basal_velocities.shape)) * np.mean(basal_velocities)
 
+        self._record_basal_velocities(basal_velocities)
+
         base = self.mesh.specialSets["MinJ_VertexSet"]
 
         if base:
@@ -166,6 +189,8 @@ class LecodeIsostasy(object):
         if self.average:
             basal_velocities = np.ones((basal_velocities.shape)) * np.mean(basal_velocities)
 
+        self._record_basal_velocities(basal_velocities)
+
         base = self.mesh.specialSets["MinK_VertexSet"]
         if base:
 
@@ -207,13 +232,9 @@ class LecodeIsostasy(object):
 
     def _get_sep_velocities2D(self):
 
-        ncol, nrow = self.mesh.elementRes
-        if self.mesh.elementType == "Q2":
-            fact = 2
-        elif self.mesh.elementType == "Q1":
-            fact = 1
-        ncol *= fact
-        nrow *= fact
+        topology = get_structured_topology(self.mesh)
+        ncol = topology.nodeShape[0] - 1
+        Ipositions = topology.node_indices[0]
 
         # Create some work arrays.
         local_top_vy = np.zeros((ncol + 1,))
@@ -225,69 +246,43 @@ class LecodeIsostasy(object):
         global_heights = np.zeros((ncol + 1,))
 
         # Get the ids of the nodes belonging to the top and bottom of the
-        # global domain.
-        top_ids = self.mesh.specialSets["MaxJ_VertexSet"]
-        bot_ids = self.mesh.specialSets["MinJ_VertexSet"]
+        # global domain (shadow nodes excluded).
+        top_ids = topology.local_vertex_set("MaxJ_VertexSet")
+        bot_ids = topology.local_vertex_set("MinJ_VertexSet")
 
         if self.surface is not None:
 
-            surfLocals, surfGlobals = self._get_surface_nodes()
+            surfLocals, _ = self._get_surface_nodes()
             if surfLocals.size > 0:
-                # Get an I,J representation of the node coordinates
-                Jpositions = (surfGlobals.astype("float") / (ncol + 1)).astype("int")
-                Ipositions = surfGlobals - Jpositions * (ncol + 1)
+                positions = Ipositions[surfLocals]
 
-                # Load the top-velocities in the local array with global dimensions.
-                local_top_vy[Ipositions.flatten()] = self.velocityField.data[surfLocals, 1]
-                local_heights[Ipositions.flatten()] += self.mesh.data[surfLocals][:,1]
+                # Load the top-velocities in the local array with global
+                # dimensions.
+                local_top_vy[positions] = (
+                    self.velocityField.data[surfLocals, 1])
+                np.add.at(local_heights, positions,
+                          self.mesh.data[surfLocals, 1])
 
         # If the local domain contains some of the top_ids, proceed:
-        elif top_ids:
+        elif top_ids.size:
 
-            # We must get rid of the shadow nodes
-            top_ids = top_ids.data[top_ids.data < self.mesh.nodesLocal]
+            positions = Ipositions[top_ids]
 
-            # Get the cooresponding global ids
-            node_gids = self.mesh.data_nodegId[top_ids]
-
-            # Get y-velocities at the top
-            topVelocities_nodes = self.velocityField.data[top_ids,1]
-            heights_nodes = self.mesh.data[top_ids,1]
-
-            # Get an I,J representation of the node coordinates
-            Jpositions = (node_gids.astype("float") / (ncol + 1)).astype("int")
-            Ipositions = node_gids - Jpositions * (ncol + 1)
-
-            # Load the top-velocities in the local array with global dimensions.
-            j = 0
-            for pos in Ipositions:
-                local_top_vy[pos] = topVelocities_nodes[j]
-                local_heights[pos] += heights_nodes[j]
-                j+=1
+            # Load the top-velocities in the local array with global
+            # dimensions.
+            local_top_vy[positions] = self.velocityField.data[top_ids, 1]
+            np.add.at(local_heights, positions, self.mesh.data[top_ids, 1])
 
         # If the local domain contains some of the bot_ids, proceed:
-        if bot_ids:
-
-            # We must get rid of the shadow nodes
-            bot_ids = bot_ids.data[bot_ids.data < self.mesh.nodesLocal]
-
-            # Get the cooresponding global ids
-            node_gids = self.mesh.data_nodegId[bot_ids]
-
-            # Get y-velocities at the bottom
-            botVelocities_nodes = self.velocityField.data[bot_ids,1]
-            heights_nodes = self.mesh.data[bot_ids,1]
+        if bot_ids.size:
 
-            # Get an I,J representation of the node coordinates
-            Jpositions = (node_gids.astype("float") / (ncol + 1)).astype("int")
-            Ipositions = node_gids - Jpositions * (ncol + 1)
+            positions = Ipositions[bot_ids]
 
-            # Load the bottom-velocities in the local array with global dimensions.
-            j = 0
-            for pos in Ipositions:
-                local_bot_vy[pos] = botVelocities_nodes[j]
-                local_heights[pos] -= heights_nodes[j]
-                j+=1
+            # Load the bottom-velocities in the local array with global
+            # dimensions.
+            local_bot_vy[positions] = self.velocityField.data[bot_ids, 1]
+            np.subtract.at(local_heights, positions,
+                           self.mesh.data[bot_ids, 1])
 
         # reduce local arrays into global_array
         comm.Allreduce(local_top_vy, global_top_vy)
@@ -296,107 +291,66 @@ class LecodeIsostasy(object):
         comm.Barrier()
 
         # 3-nodes mean average
-        global_top_vy = (np.roll(global_top_vy, -1) + global_top_vy + np.roll(global_top_vy, 1)) / 3.0
-        global_bot_vy = (np.roll(global_bot_vy, -1) + global_bot_vy + np.roll(global_bot_vy, 1)) / 3.0
-        global_heights = (np.roll(global_heights, -1) + global_heights + np.roll(global_heights, 1)) / 3.0
+        global_top_vy = self._three_nodes_average(global_top_vy)
+        global_bot_vy = self._three_nodes_average(global_bot_vy)
+        global_heights = self._three_nodes_average(global_heights)
 
         # Calculate and return sep velocities
         return global_top_vy - global_bot_vy, global_heights
 
     def _get_sep_velocities3D(self):
 
-        nx, ny, nz = self.mesh.elementRes
-        if self.mesh.elementType == "Q2":
-            fact = 2
-        elif self.mesh.elementType == "Q1":
-            fact = 1
-        nx *= fact
-        ny *= fact
-        nz *= fact
-        GlobalIndices3d = np.indices((nz + 1, ny + 1, nx + 1))
+        topology = get_structured_topology(self.mesh)
+        nx, ny, _ = topology.nodeShape
+        Ipositions, Jpositions, _ = topology.node_indices
 
         # Create some work arrays.
-        local_top_vy = np.zeros(((ny + 1), (nx + 1)))
-        local_bot_vy = np.zeros(((ny + 1), (nx + 1)))
-        global_top_vy = np.zeros(((ny + 1), (nx + 1)))
-        global_bot_vy = np.zeros(((ny + 1), (nx + 1)))
+        local_top_vy = np.zeros((ny, nx))
+        local_bot_vy = np.zeros((ny, nx))
+        global_top_vy = np.zeros((ny, nx))
+        global_bot_vy = np.zeros((ny, nx))
 
-        local_heights = np.zeros(((ny + 1), (nx + 1)))
-        global_heights = np.zeros(((ny + 1), (nx + 1)))
+        local_heights = np.zeros((ny, nx))
+        global_heights = np.zeros((ny, nx))
 
         # Get the ids of the nodes belonging to the top and bottom of the
-        # global domain.
-        top_ids = self.mesh.specialSets["MaxK_VertexSet"]
-        bot_ids = self.mesh.specialSets["MinK_VertexSet"]
+        # global domain (shadow nodes excluded).
+        top_ids = topology.local_vertex_set("MaxK_VertexSet")
+        bot_ids = topology.local_vertex_set("MinK_VertexSet")
 
         if self.surface is not None:
 
-            _, surfaceNodes = self._get_surface_nodes()
-            if surfaceNodes.size > 0:
-                ix = np.in1d(np.arange(self.mesh.nodesGlobal), surfaceNodes)
-                Ipositions = GlobalIndices3d[2].flatten()[ix]
-                Jpositions = GlobalIndices3d[1].flatten()[ix]
+            surfLocals, _ = self._get_surface_nodes()
+            if surfLocals.size > 0:
+                positions = (Jpositions[surfLocals], Ipositions[surfLocals])
 
-                # Load the top-velocities in the local array with global dimensions.
-                k = 0
-                for i, j in zip(Ipositions, Jpositions):
-                    local_top_vy[j, i] = self.velocityField.data[surfaceNodes][k]
-                    local_heights[j, i] += self.mesh.data[surfaceNodes,2][k]
-                    k += 1
+                # Load the top-velocities in the local array with global
+                # dimensions.
+                local_top_vy[positions] = (
+                    self.velocityField.data[surfLocals, -1])
+                np.add.at(local_heights, positions,
+                          self.mesh.data[surfLocals, 2])
 
         # If the local domain contains some of the top_ids, proceed:
-        elif top_ids:
-
-            # We must get rid of the shadow nodes
-            top_ids = top_ids.data[top_ids.data < self.mesh.nodesLocal]
-
-            # Get the cooresponding global ids
-            node_gids = self.mesh.data_nodegId[top_ids]
+        elif top_ids.size:
 
-            # Get y-velocities at the top
-            topVelocities_nodes = self.velocityField.data[top_ids, -1]
-            heights_nodes = self.mesh.data[top_ids, -1]
+            positions = (Jpositions[top_ids], Ipositions[top_ids])
 
-            # Get an I,J representation of the node coordinates
-
-            # FROM Numpy 1.13> ... more efficient ?
-            #ix = np.isin(GlobalIndices3d, node_gids)
-            #Kpositions, Jposition, Iposition = np.where(ix)
-            ix = np.in1d(np.arange(self.mesh.nodesGlobal), node_gids)
-            Ipositions = GlobalIndices3d[2].flatten()[ix]
-            Jpositions = GlobalIndices3d[1].flatten()[ix]
-
-            # Load the top-velocities in the local array with global dimensions.
-            k = 0
-            for i, j in zip(Ipositions, Jpositions):
-                local_top_vy[j, i] = topVelocities_nodes[k]
-                local_heights[j, i] += heights_nodes[k]
-                k += 1
+            # Load the top-velocities in the local array with global
+            # dimensions.
+            local_top_vy[positions] = self.velocityField.data[top_ids, -1]
+            np.add.at(local_heights, positions, self.mesh.data[top_ids, -1])
 
         # If the local domain contains some of the bot_ids, proceed:
-        if bot_ids:
-
-            # We must get rid of the shadow nodes
-            bot_ids = bot_ids.data[bot_ids.data < self.mesh.nodesLocal]
+        if bot_ids.size:
 
-            # Get the cooresponding global ids
-            node_gids = self.mesh.data_nodegId[bot_ids]
+            positions = (Jpositions[bot_ids], Ipositions[bot_ids])
 
-            # Get y-velocities at the bottom
-            botVelocities_nodes = self.velocityField.data[bot_ids,-1]
-            heights_nodes = self.mesh.data[bot_ids,-1]
-
-            # Get an I,J representation of the node coordinates
-            ix = np.in1d(np.arange(self.mesh.nodesGlobal), node_gids)
-            Ipositions = GlobalIndices3d[2].flatten()[ix]
-            Jpositions = GlobalIndices3d[1].flatten()[ix]
-
-            # Load the top-velocities in the local array with global dimensions.
-            k = 0
-            for i, j in zip(Ipositions, Jpositions):
-                local_bot_vy[j, i] = botVelocities_nodes[k]
-                local_heights[j, i] -= heights_nodes[k]
-                k += 1
+            # Load the bottom-velocities in the local array with global
+            # dimensions.
+            local_bot_vy[positions] = self.velocityField.data[bot_ids, -1]
+            np.subtract.at(local_heights, positions,
+                           self.mesh.data[bot_ids, -1])
 
         # reduce local arrays into global_array
         comm.Allreduce(local_top_vy, global_top_vy)
@@ -465,106 +419,91 @@ class LecodeIsostasy(object):
             globalIds = self.mesh.data_nodegId[localIds]
             return localIds, globalIds
 
-    def _get_average_densities2D(self):
+    def _get_column_statistics(self, rint=True):
+        """ Return the per-column sums and counts of the nodal densities.
 
-        ncol, nrow = self.mesh.elementRes
-        if self.mesh.elementType == "Q2":
-            fact = 2
-        elif self.mesh.elementType == "Q1":
-            fact = 1
-        ncol *= fact
-        nrow *= fact
+        Only the basal surface statistics are reduced across the
+        processors:
 
-        # Create some work arrays.
-        global_densities = np.zeros((nrow + 1) * (ncol + 1))
-        local_densities = np.zeros((nrow + 1) * (ncol + 1))
-        local_materials = np.zeros((nrow + 1) * (ncol + 1))
-        global_materials = np.zeros((nrow + 1) * (ncol + 1))
-
-        # Load the densities and material into the local_densities arrays
-        # data_nodegId as domain size (local+node) so we need to only take
-        # the local nodes otherwise the reduce operation will results in higher
-        # values where domains overlaps...
-        local_densities[self.mesh.data_nodegId[:self.mesh.nodesLocal]] = self.DensityVar.data[:self.mesh.nodesLocal]
-        local_materials[self.mesh.data_nodegId[:self.mesh.nodesLocal]] = self.MaterialVar.data[:self.mesh.nodesLocal]
-
-        # Reduce local_densities arrays to global_densities
-        comm.Allreduce(local_densities, global_densities)
-        comm.Allreduce(local_materials, global_materials)
-        # It seems that the MPI implementation to not systematically impose a
-        # barrier inside a reduce operation. That is weird but just to be safe:
-        comm.Barrier()
+        - sum and count of the densities of the non-masked materials
+        - sum and count of the densities of the reference material
 
-        # Reshape the arrays
-        global_densities = global_densities.reshape(((nrow + 1), (ncol + 1)))
-        global_materials = global_materials.reshape(((nrow + 1), (ncol + 1)))
+        The returned array has shape (4, number of columns).
+        """
+
+        topology = get_structured_topology(self.mesh)
+        ncolumns = int(np.prod(topology.nodeShape[:-1]))
+
+        # Only take the local nodes, otherwise the reduce operation
+        # will count the nodes where domains overlap more than once.
+        nodesLocal = self.mesh.nodesLocal
+        columns = topology.node_columns[:nodesLocal]
+
+        densities = self.DensityVar.data[:nodesLocal, 0]
+        materials = self.MaterialVar.data[:nodesLocal, 0]
         # Convert material values to closest integers.
-        global_materials = global_materials.astype("int")
+        if rint:
+            materials = np.rint(materials)
+        materials = materials.astype("int")
 
-        # Calculate Mean densities at the bottom
         if self.maskedMat:
-            mask = np.in1d(global_materials, self.maskedMat)
-            maskedArray = np.ma.masked_array(global_densities, mask)
-            botMeanDensities = maskedArray.mean(axis=0)
+            kept = ~np.isin(materials, self.maskedMat)
         else:
-            botMeanDensities = np.mean(global_densities, 0)
+            kept = np.ones(materials.shape, dtype=bool)
+        reference = materials == self.reference_mat
+
+        local_stats = np.zeros((4, ncolumns))
+        local_stats[0] = np.bincount(columns[kept], weights=densities[kept],
+                                     minlength=ncolumns)
+        local_stats[1] = np.bincount(columns[kept], minlength=ncolumns)
+        local_stats[2] = np.bincount(columns[reference],
+                                     weights=densities[reference],
+                                     minlength=ncolumns)
+        local_stats[3] = np.bincount(columns[reference], minlength=ncolumns)
+
+        global_stats = np.zeros_like(local_stats)
+        comm.Allreduce(local_stats, global_stats)
+
+        return global_stats
+
+    @staticmethod
+    def _three_nodes_average(values):
+        return (np.roll(values, -1) + values + np.roll(values, 1)) / 3.0
+
+    @staticmethod
+    def _column_means(sums, counts):
+        means = np.zeros_like(sums)
+        np.divide(sums, counts, out=means, where=counts > 0)
+        return means
+
+    def _get_average_densities2D(self):
+
+        stats = self._get_column_statistics(rint=False)
+
+        # Calculate Mean densities at the bottom
+        botMeanDensities = self._column_means(stats[0], stats[1])
 
         # Calculate Mean densities at the bottom (reference_mat only)
-        botMeanDensities0 = np.ma.array(global_densities, mask=(global_materials != self.reference_mat))
-        botMeanDensities0 = botMeanDensities0.mean(axis=0)
-        botMeanDensities0 = np.array(botMeanDensities0)
+        botMeanDensities0 = self._column_means(stats[2], stats[3])
 
-        botMeanDensities = (np.roll(botMeanDensities, -1) + botMeanDensities + np.roll(botMeanDensities, 1)) / 3.0
-        botMeanDensities0 = (np.roll(botMeanDensities0, -1) + botMeanDensities0 + np.roll(botMeanDensities0, 1)) / 3.0
+        botMeanDensities = self._three_nodes_average(botMeanDensities)
+        botMeanDensities0 = self._three_nodes_average(botMeanDensities0)
 
         # return bottom Densities and Densities0
         return botMeanDensities, botMeanDensities0
 
     def _get_average_densities3D(self):
 
-        nx, ny, nz = self.mesh.elementRes
-        if self.mesh.elementType == "Q2":
-            fact = 2
-        elif self.mesh.elementType == "Q1":
-            fact = 1
-        nx *= fact
-        ny *= fact
-        nz *= fact
-
-        # Create some work arrays.
-        global_densities = np.zeros((nx+1)*(ny+1)*(nz+1))
-        local_densities = np.zeros((nx+1)*(ny+1)*(nz+1))
-        local_materials = np.zeros((nx+1)*(ny+1)*(nz+1))
-        global_materials = np.zeros((nx+1)*(ny+1)*(nz+1))
-
-        # Load the densities and material into the local_densities arrays
-        local_densities[self.mesh.data_nodegId[:self.mesh.nodesLocal]] = self.DensityVar.data[:self.mesh.nodesLocal]
-        local_materials[self.mesh.data_nodegId[:self.mesh.nodesLocal]] = self.MaterialVar.data[:self.mesh.nodesLocal]
-
-        # Reduce local_densities arrays to global_densities
-        comm.Allreduce(local_densities, global_densities)
-        comm.Allreduce(local_materials, global_materials)
-        comm.Barrier()
-
-        # Reshape the arrays
-        global_densities = global_densities.reshape(((nz + 1), (ny + 1), (nx + 1)))
-        global_materials = global_materials.reshape(((nz + 1), (ny + 1), (nx + 1)))
-        # Convert material values to closest integers.
-        global_materials = np.rint(global_materials).astype("int")
+        shape = get_structured_topology(self.mesh).nodeShape
+        stats = self._get_column_statistics()
 
         # Calculate Mean densities at the bottom
-        if self.maskedMat:
-            mask = np.in1d(global_materials, self.maskedMat)
-            maskedArray = np.ma.masked_array(global_densities, mask)
-            botMeanDensities = maskedArray.mean(axis=0)
-        else:
-            botMeanDensities = np.mean(global_densities, 0)
+        botMeanDensities = self._column_means(stats[0], stats[1])
+        botMeanDensities = botMeanDensities.reshape(shape[1::-1])
 
         # Calculate Mean densities at the bottom (reference_mat only)
-        botMeanDensities0 = np.ma.array(global_densities, mask=(global_materials != self.reference_mat))
-        botMeanDensities0 = botMeanDensities0.mean(axis=0)
-        botMeanDensities0 = np.array(botMeanDensities0)
+        botMeanDensities0 = self._column_means(stats[2], stats[3])
+        botMeanDensities0 = botMeanDensities0.reshape(shape[1::-1])
 
         # return bottom Densities and Densities0
         return botMeanDensities, botMeanDensities0
-
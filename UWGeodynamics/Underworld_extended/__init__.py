@@ -1,5 +1,8 @@
 from __future__ import print_function,  absolute_import
 from ._mesh import FeMesh_Cartesian
+from ._mesh import structured_node_shape, structured_node_indices
+from ._mesh import structured_element_indices
+from ._mesh import StructuredTopology, get_structured_topology
 from ._swarm import Swarm
 from ._swarmvariable import SwarmVariable
 from ._meshvariable import MeshVariable
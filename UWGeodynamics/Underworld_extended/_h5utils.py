@@ -0,0 +1,156 @@
+from __future__ import print_function,  absolute_import
+import h5py
+import numpy as np
+from contextlib import contextmanager
+from mpi4py import MPI
+
+# Files kept open by shared_h5_file
+_shared_files = {}
+
+
+class _SharedFile(object):
+    """ Proxy to a hdf5 file kept open by shared_h5_file: closing it is a
+    no-op, the file is closed when leaving shared_h5_file"""
+
+    def __init__(self, h5f):
+        self._h5f = h5f
+
+    def __getattr__(self, name):
+        return getattr(self._h5f, name)
+
+    def __contains__(self, name):
+        return name in self._h5f
+
+    def __getitem__(self, name):
+        return self._h5f[name]
+
+    def __delitem__(self, name):
+        del self._h5f[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def shared_h5_file(filename):
+    """ Keep a hdf5 file open (append mode) while several objects are
+    saved to groups of that file, so that it is only opened and closed
+    once.
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    h5f = h5py.File(name=filename, mode="a", driver='mpio',
+                    comm=MPI.COMM_WORLD)
+    _shared_files[filename] = h5f
+    try:
+        yield h5f
+    finally:
+        del _shared_files[filename]
+        h5f.close()
+
+
+def is_shared_h5_file(filename):
+    """ Check if a hdf5 file is kept open by shared_h5_file """
+    return filename in _shared_files
+
+
+def split_h5_path(filename):
+    """ Split a 'file.h5:/group' reference into the file name and the
+    group path. Returns None for the group if the reference points to the
+    root of the file."""
+    if ".h5:/" in filename:
+        filename, group = filename.rsplit(":/", 1)
+        return filename, group.strip("/") or None
+    return filename, None
+
+
+def open_h5_group(filename, group=None, mode="r"):
+    """ Open a hdf5 file in parallel and return the file and the node
+    (group or root) holding the data.
+
+    When opened for writing, an existing group is replaced.
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    if filename in _shared_files and group:
+        h5f = _SharedFile(_shared_files[filename])
+        if mode == "w":
+            if group in h5f:
+                del h5f[group]
+            return h5f, h5f.create_group(group)
+        if group not in h5f:
+            raise RuntimeError("Can't find group '{0}' in hdf5 file "
+                               "'{1}'".format(group, filename))
+        return h5f, h5f[group]
+
+    if not group:
+        h5f = h5py.File(name=filename, mode=mode, driver='mpio',
+                        comm=MPI.COMM_WORLD)
+        return h5f, h5f
+
+    if mode == "w":
+        h5f = h5py.File(name=filename, mode="a", driver='mpio',
+                        comm=MPI.COMM_WORLD)
+        if group in h5f:
+            del h5f[group]
+        return h5f, h5f.create_group(group)
+
+    h5f = h5py.File(name=filename, mode=mode, driver='mpio',
+                    comm=MPI.COMM_WORLD)
+    if group not in h5f:
+        h5f.close()
+        raise RuntimeError("Can't find group '{0}' in hdf5 file '{1}'".format(
+            group, filename))
+    return h5f, h5f[group]
+
+
+def create_dataset(node, name, shape, dtype, options=None, data=None):
+    """ Create a dataset using storage options
+
+    Parameters
+    ----------
+    node : hdf5 file or group
+    name : name of the dataset
+    shape : global shape of the dataset
+    dtype : data type of the data in memory
+    options : dictionary of storage options. Accepted keys are the
+              h5py filter options (compression, compression_opts,
+              shuffle), chunk_rows (number of rows per chunk) and
+              float32 (store floating point data in single precision).
+    data : data used to initialise the dataset
+
+    Notes
+    -----
+    Filtered datasets must be chunked and written collectively when the
+    file is opened in parallel. Parallel HDF5 only supports the deflate
+    (gzip) filter for writing: lzf is replaced by gzip when the file is
+    opened with the mpio driver.
+    """
+    options = dict(options) if options else {}
+    rows = options.pop("chunk_rows", None)
+    if options.get("compression") == "lzf" and node.file.driver == "mpio":
+        options["compression"] = "gzip"
+        options.pop("compression_opts", None)
+    if options.pop("float32", False) and np.issubdtype(dtype, np.floating):
+        dtype = np.float32
+
+    # Chunks can not be empty
+    if not shape[0]:
+        options = {}
+    elif rows:
+        options["chunks"] = (max(1, min(rows, shape[0])),) + tuple(shape[1:])
+    elif options.get("compression") or options.get("shuffle"):
+        options["chunks"] = True
+
+    return node.create_dataset(name, shape=shape, dtype=dtype, data=data,
+                               **options)
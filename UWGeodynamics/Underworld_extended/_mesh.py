@@ -1,12 +1,149 @@
 from __future__ import print_function,  absolute_import
+import contextlib
 import underworld as uw
 import h5py
+import numpy as np
 from mpi4py import MPI
 from UWGeodynamics.scaling import Dimensionalize
 from UWGeodynamics.scaling import nonDimensionalize
 from UWGeodynamics.scaling import UnitRegistry as u
 from UWGeodynamics.version import git_revision as __git_revision__
 from . import _meshvariable as var
+from ._h5utils import create_dataset
+
+
+def structured_node_shape(elementRes, elementType):
+    """ Return the number of nodes along each axis (I, J[, K]) of a
+    structured Cartesian mesh"""
+    fact = 2 if elementType.upper() == "Q2" else 1
+    return tuple([fact * res + 1 for res in elementRes])
+
+
+def structured_node_indices(node_gids, elementRes, elementType):
+    """ Return the I, J(, K) structured indices of a set of nodes
+
+    Parameters
+    ----------
+    node_gids : global ids of the nodes
+    elementRes : element resolution of the mesh
+    elementType : element type of the mesh (Q1 or Q2)
+
+    Returns
+    -------
+    A tuple of arrays (I, J) in 2D and (I, J, K) in 3D.
+
+    Notes
+    -----
+    Global ids are numbered with I varying fastest so that
+    gid = (K * nJ + J) * nI + I. The mapping is computed in O(N).
+    """
+    shape = structured_node_shape(elementRes, elementType)
+    node_gids = np.asarray(node_gids, dtype=int).ravel()
+    # unravel_index expects the slowest varying axis first
+    return np.unravel_index(node_gids, shape[::-1])[::-1]
+
+
+def structured_element_indices(element_gids, elementRes):
+    """ Return the I, J(, K) structured indices of a set of elements
+
+    Parameters
+    ----------
+    element_gids : global ids of the elements
+    elementRes : element resolution of the mesh
+
+    Returns
+    -------
+    A tuple of arrays (I, J) in 2D and (I, J, K) in 3D.
+    """
+    element_gids = np.asarray(element_gids, dtype=int).ravel()
+    return np.unravel_index(element_gids, tuple(elementRes)[::-1])[::-1]
+
+
+class StructuredTopology(object):
+    """ Structured description of a Cartesian mesh
+
+    Maps the local (+ shadow) nodes and elements of a mesh to their
+    structured (I, J[, K]) positions in the global grid. The maps, the
+    local vertex sets and the resolution factors are computed once and
+    cached. They are rebuilt if the mesh is repartitioned (the local and
+    shadow counts change) or if `invalidate` is called.
+
+    Parameters
+    ----------
+    mesh : Cartesian mesh (Q1 or Q2)
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.dim = mesh.dim
+        self.elementRes = tuple(mesh.elementRes)
+        self.factor = 2 if mesh.elementType.upper() == "Q2" else 1
+        # Number of nodes along I, J(, K)
+        self.nodeShape = structured_node_shape(self.elementRes,
+                                               mesh.elementType)
+        self._cache = dict()
+        self._partition = None
+
+    def invalidate(self):
+        """ Clear the cached maps """
+        self._cache = dict()
+        self._partition = None
+
+    def _get(self, key, builder):
+        mesh = self.mesh
+        partition = (mesh.nodesLocal, mesh.nodesDomain,
+                     mesh.subMesh.nodesLocal, mesh.subMesh.nodesDomain)
+        if partition != self._partition:
+            self._cache = dict()
+            self._partition = partition
+        if key not in self._cache:
+            self._cache[key] = builder()
+        return self._cache[key]
+
+    @property
+    def node_indices(self):
+        """ I, J(, K) positions of the local + shadow nodes """
+        return self._get("nodes", lambda: structured_node_indices(
+            self.mesh.data_nodegId, self.elementRes, self.mesh.elementType))
+
+    @property
+    def node_columns(self):
+        """ Index of the vertical column (I + J * nI) of the local + shadow
+        nodes"""
+        def builder():
+            ncolumns = int(np.prod(self.nodeShape[:-1]))
+            return np.asarray(self.mesh.data_nodegId).ravel() % ncolumns
+        return self._get("columns", builder)
+
+    @property
+    def element_indices(self):
+        """ I, J(, K) positions of the local + shadow elements (dQ0
+        subMesh nodes)"""
+        if self.mesh.subMesh.elementType.upper() != "DQ0":
+            raise ValueError("Element maps require a dQ0 subMesh")
+        return self._get("elements", lambda: structured_element_indices(
+            self.mesh.subMesh.data_nodegId, self.elementRes))
+
+    def local_vertex_set(self, name):
+        """ Local ids (shadow nodes excluded) of the nodes of a special
+        set, e.g. 'MinI_VertexSet'"""
+        def builder():
+            indexSet = self.mesh.specialSets[name]
+            if indexSet:
+                ids = np.asarray(indexSet.data)
+            else:
+                ids = np.array([], dtype=int)
+            return ids[ids < self.mesh.nodesLocal]
+        return self._get(name, builder)
+
+
+def get_structured_topology(mesh):
+    """ Return the structured topology of a mesh (cached for
+    FeMesh_Cartesian meshes)"""
+    if isinstance(mesh, FeMesh_Cartesian):
+        return mesh.structured_topology
+    return StructuredTopology(mesh)
+
 
 class FeMesh_Cartesian(uw.mesh.FeMesh_Cartesian):
 
@@ -23,6 +160,27 @@ class FeMesh_Cartesian(uw.mesh.FeMesh_Cartesian):
                                                partitioned,
                                                **kwargs)
 
+    @property
+    def geometryId(self):
+        """ Number of deformations of the mesh (see deform_mesh) """
+        return getattr(self, "_geometryId", 0)
+
+    @contextlib.contextmanager
+    def deform_mesh(self, isRegular=False):
+        """ Deform the mesh (see underworld.mesh.FeMesh.deform_mesh),
+        the geometry counter is incremented on exit"""
+        with super(FeMesh_Cartesian, self).deform_mesh(isRegular=isRegular):
+            yield
+        self._geometryId = self.geometryId + 1
+
+    @property
+    def structured_topology(self):
+        """ Cached structured (I, J[, K]) maps of the nodes and elements
+        (see StructuredTopology)"""
+        if getattr(self, "_structuredTopology", None) is None:
+            self._structuredTopology = StructuredTopology(self)
+        return self._structuredTopology
+
     def add_variable(self, nodeDofCount, dataType='double', **kwargs):
         """
         Creates and returns a mesh variable using the discretisation of the given mesh.
@@ -52,7 +210,7 @@ class FeMesh_Cartesian(uw.mesh.FeMesh_Cartesian):
 
         return  var.MeshVariable(self, nodeDofCount, dataType, **kwargs)
 
-    def save(self, filename, units=None, time=None):
+    def save(self, filename, units=None, time=None, dataset_options=None):
         """
         Save the mesh to disk
 
@@ -60,6 +218,9 @@ class FeMesh_Cartesian(uw.mesh.FeMesh_Cartesian):
         ----------
         filename : string
             The name of the output file.
+        dataset_options : dict, optional
+            Storage options of the dataset (compression, compression_opts,
+            shuffle, chunk_rows, float32).
 
         Returns
         -------
@@ -132,9 +293,8 @@ class FeMesh_Cartesian(uw.mesh.FeMesh_Cartesian):
 
         # write the vertices
         globalShape = ( self.nodesGlobal, self.data.shape[1] )
-        dset = h5f.create_dataset("vertices",
-                                  shape=globalShape,
-                                  dtype=self.data.dtype)
+        dset = create_dataset(h5f, "vertices", globalShape, self.data.dtype,
+                              options=dataset_options)
 
         local = self.nodesLocal
         # write to the dset using the local set of global node ids
@@ -143,9 +303,9 @@ class FeMesh_Cartesian(uw.mesh.FeMesh_Cartesian):
 
         # write the element node connectivity
         globalShape = ( self.elementsGlobal, self.data_elementNodes.shape[1] )
-        dset = h5f.create_dataset("en_map",
-                                  shape=globalShape,
-                                  dtype=self.data_elementNodes.dtype)
+        dset = create_dataset(h5f, "en_map", globalShape,
+                              self.data_elementNodes.dtype,
+                              options=dataset_options)
 
         local = self.elementsLocal
         # write to the dset using the local set of global node ids
@@ -3,11 +3,11 @@ import underworld as uw
 import h5py
 import numpy as np
 import os
-from mpi4py import MPI
 from UWGeodynamics.scaling import Dimensionalize
 from UWGeodynamics.scaling import nonDimensionalize
 from UWGeodynamics.scaling import UnitRegistry as u
 from UWGeodynamics.version import git_revision as __git_revision__
+from ._h5utils import split_h5_path, open_h5_group, create_dataset
 
 
 class MeshVariable(uw.mesh.MeshVariable):
@@ -23,7 +23,8 @@ class MeshVariable(uw.mesh.MeshVariable):
         ----------
         filename: str
             The filename for the saved file. Relative or absolute paths may be
-            used, but all directories must exist.
+            used, but all directories must exist. Data stored in a group of
+            a multi-field file can be loaded using 'file.h5:/group'.
         interpolate: bool
             Set to True to interpolate a file containing different resolution data.
             Note that a temporary MeshVariable with the file data will be build
@@ -51,12 +52,13 @@ class MeshVariable(uw.mesh.MeshVariable):
             raise TypeError("Expected filename to be provided as a string")
 
         # get field and mesh information
-        h5f = h5py.File( filename, "r", driver='mpio', comm=MPI.COMM_WORLD );
-        dset = h5f.get('data')
+        filename, group = split_h5_path(filename)
+        h5f, node = open_h5_group(filename, group, mode="r")
+        dset = node.get('data')
 
         # get units
         try:
-            units = h5f.attrs["units"]
+            units = node.attrs["units"]
         except KeyError:
             units = None
 
@@ -90,32 +92,32 @@ class MeshVariable(uw.mesh.MeshVariable):
             # if here then we build a local version of the entire file field and interpolate it's values
 
             # first get file field's mesh
-            if h5f.get('mesh') == None:
+            if node.get('mesh') == None:
                 raise RuntimeError("The hdf5 field to be loaded with interpolation must have an associated "+
                         "'mesh' hdf5 file. Resave the field with its associated mesh."+
                         "i.e. myField.save(\"filename.h5\", meshFilename)" )
             # get resolution of old mesh
-            res = h5f['mesh'].attrs.get('mesh resolution')
+            res = node['mesh'].attrs.get('mesh resolution')
             if res is None:
                 raise RuntimeError("Can't read the 'mesh resolution' for the field hdf5 file,"+
                        " was it created correctly?")
 
             # get max of old mesh
-            inputMax = h5f['mesh'].attrs.get('max')
+            inputMax = node['mesh'].attrs.get('max')
             if inputMax is None:
                 raise RuntimeError("Can't read the 'max' for the field hdf5 file,"+
                        " was it created correctly?")
 
-            inputMin = h5f['mesh'].attrs.get('min')
+            inputMin = node['mesh'].attrs.get('min')
             if inputMin is None:
                 raise RuntimeError("Can't read the 'min' for the field hdf5 file,"+
                        " was it created correctly?")
-            regular = h5f['mesh'].attrs.get('regular')
+            regular = node['mesh'].attrs.get('regular')
             if regular and regular!=True:
                 raise RuntimeError("Saved mesh file appears to correspond to a irregular mesh.\n"\
                                    "Interpolating from irregular mesh not currently supported." )
 
-            elType = h5f['mesh'].attrs.get('elementType')
+            elType = node['mesh'].attrs.get('elementType')
             # for backwards compatiblity, the 'elementType' attribute was added Feb2017
             if elType == None:
                 elType = 'Q1'
@@ -155,7 +157,8 @@ class MeshVariable(uw.mesh.MeshVariable):
         uw.libUnderworld.StgFEM._FeVariable_SyncShadowValues( self._cself )
         h5f.close()
 
-    def save(self, filename, meshHandle=None, units=None, time=None):
+    def save(self, filename, meshHandle=None, units=None, time=None,
+             group=None, dataset_options=None):
         """
         Save the MeshVariable to disk.
 
@@ -168,6 +171,13 @@ class MeshVariable(uw.mesh.MeshVariable):
             The saved mesh file handle. If provided, a link is created within the
             mesh variable file to this saved mesh file. Important for checkpoint when
             the mesh deforms.
+        group : string, optional
+            Name of the group the data are saved to. If provided, the file
+            is opened in append mode so that several variables can be
+            stored in the same file.
+        dataset_options : dict, optional
+            Storage options of the dataset (compression, compression_opts,
+            shuffle, chunk_rows, float32).
 
         Notes
         -----
@@ -215,26 +225,25 @@ class MeshVariable(uw.mesh.MeshVariable):
             raise TypeError("Expected 'filename' to be provided as a string")
 
         mesh = self.mesh
-        h5f = h5py.File(name=filename, mode="w", driver='mpio', comm=MPI.COMM_WORLD)
+        h5f, node = open_h5_group(filename, group, mode="w")
 
         # ugly global shape def
         globalShape = ( mesh.nodesGlobal, self.data.shape[1] )
         # create dataset
-        dset = h5f.create_dataset("data",
-                                  shape=globalShape,
-                                  dtype=self.data.dtype)
+        dset = create_dataset(node, "data", globalShape, self.data.dtype,
+                              options=dataset_options)
         fact = 1.0
         if units:
             fact = Dimensionalize(1.0, units=units).magnitude
             if units == "degC":
                 fact = Dimensionalize(1.0, units=u.degK).magnitude
             # Save unit type as attribute
-            h5f.attrs['units'] = str(units)
+            node.attrs['units'] = str(units)
 
         if time:
-            h5f.attrs['time'] = str(time)
+            node.attrs['time'] = str(time)
 
-        h5f.attrs["git commit"] = __git_revision__
+        node.attrs["git commit"] = __git_revision__
 
         # write to the dset using the global node ids
         local = mesh.nodesLocal
@@ -246,7 +255,7 @@ class MeshVariable(uw.mesh.MeshVariable):
                 dset[mesh.data_nodegId[0:local],:] = self.data[0:local] * fact
 
         # save a hdf5 attribute to the elementType used for this field - maybe useful
-        h5f.attrs["elementType"] = np.string_(mesh.elementType)
+        node.attrs["elementType"] = np.string_(mesh.elementType)
 
         if hasattr( mesh.generator, "geometryMesh"):
             mesh = mesh.generator.geometryMesh
@@ -269,7 +278,7 @@ class MeshVariable(uw.mesh.MeshVariable):
                                   that does not appear to exist. If you need to link \n\
                                   against a mesh file, please make sure it is created first.".format(meshFilename))
             # set reference to mesh (all procs must call following)
-            h5f["mesh"] = h5py.ExternalLink(meshFilename, "./")
+            node["mesh"] = h5py.ExternalLink(meshFilename, "./")
 
         h5f.close()
 
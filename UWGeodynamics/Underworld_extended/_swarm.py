@@ -56,7 +56,8 @@ class Swarm(uw.swarm.Swarm):
         """
         return svar.SwarmVariable( self, dataType, count )
 
-    def save(self, filename, collective=False, units=None, time=None):
+    def save(self, filename, collective=False, units=None, time=None,
+             dataset_options=None):
         """
         Save the swarm to disk.
 
@@ -65,6 +66,9 @@ class Swarm(uw.swarm.Swarm):
         filename : str
             The filename for the saved file. Relative or absolute paths may be
             used, but all directories must exist.
+        dataset_options : dict, optional
+            Storage options of the dataset (compression, compression_opts,
+            shuffle, chunk_rows, float32).
 
         Returns
         -------
@@ -110,7 +114,9 @@ class Swarm(uw.swarm.Swarm):
             raise TypeError("Expected filename to be provided as a string")
 
         # just save the particle coordinates SwarmVariable
-        self.particleCoordinates.save(filename, collective, units=units, time=time)
+        self.particleCoordinates.save(filename, collective, units=units,
+                                      time=time,
+                                      dataset_options=dataset_options)
 
         return uw.utils.SavedFileData( self, filename )
 
@@ -7,6 +7,8 @@ from UWGeodynamics.scaling import Dimensionalize
 from UWGeodynamics.scaling import nonDimensionalize
 from UWGeodynamics.scaling import UnitRegistry as u
 from UWGeodynamics.version import git_revision as __git_revision__
+from ._h5utils import split_h5_path, open_h5_group, create_dataset
+from ._h5utils import is_shared_h5_file
 
 
 class SwarmVariable(uw.swarm.SwarmVariable):
@@ -23,7 +25,8 @@ class SwarmVariable(uw.swarm.SwarmVariable):
         ----------
         filename : str
             The filename for the saved file. Relative or absolute paths may be
-            used, but all directories must exist.
+            used, but all directories must exist. Data stored in a group of
+            a multi-field file can be loaded using 'file.h5:/group'.
 
         Notes
         -----
@@ -48,10 +51,11 @@ class SwarmVariable(uw.swarm.SwarmVariable):
         rank = comm.rank
 
         # open hdf5 file
-        h5f = h5py.File(name=filename, mode="r", driver='mpio', comm=MPI.COMM_WORLD)
+        filename, group = split_h5_path(filename)
+        h5f, node = open_h5_group(filename, group, mode="r")
 
 
-        dset = h5f.get('data')
+        dset = node.get('data')
         if dset == None:
             raise RuntimeError("Can't find 'data' in file '{}'.\n".format(filename))
 
@@ -113,7 +117,7 @@ class SwarmVariable(uw.swarm.SwarmVariable):
 
         # get units
         try:
-            units = h5f.attrs["units"]
+            units = node.attrs["units"]
         except KeyError:
             units = None
 
@@ -127,7 +131,8 @@ class SwarmVariable(uw.swarm.SwarmVariable):
         if units:
             self.data[:] = nonDimensionalize(self.data * units)
 
-    def save( self, filename, collective=False, units=None, time=None):
+    def save( self, filename, collective=False, units=None, time=None,
+              group=None, dataset_options=None):
         """
         Save the swarm variable to disk.
 
@@ -139,6 +144,13 @@ class SwarmVariable(uw.swarm.SwarmVariable):
         swarmHandle :uw.utils.SavedFileData , optional
             The saved swarm file handle. If provided, a reference to the swarm file
             is made. Currently this doesn't provide any extra functionality.
+        group : str, optional
+            Name of the group the data are saved to. If provided, the file
+            is opened in append mode so that the variable can be stored
+            alongside other data (e.g. the swarm coordinates).
+        dataset_options : dict, optional
+            Storage options of the dataset (compression, compression_opts,
+            shuffle, chunk_rows, float32).
 
         Returns
         -------
@@ -209,21 +221,26 @@ class SwarmVariable(uw.swarm.SwarmVariable):
             offset += procCount[i]
 
         # open parallel hdf5 file
-        with h5py.File(name=filename, mode="w", driver='mpio', comm=MPI.COMM_WORLD) as h5f:
+        shared = group and is_shared_h5_file(filename)
+        h5f, node = open_h5_group(filename, group, mode="w")
+        with h5f:
             # write the entire local swarm to the appropriate offset position
             globalShape = (particleGlobalCount, self.data.shape[1])
-            dset = h5f.create_dataset("data",
-                                       shape=globalShape,
-                                       dtype=self.data.dtype)
+            dset = create_dataset(node, "data", globalShape, self.data.dtype,
+                                  options=dataset_options)
+
+            # filtered datasets must be written collectively
+            if dset.compression or dset.shuffle:
+                collective = True
             fact = 1.0
             if units:
                 fact = Dimensionalize(1.0, units=units).magnitude
-                h5f.attrs['units'] = str(units)
+                node.attrs['units'] = str(units)
 
             if time is not None:
-                h5f.attrs['time'] = str(time)
+                node.attrs['time'] = str(time)
 
-            h5f.attrs["git commit"] = __git_revision__
+            node.attrs["git commit"] = __git_revision__
 
             if collective:
                 with dset.collective:
@@ -231,13 +248,19 @@ class SwarmVariable(uw.swarm.SwarmVariable):
             else:
                 dset[offset:offset + swarm.particleLocalCount] = self.data[:] * fact
 
+            if shared:
+                # The file can not be reopened in serial while it is kept
+                # open, the offsets are identical on all the processors
+                node.attrs["proc_offset"] = procCount
+
         # let's reopen in serial to write the attrib.
         # not sure if this really is necessary.
         comm.barrier()
-        if comm.rank==0:
+        if comm.rank==0 and not shared:
             with h5py.File(name=filename, mode="a") as h5f:
                 # attribute of the proc offsets - used for loading from checkpoint
-                h5f.attrs["proc_offset"] = procCount
+                node = h5f[group] if group else h5f
+                node.attrs["proc_offset"] = procCount
 
         return uw.utils.SavedFileData( self, filename )
 
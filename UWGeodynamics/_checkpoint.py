@@ -0,0 +1,553 @@
+from __future__ import print_function,  absolute_import
+import os
+import atexit
+import threading
+import numpy as np
+import h5py
+import underworld as uw
+from mpi4py import MPI
+from . import rcParams
+from .scaling import Dimensionalize
+from .scaling import UnitRegistry as u
+from .version import git_revision as __git_revision__
+from .Underworld_extended._h5utils import create_dataset, shared_h5_file
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+
+
+class CheckpointWriter(object):
+    """ Asynchronous checkpoint writer
+
+    The data to be saved are copied (gathered) into buffers on rank 0 and
+    written to disk by a background thread while the Model keeps running.
+    The files follow the same layout as the one produced by the save
+    methods of the Underworld_extended objects and can be reloaded
+    transparently.
+
+    The writer thread only performs serial I/O on rank 0, it never
+    communicates. The amount of data held in buffers on rank 0 is bounded
+    by `budget` (in bytes): the space is reserved before the data are
+    gathered and rank 0 waits for the writer when the budget would be
+    exceeded. Files larger than the budget are saved synchronously with
+    the collective (mpio) path, so that the memory of rank 0 does not grow
+    with the size of the model.
+
+    Callbacks registered with `when_done` (typically used to write the XDMF
+    files) are run collectively on the main thread by `finalize`.
+    """
+
+    def __init__(self, budget, comm=None):
+        self.budget = budget
+        self.comm = comm if comm else MPI.COMM_WORLD
+        self._queue = queue.Queue()
+        self._condition = threading.Condition()
+        self._pending_bytes = 0
+        self._reserved = 0
+        self._submitted = 0
+        self._completed = 0
+        self._callbacks = list()
+        self._error = None
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            filename, groups, nbytes = self._queue.get()
+            error = None
+            try:
+                mode = "a" if groups[0][0] else "w"
+                with h5py.File(name=filename, mode=mode) as h5f:
+                    for group, datasets, attrs, options in groups:
+                        if group:
+                            if group in h5f:
+                                del h5f[group]
+                            node = h5f.create_group(group)
+                        else:
+                            node = h5f
+                        for key, value in attrs.items():
+                            node.attrs[key] = value
+                        for name, data in datasets.items():
+                            create_dataset(node, name, data.shape,
+                                           data.dtype, options=options,
+                                           data=data)
+            except Exception as exception:
+                error = "{0}: {1}".format(filename, exception)
+            # The error is handed to the main thread under the lock
+            with self._condition:
+                if error and not self._error:
+                    self._error = error
+                self._pending_bytes -= nbytes
+                self._completed += 1
+                self._condition.notify_all()
+
+    def fits(self, nbytes):
+        """ Check if a file of size nbytes can be buffered """
+        return nbytes <= self.budget
+
+    def reserve(self, nbytes):
+        """ Reserve the space of the buffers of the next file on rank 0
+
+        Rank 0 waits for the writer until nbytes more can be buffered. This
+        is done before the data are gathered so that the buffers never
+        exceed the budget. The space is used by the next call to write or
+        write_groups.
+        """
+        if self.comm.rank != 0:
+            return
+        with self._condition:
+            while (self._pending_bytes and
+                   self._pending_bytes + nbytes > self.budget):
+                self._condition.wait()
+            self._pending_bytes += nbytes
+            self._reserved += nbytes
+
+    def write(self, filename, datasets, attrs, nbytes, group=None,
+              options=None):
+        """ Queue a file for writing
+
+        Parameters
+        ----------
+
+        filename : path of the hdf5 file
+        datasets : dictionary of numpy arrays (only used on rank 0)
+        attrs : dictionary of hdf5 attributes (only used on rank 0)
+        nbytes : size of the buffers
+        group : name of the group the data are written to (the file is
+                then opened in append mode)
+        options : storage options of the datasets
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        self.write_groups(filename, [(group, datasets, attrs, options)],
+                          nbytes)
+
+    def write_groups(self, filename, groups, nbytes):
+        """ Queue several groups of a file for writing, the file is opened
+        once for all the groups
+
+        Parameters
+        ----------
+
+        filename : path of the hdf5 file
+        groups : list of (group, datasets, attrs, options), see write
+        nbytes : total size of the buffers
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        self._submitted += 1
+        if self.comm.rank != 0:
+            return
+
+        self._start()
+        if not self._reserved:
+            self.reserve(nbytes)
+        self._reserved = 0
+        self._queue.put((filename, groups, nbytes))
+
+    def when_done(self, callback):
+        """ Register a callback to be run once all the files submitted so
+        far have been written"""
+        self._callbacks.append((self._submitted, callback))
+
+    def flush(self):
+        """ Wait for the writer thread (rank 0 only, no communication) """
+        if self._thread is None:
+            return
+        with self._condition:
+            while self._completed < self._submitted:
+                self._condition.wait()
+
+    def finalize(self, block=False):
+        """ Run the callbacks of the completed files
+
+        Parameters
+        ----------
+
+        block : wait for all the pending files to be written
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        if self.comm.rank == 0:
+            if block:
+                self.flush()
+            with self._condition:
+                if self._thread:
+                    completed = self._completed
+                else:
+                    completed = self._submitted
+                error = self._error
+                self._error = None
+        else:
+            completed = None
+            error = None
+
+        completed, error = self.comm.bcast((completed, error), root=0)
+
+        if error:
+            raise RuntimeError("Asynchronous checkpoint failed: " + error)
+
+        callbacks = [val for val in self._callbacks if val[0] <= completed]
+        self._callbacks = [val for val in self._callbacks
+                           if val[0] > completed]
+        for _, callback in callbacks:
+            callback()
+
+    @property
+    def pending(self):
+        """ Number of callbacks waiting for their files to be written """
+        return len(self._callbacks)
+
+
+def _scaling(units):
+    """ Return the multiplicative factor and offset used to dimensionalise
+    data for output"""
+    if not units:
+        return 1.0, 0.0
+    if units == "degC":
+        return Dimensionalize(1.0, units=u.degK).magnitude, -273.15
+    return Dimensionalize(1.0, units=units).magnitude, 0.0
+
+
+def _scale(data, units, fact, offset=0.0):
+    """ Scale a copy of data for output, keeping its dtype (as the
+    synchronous save does)"""
+    if not units:
+        return np.copy(data)
+    return (data * fact + offset).astype(data.dtype)
+
+
+def _gather(comm, values):
+    """ Gather the local arrays on rank 0, concatenated in rank order. The
+    data are received in a single buffer (no pickling)."""
+    values = np.ascontiguousarray(values)
+    counts = comm.gather(values.size, root=0)
+    if comm.rank != 0:
+        comm.Gatherv(values, None, root=0)
+        return None
+    data = np.empty(sum(counts), dtype=values.dtype)
+    comm.Gatherv(values, [data, counts], root=0)
+    return data.reshape((-1,) + values.shape[1:])
+
+
+def _gather_by_index(comm, indices, values, shape, dtype):
+    """ Gather local values on rank 0 into an array of global shape """
+    indices = _gather(comm, np.asarray(indices, dtype="int64"))
+    values = _gather(comm, np.asarray(values, dtype=dtype))
+    if comm.rank != 0:
+        return None
+    data = np.zeros(shape, dtype=dtype)
+    data[indices] = values
+    return data
+
+
+def _flush(writer):
+    """ Make sure no asynchronous write is pending before a synchronous
+    save (files may be shared when saving to groups)"""
+    if writer is not None and writer.comm.rank == 0:
+        writer.flush()
+
+
+def save_mesh_variable(writer, obj, filename, units=None, time=None,
+                       group=None, dataset_options=None):
+    """ Save a MeshVariable, asynchronously if the writer can buffer it
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    nbytes = _mesh_variable_size(obj)
+
+    if writer is None or not writer.fits(nbytes):
+        _flush(writer)
+        return obj.save(filename, units=units, time=time, group=group,
+                        dataset_options=dataset_options)
+
+    writer.reserve(nbytes)
+    datasets, attrs = _mesh_variable_data(writer.comm, obj, units, time)
+    writer.write(filename, datasets, attrs, nbytes, group=group,
+                 options=dataset_options)
+    return uw.utils.SavedFileData(obj, filename)
+
+
+def save_mesh_variables(writer, variables, filename, time=None):
+    """ Save several MeshVariables to groups of the same file, which is
+    only opened once. The file is written asynchronously if the writer
+    can buffer all the variables.
+
+    Parameters
+    ----------
+
+    variables : list of (MeshVariable, group, units, dataset options)
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    nbytes = sum([_mesh_variable_size(obj) for obj, _, _, _ in variables])
+
+    if writer is None or not writer.fits(nbytes):
+        _flush(writer)
+        with shared_h5_file(filename):
+            return [obj.save(filename, units=units, time=time, group=group,
+                             dataset_options=options)
+                    for obj, group, units, options in variables]
+
+    writer.reserve(nbytes)
+    groups = list()
+    for obj, group, units, options in variables:
+        datasets, attrs = _mesh_variable_data(writer.comm, obj, units, time)
+        groups.append((group, datasets, attrs, options))
+    writer.write_groups(filename, groups, nbytes)
+    return [uw.utils.SavedFileData(obj, filename)
+            for obj, _, _, _ in variables]
+
+
+def _mesh_variable_size(obj):
+    """ Size in bytes of the global data of a MeshVariable """
+    shape = (obj.mesh.nodesGlobal, obj.data.shape[1])
+    return int(np.prod(shape)) * obj.data.dtype.itemsize
+
+
+def _mesh_variable_data(comm, obj, units, time):
+    """ Gather the data of a MeshVariable on rank 0, return the datasets
+    and the attributes to be written"""
+    mesh = obj.mesh
+    shape = (mesh.nodesGlobal, obj.data.shape[1])
+    local = mesh.nodesLocal
+    fact, offset = _scaling(units)
+    indices = np.array(mesh.data_nodegId[0:local]).ravel()
+    values = _scale(obj.data[0:local], units, fact, offset)
+    data = _gather_by_index(comm, indices, values, shape, obj.data.dtype)
+
+    attrs = {"git commit": __git_revision__,
+             "elementType": np.string_(mesh.elementType)}
+    if units:
+        attrs["units"] = str(units)
+    if time:
+        attrs["time"] = str(time)
+    return {"data": data}, attrs
+
+
+def save_mesh(writer, mesh, filename, units=None, time=None,
+              dataset_options=None):
+    """ Save a FeMesh_Cartesian, asynchronously if the writer can buffer it
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    vshape = (mesh.nodesGlobal, mesh.data.shape[1])
+    eshape = (mesh.elementsGlobal, mesh.data_elementNodes.shape[1])
+    nbytes = (int(np.prod(vshape)) * mesh.data.dtype.itemsize +
+              int(np.prod(eshape)) * mesh.data_elementNodes.dtype.itemsize)
+
+    if writer is None or not writer.fits(nbytes):
+        _flush(writer)
+        return mesh.save(filename, units=units, time=time,
+                         dataset_options=dataset_options)
+
+    writer.reserve(nbytes)
+    comm = writer.comm
+    fact, _ = _scaling(units)
+
+    local = mesh.nodesLocal
+    indices = np.array(mesh.data_nodegId[0:local]).ravel()
+    vertices = _gather_by_index(comm, indices, mesh.data[0:local] * fact,
+                                vshape, mesh.data.dtype)
+
+    local = mesh.elementsLocal
+    indices = np.array(mesh.data_elgId[0:local]).ravel()
+    en_map = _gather_by_index(comm, indices,
+                              mesh.data_elementNodes[0:local],
+                              eshape, mesh.data_elementNodes.dtype)
+
+    attrs = {"dimensions": mesh.dim,
+             "mesh resolution": mesh.elementRes,
+             "max": tuple([fact * x for x in mesh.maxCoord]),
+             "min": tuple([fact * x for x in mesh.minCoord]),
+             "regular": mesh._cself.isRegular,
+             "elementType": mesh.elementType,
+             "time": str(time),
+             "git commit": __git_revision__}
+    if units:
+        attrs["units"] = str(units)
+
+    writer.write(filename, {"vertices": vertices, "en_map": en_map},
+                 attrs, nbytes, options=dataset_options)
+    return uw.utils.SavedFileData(mesh, filename)
+
+
+def save_swarm_variable(writer, obj, filename, units=None, time=None,
+                        pyobj=None, group=None, dataset_options=None):
+    """ Save a SwarmVariable, asynchronously if the writer can buffer it
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    # The decision to buffer the data must be the same on all the
+    # processors
+    nbytes = _swarm_variable_size(writer, obj)
+
+    if writer is None or not writer.fits(nbytes):
+        _flush(writer)
+        if pyobj is not None:
+            pyobj.save(filename, units=units, time=time,
+                       dataset_options=dataset_options)
+            return uw.utils.SavedFileData(pyobj, filename)
+        return obj.save(filename, units=units, time=time, group=group,
+                        dataset_options=dataset_options)
+
+    writer.reserve(nbytes)
+    datasets, attrs = _swarm_variable_data(writer.comm, obj, units, time)
+    writer.write(filename, datasets, attrs, nbytes, group=group,
+                 options=dataset_options)
+    pyobj = pyobj if pyobj is not None else obj
+    return uw.utils.SavedFileData(pyobj, filename)
+
+
+def save_swarm_variables(writer, variables, filename, time=None):
+    """ Save several SwarmVariables to groups of the same file (e.g. the
+    swarm file), which is only opened once. The file is written
+    asynchronously if the writer can buffer all the variables.
+
+    Parameters
+    ----------
+
+    variables : list of (SwarmVariable, group, units, dataset options)
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    nbytes = sum([_swarm_variable_size(writer, obj)
+                  for obj, _, _, _ in variables])
+
+    if writer is None or not writer.fits(nbytes):
+        _flush(writer)
+        with shared_h5_file(filename):
+            return [obj.save(filename, units=units, time=time, group=group,
+                             dataset_options=options)
+                    for obj, group, units, options in variables]
+
+    writer.reserve(nbytes)
+    groups = list()
+    for obj, group, units, options in variables:
+        datasets, attrs = _swarm_variable_data(writer.comm, obj, units, time)
+        groups.append((group, datasets, attrs, options))
+    writer.write_groups(filename, groups, nbytes)
+    return [uw.utils.SavedFileData(obj, filename)
+            for obj, _, _, _ in variables]
+
+
+def _swarm_variable_size(writer, obj):
+    """ Size in bytes of the global data of a SwarmVariable (0 without a
+    writer, the size is then not needed)"""
+    if writer is None:
+        return 0
+    count = writer.comm.allreduce(obj.swarm.particleLocalCount)
+    return count * obj.data.shape[1] * obj.data.dtype.itemsize
+
+
+def _swarm_variable_data(comm, obj, units, time):
+    """ Gather the data of a SwarmVariable on rank 0, return the datasets
+    and the attributes to be written"""
+    procCount = comm.allgather(obj.swarm.particleLocalCount)
+    fact, _ = _scaling(units)
+    data = _gather(comm, _scale(obj.data[:], units, fact))
+
+    attrs = {"git commit": __git_revision__,
+             "proc_offset": procCount}
+    if units:
+        attrs["units"] = str(units)
+    if time is not None:
+        attrs["time"] = str(time)
+    return {"data": data}, attrs
+
+
+def save_swarm(writer, swarm, filename, units=None, time=None,
+               dataset_options=None):
+    """ Save a Swarm, asynchronously if the writer can buffer it
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    return save_swarm_variable(writer, swarm.particleCoordinates, filename,
+                               units=units, time=time, pyobj=swarm,
+                               dataset_options=dataset_options)
+
+
+def dataset_options(name):
+    """ Return the storage options of a checkpointed object (field name,
+    "mesh" or "swarm") as defined in the rcParams"""
+    options = {}
+    compression = rcParams["checkpoint.compression"]
+    if compression and name not in rcParams["checkpoint.uncompressed.fields"]:
+        options["compression"] = compression
+        if compression == "gzip":
+            options["compression_opts"] = (
+                rcParams["checkpoint.compression.level"])
+        options["shuffle"] = rcParams["checkpoint.shuffle"]
+    if rcParams["checkpoint.chunk.size"]:
+        options["chunk_rows"] = rcParams["checkpoint.chunk.size"]
+    # Coordinates are always saved in double precision
+    if (name not in ["mesh", "swarm"] and
+            name in rcParams["checkpoint.float32.fields"]):
+        options["float32"] = True
+    return options
+
+
+def downcast_schema(schema):
+    """ Set the precision of the floating point data of a XDMF schema to
+    single precision"""
+    return schema.replace('NumberType="Float" Precision="8"',
+                          'NumberType="Float" Precision="4"')
+
+
+def grouped_schema(schema, group):
+    """ Point the hdf5 references of a XDMF schema to a group """
+    return schema.replace(":/data<", ":/{0}/data<".format(group))
+
+
+def find_checkpoint_data(directory, field, step, swarm=False):
+    """ Return the path to the data of a field for a given checkpoint
+    step, or None if they can not be found.
+
+    The data are either stored in their own file (field-step.h5) or in a
+    group of a multi-field file (fields-step.h5 for mesh variables,
+    swarm-step.h5 for swarm variables). Paths to groups are
+    returned as 'file.h5:/group'.
+
+    Notes
+    -----
+    This function must be called collectively by all processes.
+    """
+    path = os.path.join(directory, field + "-%s.h5" % step)
+    if os.path.exists(path):
+        return path
+
+    prefix = "swarm" if swarm else "fields"
+    path = os.path.join(directory, prefix + "-%s.h5" % step)
+    if not os.path.exists(path):
+        return None
+
+    with h5py.File(path, "r", driver="mpio", comm=MPI.COMM_WORLD) as h5f:
+        if field not in h5f:
+            return None
+    return path + ":/" + field
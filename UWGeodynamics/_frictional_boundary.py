@@ -2,6 +2,7 @@ from __future__ import print_function,  absolute_import
 import numpy as np
 import underworld as uw
 import underworld.function as fn
+from .Underworld_extended import get_structured_topology
 
 class FrictionBoundaries(object):
     """ This class flags elements at the boundaries
@@ -14,10 +15,6 @@ class FrictionBoundaries(object):
         self.Model = Model
         self.thickness = thickness
 
-        # Build borders
-        globalIndices = np.arange(np.prod(Model.mesh.elementRes))
-        globalIndices = globalIndices.reshape((Model.mesh.elementRes[::-1]))
-
         self.bottomFriction = bottomFriction
         self.rightFriction = rightFriction
         self.leftFriction = leftFriction
@@ -35,13 +32,7 @@ class FrictionBoundaries(object):
             self._right_mask = uw.mesh.MeshVariable(mesh=self.subMesh, nodeDofCount=1)
             self._right_mask.data[:] = 0
 
-            if Model.mesh.dim < 3:
-                right = globalIndices[:, -thickness:].ravel()
-            else:
-                right = globalIndices[:, :, -thickness:].ravel()
-
-            intersect = np.intersect1d(self.subMesh.data_nodegId.ravel(), right)
-            mask = np.in1d(self.subMesh.data_nodegId.ravel(), intersect)
+            mask = self._boundary_mask(axis=0, upper=True)
             self._right_mask.data[mask, 0] = 1
             self._mask.data[mask, 0] = 1
             conditions.append((self._right_mask > 0., self.rightFriction))
@@ -50,13 +41,7 @@ class FrictionBoundaries(object):
             self._left_mask = uw.mesh.MeshVariable(mesh=self.subMesh, nodeDofCount=1)
             self._left_mask.data[:] = 0
 
-            if Model.mesh.dim < 3:
-                left = globalIndices[:, :thickness].ravel()
-            else:
-                left = globalIndices[:, :, :thickness].ravel()
-
-            intersect = np.intersect1d(self.subMesh.data_nodegId.ravel(), left)
-            mask = np.in1d(self.subMesh.data_nodegId.ravel(), intersect)
+            mask = self._boundary_mask(axis=0, upper=False)
             self._left_mask.data[mask, 0] = 1
             self._mask.data[mask, 0] = 1
             conditions.append((self._left_mask > 0., self.leftFriction))
@@ -65,13 +50,10 @@ class FrictionBoundaries(object):
             self._front_mask = uw.mesh.MeshVariable(mesh=self.subMesh, nodeDofCount=1)
             self._front_mask.data[:] = 0
 
-            if Model.mesh.dim > 2:
-                front = globalIndices[:, :thickness, :].ravel()
-            else:
+            if Model.mesh.dim < 3:
                 raise ValueError("Mesh is 2D")
 
-            intersect = np.intersect1d(self.subMesh.data_nodegId.ravel(), front)
-            mask = np.in1d(self.subMesh.data_nodegId.ravel(), intersect)
+            mask = self._boundary_mask(axis=1, upper=False)
             self._front_mask.data[mask, 0] = 1
             self._mask.data[mask, 0] = 1
             conditions.append((self._front_mask > 0., self.frontFriction))
@@ -80,13 +62,10 @@ class FrictionBoundaries(object):
             self._back_mask = uw.mesh.MeshVariable(mesh=self.subMesh, nodeDofCount=1)
             self._back_mask.data[:] = 0
 
-            if Model.mesh.dim > 2:
-                back = globalIndices[:, -thickness:, :].ravel()
-            else:
+            if Model.mesh.dim < 3:
                 raise ValueError("Mesh is 2D")
 
-            intersect = np.intersect1d(self.subMesh.data_nodegId.ravel(), back)
-            mask = np.in1d(self.subMesh.data_nodegId.ravel(), intersect)
+            mask = self._boundary_mask(axis=1, upper=True)
             self._back_mask.data[mask, 0] = 1
             self._mask.data[mask, 0] = 1
             conditions.append((self._back_mask > 0., self.backFriction))
@@ -95,12 +74,9 @@ class FrictionBoundaries(object):
             self._bottom_mask = uw.mesh.MeshVariable(mesh=self.subMesh, nodeDofCount=1)
             self._bottom_mask.data[:] = 0
 
-            bottom = globalIndices[:thickness].ravel()
-            # Take the intersection between the globalID and the boundaries where
-            # friction is to be applied
-            intersect = np.intersect1d(self.subMesh.data_nodegId.ravel(), bottom)
-            # Create a mask to highlight those elements in the local domain
-            mask = np.in1d(self.subMesh.data_nodegId.ravel(), intersect)
+            # Create a mask to highlight the elements of the local domain
+            # where friction is to be applied
+            mask = self._boundary_mask(axis=Model.mesh.dim - 1, upper=False)
             self._bottom_mask.data[mask, 0] = 1
             self._mask.data[mask, 0] = 1
             conditions.append((self._bottom_mask > 0., self.bottomFriction))
@@ -109,12 +85,33 @@ class FrictionBoundaries(object):
             self._top_mask = uw.mesh.MeshVariable(mesh=self.subMesh, nodeDofCount=1)
             self._top_mask.data[:] = 0
 
-            top = globalIndices[-thickness:].ravel()
-            intersect = np.intersect1d(self.subMesh.data_nodegId.ravel(), top)
-            mask = np.in1d(self.subMesh.data_nodegId.ravel(), intersect)
+            mask = self._boundary_mask(axis=Model.mesh.dim - 1, upper=True)
             self._top_mask.data[mask, 0] = 1
             self._mask.data[mask, 0] = 1
             conditions.append((self._top_mask > 0., self.topFriction))
 
         conditions.append((True, -1.0))
         self.friction = fn.branching.conditional(conditions)
+
+    def _boundary_mask(self, axis, upper):
+        """ Mask of the local + shadow elements lying within `thickness`
+        elements of the lower or upper boundary along an axis"""
+        mesh = self.Model.mesh
+        thickness = self.thickness
+
+        if self.subMesh.elementType.upper() == "DQ0":
+            # Use the cached structured positions of the elements
+            index = get_structured_topology(mesh).element_indices[axis]
+            if upper:
+                return index >= mesh.elementRes[axis] - thickness
+            return index < thickness
+
+        globalIndices = np.arange(np.prod(mesh.elementRes))
+        globalIndices = globalIndices.reshape((mesh.elementRes[::-1]))
+        border = [slice(None)] * mesh.dim
+        if upper:
+            border[mesh.dim - 1 - axis] = slice(-thickness, None)
+        else:
+            border[mesh.dim - 1 - axis] = slice(None, thickness)
+        border = globalIndices[tuple(border)].ravel()
+        return np.isin(self.subMesh.data_nodegId.ravel(), border)
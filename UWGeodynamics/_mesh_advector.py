@@ -4,6 +4,7 @@ import underworld as uw
 import numpy as np
 import sys
 from mpi4py import MPI
+from .Underworld_extended import get_structured_topology
 
 comm = MPI.COMM_WORLD
 size = comm.Get_size()
@@ -44,17 +45,14 @@ class _mesh_advector(object):
         minX += vxLeft * dt
         maxX += vxRight * dt
 
-        if self.Model.mesh.dim <3:
-            newValues = np.linspace(minX, maxX, self.Model.mesh.elementRes[axis]+1)
-            newValues = np.repeat(newValues[np.newaxis,:], self.Model.mesh.elementRes[1] + 1, axis)
-        else:
-            newValues = np.linspace(minX, maxX, self.Model.mesh.elementRes[axis]+1)
-            newValues = np.repeat(newValues[np.newaxis, :], self.Model.mesh.elementRes[1] + 1, axis)
-            newValues = np.repeat(newValues[np.newaxis, :, :], self.Model.mesh.elementRes[2] + 1, axis)
+        # Regularly spaced coordinates along the axis, mapped to the nodes
+        # through their cached structured positions.
+        topology = get_structured_topology(self.Model.mesh)
+        newValues = np.linspace(minX, maxX, topology.nodeShape[axis])
 
         with self._mesh2nd.deform_mesh():
-            values = newValues.flatten()
-            self._mesh2nd.data[:, axis] = values[self._mesh2nd.data_nodegId.ravel()]
+            self._mesh2nd.data[:, axis] = (
+                newValues[topology.node_indices[axis]])
 
         uw.barrier()
 
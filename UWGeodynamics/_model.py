@@ -14,6 +14,7 @@ from .scaling import nonDimensionalize as nd
 from .scaling import UnitRegistry as u
 from .lithopress import LithostaticPressure
 from ._utils import PressureSmoother, PassiveTracers, PassiveTracersGrid
+from ._utils import Timings, BatchedProjector, Nearest_neighbors_projector
 from ._rheology import ViscosityLimiter, StressLimiter
 from ._material import Material
 from ._visugrid import Visugrid
@@ -29,11 +30,48 @@ from .Underworld_extended import SwarmVariable
 from datetime import datetime
 from .version import full_version
 from ._freesurface import FreeSurfaceProcessor
+from ._checkpoint import CheckpointWriter
+from ._checkpoint import save_mesh, save_mesh_variable, save_mesh_variables
+from ._checkpoint import save_swarm, save_swarm_variable, save_swarm_variables
+from ._checkpoint import grouped_schema, find_checkpoint_data
+from ._checkpoint import dataset_options, downcast_schema
 from mpi4py import MPI
 
 _dim_gravity = {'[length]': 1.0, '[time]': -2.0}
 _dim_time = {'[time]': 1.0}
 
+# Phases timed during Model.run_for (see Model.timings)
+_timed_phases = ["Stokes solve", "Isostasy", "Timestep", "Plastic strain",
+                 "Melt", "Temperature", "Swarm advection", "Stress history",
+                 "Passive tracers", "Population control",
+                 "Surface processes", "Visugrid", "Phase changes",
+                 "Checkpoint fields", "Checkpoint tracers",
+                 "Checkpoint swarms"]
+
+# Fields projected from the swarm on the mesh (or submesh):
+# property -> (swarm variable, projected mesh variable, source function
+# evaluated on the swarm before the projection, if any)
+_projections = OrderedDict([
+    ("projMaterialField", ("materialField", "_projMaterialField", None)),
+    ("projPlasticStrain", ("plasticStrain", "_projPlasticStrain", None)),
+    ("projTimeField", ("timeField", "_projTimeField", None)),
+    ("projMeltField", ("meltField", "_projMeltField", None)),
+    ("projViscosityField", ("_viscosityField", "_projViscosityField",
+                            "_viscosityFn")),
+    ("projDensityField", ("_densityField", "_projDensityField",
+                          "_densityFn")),
+    ("projStressTensor", ("_stressTensor", "_projStressTensor",
+                          "_stressFn")),
+    ("projStressField", ("_stressField", "_projStressField",
+                         "_stressInvariantFn"))])
+
+
+def _same_state(state, reference):
+    """ Compare two state snapshots (lists of objects) by identity """
+    if reference is None or len(state) != len(reference):
+        return False
+    return all([a is b for a, b in zip(state, reference)])
+
 
 class Model(Material):
     """UWGeodynamic Model Class"""
@@ -213,6 +251,10 @@ class Model(Material):
             self.top_wall = self.mesh.specialSets["MaxK_VertexSet"]
             self.bottom_wall = self.mesh.specialSets["MinK_VertexSet"]
 
+        # Asynchronous checkpoint writer (the lagged surface processes wait
+        # for it when they start)
+        self._checkpointWriter = None
+
         # Boundary Conditions
         self.velocityBCs = velocityBCs
         self.stressBCs = stressBCs
@@ -247,9 +289,25 @@ class Model(Material):
         self.DiffusivityFn = None
         self.HeatProdFn = None
         self._buoyancyFn = None
+        self._viscosityFnCache = None
+        self._rheologyState = None
+        self._stressFnCache = None
+        self._advdiffSystemCache = None
+        self._thermalState = None
+        self._stokesState = None
+        self._stokesConditions = None
         self._freeSurface = False
+        self._nonLinearIterations = 0
+        self._isostasySolves = 0
+        self._projectionVersion = 0
+        # Changes of the materials and of the swarm tracked by the surface
+        # processes (see SurfaceProcesses._full_pass)
+        self._materialsVersion = 0
+        self._advectedState = None
+        self._phaseChanges = (None, None, None)
         self.callback_post_solve = None
         self._mesh_saved = False
+        self.timings = Timings(_timed_phases)
         self._initialize()
 
     def _initialize(self):
@@ -257,6 +315,11 @@ class Model(Material):
         Model Initialisation
         """
 
+        # The projectors are bound to the swarm (new swarm on restart)
+        self._projectionStates = dict()
+        self._projectionSources = OrderedDict(_projections)
+        self._swarmProjectors = list()
+
         self.swarm_advector = uw.systems.SwarmAdvector(
             swarm=self.swarm,
             velocityField=self.velocityField,
@@ -377,6 +440,9 @@ class Model(Material):
         if not os.path.exists(restartDir):
             raise ValueError("restartDir must be a path to an existing folder")
 
+        # No Badlands run may be in flight while the model is reloaded
+        self.synchronize_surface_processes()
+
         # Do not raise and error idf directory is empty, just run
         # the model...
         if not os.listdir(restartDir):
@@ -436,7 +502,12 @@ class Model(Material):
             if field == "temperature":
                 continue
             obj = getattr(self, field)
-            path = os.path.join(restartDir, field + "-%s.h5" % step)
+            path = find_checkpoint_data(
+                restartDir, field, step,
+                swarm=field in rcParams["swarm.variables"])
+            if path is None:
+                raise ValueError("Cannot find {0} for step {1}".format(
+                    field, step))
             if uw.rank() == 0:
                 print("Reloading field {0} from {1}".format(field, path))
                 sys.stdout.flush()
@@ -446,8 +517,8 @@ class Model(Material):
                 sys.stdout.flush()
 
         # Temperature is a special case...
-        path = os.path.join(restartDir, "temperature" + "-%s.h5" % step)
-        if os.path.exists(path):
+        path = find_checkpoint_data(restartDir, "temperature", step)
+        if path is not None:
             if not self.temperature:
                 self.temperature = True
             obj = getattr(self, "temperature")
@@ -520,44 +591,119 @@ class Model(Material):
             XML = badlands_model.XML
             resolution = badlands_model.resolution
             checkpoint_interval = badlands_model.checkpoint_interval
+            badlands_model.close()
 
             self.surfaceProcesses = surfaceProcesses.Badlands(
                 airIndex, sedimentIndex,
                 XML, resolution,
                 checkpoint_interval,
                 restartFolder=restartFolder,
-                restartStep=restartStep)
+                restartStep=restartStep,
+                lagged=badlands_model.lagged,
+                driver=badlands_model.driver)
             if uw.rank() == 0:
                 print("Badlands restarted" + '(' + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ')')
                 sys.stdout.flush()
 
+        self._materialsVersion += 1
+        self.invalidate_projections()
         return
 
+    def invalidate_projections(self):
+        """ Force the projected fields (proj*) to be recomputed when they
+        are next accessed.
+
+        The projections are only updated when the swarm, the time step or
+        the non-linear iteration change. Call this method after modifying
+        the data of a swarm field directly.
+        """
+        self._projectionVersion += 1
+
+    def _projection_state(self):
+        return (self.swarm.stateId, self.step, self._nonLinearIterations,
+                self._projectionVersion)
+
+    def _get_swarm_projector(self, mesh, cls):
+        for projector in self._swarmProjectors:
+            if (projector.mesh is mesh and projector.swarm is self.swarm and
+                    isinstance(projector, cls)):
+                return projector
+        if cls is BatchedProjector:
+            projector = BatchedProjector(mesh, voronoi_swarm=self.swarm)
+        else:
+            projector = cls(mesh, self.swarm)
+        self._swarmProjectors.append(projector)
+        return projector
+
+    def _get_batched_projector(self, mesh):
+        return self._get_swarm_projector(mesh, BatchedProjector)
+
+    def _get_nearest_projector(self, mesh):
+        return self._get_swarm_projector(mesh, Nearest_neighbors_projector)
+
+    def _update_projections(self, names):
+        """ Update the projected fields (proj*) that are out of date
+
+        The projections sharing the same mesh are solved together
+        (see BatchedProjector). Each swarm field added with add_swarm_field
+        is registered as 'proj' + name (e.g. projPlasticStrain), the fields
+        added by users are updated with the others by checkpoint_fields
+        when their projection is listed in rcParams["mesh.variables"].
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        state = self._projection_state()
+        sources = self._projectionSources
+        stale = [name for name in sources if name in names and
+                 self._projectionStates.get(name) != state]
+        if not stale:
+            return
+
+        batches = OrderedDict()
+        for name in stale:
+            source, _, function = sources[name]
+            if function:
+                getattr(self, source).data[...] = getattr(
+                    self, function).evaluate(self.swarm)
+            projector = [obj for obj in self._swarmProjectors
+                         if name in obj][0]
+            batches.setdefault(projector, []).append(name)
+
+        for projector, batch in batches.items():
+            projector.solve(batch)
+
+        if "projMaterialField" in stale:
+            self._projMaterialField.data[:] = np.rint(
+                self._projMaterialField.data[:]
+            )
+
+        for name in stale:
+            self._projectionStates[name] = state
+
     @property
     def projMaterialField(self):
         """ Material field projected on the mesh """
-        self._materialFieldProjector.solve()
-        self._projMaterialField.data[:] = np.rint(
-            self._projMaterialField.data[:]
-        )
+        self._update_projections(["projMaterialField"])
         return self._projMaterialField
 
     @property
     def projPlasticStrain(self):
         """ Plastic Strain Field projected on the mesh """
-        self._plasticStrainProjector.solve()
+        self._update_projections(["projPlasticStrain"])
         return self._projPlasticStrain
 
     @property
     def projTimeField(self):
         """ Time Field projected on the mesh """
-        self._timeFieldProjector.solve()
+        self._update_projections(["projTimeField"])
         return self._projTimeField
 
     @property
     def projMeltField(self):
         """ Melt Field projected on the mesh """
-        self._meltFieldProjector.solve()
+        self._update_projections(["projMeltField"])
         return self._projMeltField
 
     @property
@@ -580,8 +726,7 @@ class Model(Material):
     @property
     def projViscosityField(self):
         """ Viscosity Field projected on the mesh """
-        self.viscosityField.data[...] = self._viscosityFn.evaluate(self.swarm)
-        self._viscosityFieldProjector.solve()
+        self._update_projections(["projViscosityField"])
         return self._projViscosityField
 
     @property
@@ -593,23 +738,23 @@ class Model(Material):
     @property
     def projStressTensor(self):
         """ Stress Tensor on mesh """
-        self._stressTensor.data[...] = self._stressFn.evaluate(self.swarm)
-        self._stressTensorProjector.solve()
+        self._update_projections(["projStressTensor"])
         return self._projStressTensor
 
+    @property
+    def _stressInvariantFn(self):
+        return fn.tensor.second_invariant(self._stressFn)
+
     @property
     def projStressField(self):
         """ Second Invariant of the Stress tensor projected on the submesh"""
-        stress = fn.tensor.second_invariant(self._stressFn)
-        self._stressField.data[...] = stress.evaluate(self.swarm)
-        self._stressFieldProjector.solve()
+        self._update_projections(["projStressField"])
         return self._projStressField
 
     @property
     def projDensityField(self):
         """ Density Field projected on the mesh """
-        self.densityField.data[...] = self._densityFn.evaluate(self.swarm)
-        self._densityFieldProjector.solve()
+        self._update_projections(["projDensityField"])
         return self._projDensityField
 
     @property
@@ -743,9 +888,58 @@ class Model(Material):
             raise ValueError("Set Boundary Conditions")
         return self.temperatureBCs.get_conditions()
 
+    def _thermal_state(self):
+        """ Snapshot of the objects the advection-diffusion system is
+        built from"""
+        state = [self._temperatureDot, self.velocityField,
+                 self.temperatureBCs, self.diffusivity,
+                 rcParams["advection.diffusion.method"],
+                 rcParams["shearHeating"]]
+        state += self._density_state()
+
+        # Material conditions follow the materials: rebuild once per step.
+        if self.temperatureBCs and self.temperatureBCs.materials:
+            state.append(self.step)
+
+        if rcParams["shearHeating"]:
+            state.append(self._viscosityFn)
+
+        for material in self.materials:
+            state += [material.diffusivity, material.capacity,
+                      material.radiogenicHeatProd]
+
+        return state
+
+    def invalidate_thermal(self):
+        """ Force a rebuild of the advection-diffusion system on next access
+
+        Changes to the materials thermal properties, the temperature field
+        and the thermal boundary conditions are detected automatically.
+        This is only needed when a density object is modified in place.
+        """
+        self._advdiffSystemCache = None
+        self._thermalState = None
+
     @property
     def _advdiffSystem(self):
-        """ Advection Diffusion System """
+        """ Advection Diffusion System
+
+        The system is kept alive between time steps and is only rebuilt
+        when one of its inputs has changed. The boundary values are written
+        into the temperature and heat flux fields at each access, as they
+        were when the system was rebuilt at each access.
+        """
+        state = self._thermal_state()
+        if (self._advdiffSystemCache is None or
+                not _same_state(state, self._thermalState)):
+            self._advdiffSystemCache = self._build_advdiffSystem()
+            self._thermalState = state
+        else:
+            self.temperatureBCs.apply_values()
+        return self._advdiffSystemCache
+
+    def _build_advdiffSystem(self):
+        """ Advection Diffusion System Builder """
 
         DiffusivityMap = {}
         for material in self.materials:
@@ -799,13 +993,63 @@ class Model(Material):
             )
         return obj
 
+    def _density_state(self):
+        """ Snapshot of the objects the density function is built from"""
+        state = [self.materialField, self.temperature, self.pressureField,
+                 self.meltField]
+        for material in self.materials:
+            state += [material, material.density, material.meltExpansion]
+        return state
+
+    def _stokes_state(self):
+        """ Snapshot of the objects the Stokes system is built from"""
+        state = [self.velocityField, self.pressureField, self.velocityBCs,
+                 self.stressBCs, self.gravity, self._viscosityFn,
+                 rcParams["solver"], rcParams["penalty"],
+                 rcParams["mg.levels"]]
+        state += self._density_state()
+        for material in self.materials:
+            state.append(material.compressibility)
+        return state
+
+    def _stokes_conditions_changed(self):
+        """ Check if the mechanical boundary index sets have changed
+
+        This is a collective call: the result is reduced over all the
+        processors.
+        """
+        indexSets = list(self.velocityBCs._dirichlet_indices)
+        if self.stressBCs:
+            indexSets += list(self.stressBCs._neumann_indices)
+
+        current = [np.copy(indexSet.data) if indexSet is not None else None
+                   for indexSet in indexSets]
+        previous = self._stokesConditions
+        self._stokesConditions = current
+
+        changed = previous is None or len(previous) != len(current)
+        if not changed:
+            for old, new in zip(previous, current):
+                if old is None and new is None:
+                    continue
+                if old is None or new is None or not np.array_equal(old, new):
+                    changed = True
+                    break
+
+        return MPI.COMM_WORLD.allreduce(changed, op=MPI.LOR)
+
     def get_stokes_solver(self):
-        """ Stokes solver """
+        """ Stokes solver
+
+        By default a new Stokes system and solver are created at each call.
+        If rcParams["solver.reuse"] is True, the system and its solver
+        (including the multigrid hierarchy and PETSc options) are kept
+        alive between solves. Boundary conditions values are refreshed at
+        each call, the system is only rebuilt when the boundary index
+        sets or the functions it is built from have changed.
+        """
 
         if not self._solver or not self._static_solver:
-            gravity = tuple([nd(val) for val in self.gravity])
-            self._buoyancyFn = self._densityFn * gravity
-            self._buoyancyFn = self._buoyancyFn
 
             if any([material.viscosity for material in self.materials]):
 
@@ -815,24 +1059,42 @@ class Model(Material):
                 if self.stressBCs:
                     conditions.append(self.stressBCs.get_conditions())
 
-                self._stokes_SLE = uw.systems.Stokes(
-                    velocityField=self.velocityField,
-                    pressureField=self.pressureField,
-                    conditions=conditions,
-                    fn_viscosity=self._viscosityFn,
-                    fn_bodyforce=self._buoyancyFn,
-                    fn_stresshistory=self._elastic_stressFn,
-                    fn_one_on_lambda=self._lambdaFn)
-                    #useEquationResidual=rcParams["useEquationResidual"])
+                # The index sets are only compared when the solver can be
+                # reused. Collective, must be called on all procs.
+                reuse = False
+                if rcParams["solver.reuse"]:
+                    conditions_changed = self._stokes_conditions_changed()
+                    state = self._stokes_state()
+                    reuse = (self._solver and not conditions_changed and
+                             _same_state(state, self._stokesState))
+                else:
+                    self._stokesConditions = None
+                    state = None
+
+                if not reuse:
+                    gravity = tuple([nd(val) for val in self.gravity])
+                    self._buoyancyFn = self._densityFn * gravity
+
+                    self._stokes_SLE = uw.systems.Stokes(
+                        velocityField=self.velocityField,
+                        pressureField=self.pressureField,
+                        conditions=conditions,
+                        fn_viscosity=self._viscosityFn,
+                        fn_bodyforce=self._buoyancyFn,
+                        fn_stresshistory=self._elastic_stressFn,
+                        fn_one_on_lambda=self._lambdaFn)
+                        #useEquationResidual=rcParams["useEquationResidual"])
+
+                    self._solver = uw.systems.Solver(self._stokes_SLE)
+                    self._solver.set_inner_method(rcParams["solver"])
 
-                self._solver = uw.systems.Solver(self._stokes_SLE)
-                self._solver.set_inner_method(rcParams["solver"])
+                    if rcParams["penalty"]:
+                        self._solver.set_penalty(rcParams["penalty"])
 
-                if rcParams["penalty"]:
-                    self._solver.set_penalty(rcParams["penalty"])
+                    if rcParams["mg.levels"]:
+                        self._solver.options.mg.levels = rcParams["mg.levels"]
 
-                if rcParams["mg.levels"]:
-                    self._solver.options.mg.levels = rcParams["mg.levels"]
+                    self._stokesState = state
 
             if self._solver._check_linearity(False):
                 if not hasattr(self, "prevVelocityField"):
@@ -979,11 +1241,14 @@ class Model(Material):
                 condition = [(mat.shape, mat.index), (True, self.materialField)]
             func = fn.branching.conditional(condition)
             self.materialField.data[:] = func.evaluate(self.swarm)
+            self._materialsVersion += 1
 
+        self.invalidate_projections()
         return mat
 
     def add_swarm_field(self, name, dataType="double", count=1,
-                        init_value=0., projected="mesh", **kwargs):
+                        init_value=0., projected="mesh",
+                        projection="average", **kwargs):
         """Add a new swarm field to the model
 
         Parameters
@@ -994,9 +1259,15 @@ class Model(Material):
         count : degree of freedom, default is 1
         init_value : default value of the field, default is to initialise
             the field to 0.
-        projected : the function creates a projector for each new
-            swarm variable, you can choose to project on the "mesh" or
-            "submesh"
+        projected : the new swarm variable is projected on the "mesh" or
+            on the "submesh" by the projector shared by all the swarm
+            fields projected on that mesh. The _<name>Projector attribute
+            projects the new field alone.
+        projection : "average" (default) for a weighted average projection
+            using Voronoi integration, or "nearest" to copy the value of the
+            closest particle to each node. The nearest neighbour projection
+            is much cheaper and is meant for fields only used for
+            visualisation.
 
         Returns
         -------
@@ -1004,6 +1275,9 @@ class Model(Material):
         Swarm Variable
         """
 
+        if projection not in ["average", "nearest"]:
+            raise ValueError("projection must be 'average' or 'nearest'")
+
         newField = self.swarm.add_variable(dataType, count, **kwargs)
         setattr(self, name, newField)
         newField.data[...] = init_value
@@ -1029,11 +1303,20 @@ class Model(Material):
             projector_name = name + "Projector"
         else:
             projector_name = "_" + name + "Projector"
-        projector = uw.utils.MeshVariable_Projection(projected,
-                                                     newField,
-                                                     voronoi_swarm=self.swarm,
-                                                     type=0)
-        setattr(self, projector_name, projector)
+        if projection == "nearest":
+            # The nearest neighbour map is shared by all the fields
+            # projected on the same mesh
+            projector = self._get_nearest_projector(projected.mesh)
+        else:
+            # Register the field with the projector shared by all the
+            # fields projected on the same mesh
+            projector = self._get_batched_projector(projected.mesh)
+        projector.add(proj_name[1:], projected, newField)
+        setattr(self, projector_name, projector.view(proj_name[1:]))
+
+        # The projection is versioned with the others (_update_projections)
+        self._projectionSources.setdefault(proj_name[1:],
+                                           (name, proj_name, None))
 
         return newField
 
@@ -1133,8 +1416,66 @@ class Model(Material):
 
         return self.frictionalBCs
 
+    def _rheology_state(self):
+        """ Snapshot of the objects the viscosity function is built from
+
+        The snapshot holds references (compared by identity) to the model
+        fields, the model and material limiters, the materials, their
+        rheology handlers and the frictional boundaries. Attributes of the
+        handlers which are underworld functions are wired by the Model itself
+        and are ignored.
+        """
+        state = [self.materialField, self.pressureField, self.velocityField,
+                 self.plasticStrain, self.meltField,
+                 self._previousStressField, self.temperature,
+                 self.frictionalBCs, self._solution_exist.value,
+                 self.minViscosity, self.maxViscosity, self.stressLimiter]
+
+        for material in self.materials:
+            state += [material, material.viscosity, material.plasticity,
+                      material.elasticity, material.melt,
+                      material.minViscosity, material.maxViscosity,
+                      material.stressLimiter, material.viscosityChange,
+                      material.viscosityChangeX1, material.viscosityChangeX2]
+            for handler in (material.viscosity, material.plasticity,
+                            material.elasticity):
+                attributes = getattr(handler, "__dict__", {})
+                for key in sorted(attributes.keys()):
+                    value = attributes[key]
+                    if value is None or isinstance(value, fn.Function):
+                        continue
+                    state += [key, value]
+
+        return state
+
+    @property
+    def rheology_dirty(self):
+        """ True if the viscosity function needs to be rebuilt """
+        if self._viscosityFnCache is None:
+            return True
+
+        return not _same_state(self._rheology_state(), self._rheologyState)
+
+    def invalidate_rheology(self):
+        """ Force a rebuild of the viscosity function on next access
+
+        Changes to the materials, rheologies, limiters and frictional
+        boundaries are detected automatically. This is only needed when
+        an object nested inside a rheology (e.g. a law of a
+        CompositeViscosity) has been modified in place.
+        """
+        self._viscosityFnCache = None
+        self._rheologyState = None
+
     @property
     def _viscosityFn(self):
+        """ Viscosity Function (cached)"""
+        if self.rheology_dirty:
+            self._viscosityFnCache = self._build_viscosityFn()
+            self._rheologyState = self._rheology_state()
+        return self._viscosityFnCache
+
+    def _build_viscosityFn(self):
         """ Viscosity Function Builder"""
 
         ViscosityMap = {}
@@ -1314,16 +1655,19 @@ class Model(Material):
 
     @property
     def _stressFn(self):
-        """Stress Function Builder"""
-        stressMap = {}
-        for material in self.materials:
-            # Calculate viscous stress
-            viscousStressFn = self._viscous_stressFn()
-            elasticStressFn = self._elastic_stressFn
-            stressMap[material.index] = viscousStressFn + elasticStressFn
+        """Stress Function Builder
 
-        return fn.branching.map(fn_key=self.materialField,
-                                mapping=stressMap)
+        The stress is the same function for all the materials (the
+        viscosity and elastic stress functions already depend on the
+        material), it is cached until the viscosity function is rebuilt.
+        """
+        viscosityFn = self._viscosityFn
+        if self._stressFnCache and self._stressFnCache[0] is viscosityFn:
+            return self._stressFnCache[1]
+
+        stressFn = self._viscous_stressFn() + self._elastic_stressFn
+        self._stressFnCache = (viscosityFn, stressFn)
+        return stressFn
 
     def _viscous_stressFn(self):
         """Viscous Stress Function Builder"""
@@ -1372,14 +1716,53 @@ class Model(Material):
         return 2.0 * self._viscosityFn * fn.misc.max(eij, eijdef)
 
     def _phaseChangeFn(self):
-        for material in self.materials:
-            if material.phase_changes:
-                for change in material.phase_changes:
-                    obj = change
-                    mask = obj.fn().evaluate(self.swarm)
-                    conds = ((mask == 1) &
-                             (self.materialField.data == material.index))
-                    self.materialField.data[conds] = obj.result
+        """ Apply the phase changes of the materials
+
+        The conditions of all the phase changes are evaluated in a single
+        pass over the swarm. Only the particles of the materials with phase
+        changes evaluate them. The changes are then applied in order (by
+        material, then by phase change), as a particle changed by a
+        material can be changed again by the phase changes of its new
+        material.
+        """
+        changes = [(material.index, change) for material in self.materials
+                   for change in material.phase_changes]
+        if not changes:
+            return
+
+        # The conditions function is bound to the material field (and the
+        # swarm it is evaluated on) and to the phase changes and their
+        # conditions.
+        indices = [index for index, _ in changes]
+        state = [self.materialField, self.swarm]
+        for _, change in changes:
+            state += [change, change.condition]
+        if (indices != self._phaseChanges[0] or
+                not _same_state(state, self._phaseChanges[1])):
+            conditions = [change.fn() for _, change in changes]
+            if len(conditions) > 1:
+                conditions, default = tuple(conditions), (0,) * len(changes)
+            else:
+                conditions, default = conditions[0], 0
+            mapping = dict([(index, conditions) for index, _ in changes])
+            conditionsFn = fn.branching.map(fn_key=self.materialField,
+                                            mapping=mapping,
+                                            fn_default=default)
+            self._phaseChanges = (indices, state, conditionsFn)
+        conditionsFn = self._phaseChanges[2]
+
+        material = self.materialField.data
+        changed = False
+        if np.any(np.isin(material, indices)):
+            mask = conditionsFn.evaluate(self.swarm)
+            for column, (index, change) in enumerate(changes):
+                conds = (mask[:, column] == 1) & (material[:, 0] == index)
+                material[conds] = change.result
+                changed = changed or bool(np.any(conds))
+
+        # The surface processes must check all the particles again
+        if MPI.COMM_WORLD.allreduce(changed, op=MPI.LOR):
+            self._materialsVersion += 1
 
     def solve_temperature_steady_state(self):
         """ Solve for steady state temperature
@@ -1512,6 +1895,9 @@ class Model(Material):
             minIterations = rcParams["nonlinear.min.iterations"]
             maxIterations = rcParams["nonlinear.max.iterations"]
 
+        self._nonLinearIterations = 0
+        self._isostasySolves = 0
+        self.invalidate_projections()
         self.get_stokes_solver().solve(
             nonLinearIterate=True,
             nonLinearMinIterations=minIterations,
@@ -1582,7 +1968,10 @@ class Model(Material):
                 self.restart(step=restartStep, restartDir=restartDir)
             uw.barrier()
 
-        if ((checkpoint_interval or checkpoint_times) and
+        timings_output = rcParams["timings.output"]
+        self.timings.new_output()
+
+        if ((checkpoint_interval or checkpoint_times or timings_output) and
             uw.rank() == 0 and not os.path.exists(self.outputDir)):
             os.makedirs(self.outputDir)
         uw.barrier()
@@ -1624,19 +2013,22 @@ class Model(Material):
 
             self.preSolveHook()
 
-            self.solve()
+            with self.timings.record("Stokes solve"):
+                self.solve()
 
             # Whats the longest we can run before reaching the end
             # of the model or a checkpoint?
             # Need to generalize that
-            self._dt = 2.0 * rcParams["CFL"] * self.swarm_advector.get_max_dt()
+            with self.timings.record("Timestep"):
+                self._dt = (2.0 * rcParams["CFL"] *
+                            self.swarm_advector.get_max_dt())
 
-            if self.temperature:
-                # Only get a condition if using SUPG
-                if rcParams["advection.diffusion.method"] == "SUPG":
-                    supg_dt = self._advdiffSystem.get_max_dt()
-                    supg_dt *= 2.0 * rcParams["CFL"]
-                    self._dt = min(self._dt, supg_dt)
+                if self.temperature:
+                    # Only get a condition if using SUPG
+                    if rcParams["advection.diffusion.method"] == "SUPG":
+                        supg_dt = self._advdiffSystem.get_max_dt()
+                        supg_dt *= 2.0 * rcParams["CFL"]
+                        self._dt = min(self._dt, supg_dt)
 
             if (isinstance(checkpoint_interval, u.Quantity) and
                checkpoint_interval.dimensionality == _dim_time):
@@ -1678,19 +2070,33 @@ class Model(Material):
                time == next_checkpoint) or stepDone == next_checkpoint):
                     self.checkpointID += 1
                     # Save Mesh Variables
-                    self.checkpoint_fields(checkpointID=self.checkpointID)
+                    with self.timings.record("Checkpoint fields"):
+                        self.checkpoint_fields(checkpointID=self.checkpointID)
                     # Save Tracers
-                    self.checkpoint_tracers(checkpointID=self.checkpointID)
+                    with self.timings.record("Checkpoint tracers"):
+                        self.checkpoint_tracers(checkpointID=self.checkpointID)
                     next_checkpoint += nd(checkpoint_interval)
 
             uw.barrier()
 
             # if it's time to checkpoint the swarm, do so.
             if self.checkpointID % restart_checkpoint == 0:
-                self.checkpoint_swarms(checkpointID=self.checkpointID)
+                with self.timings.record("Checkpoint swarms"):
+                    self.checkpoint_swarms(checkpointID=self.checkpointID)
 
             uw.barrier()
 
+            self.timings.end_step(
+                step=self.step,
+                time=self.time.to(units),
+                dt=Dimensionalize(self._dt, units),
+                nonLinearIterations=self._nonLinearIterations,
+                isostasySolves=self._isostasySolves)
+
+            if timings_output == "csv":
+                self.timings.write_csv(
+                    os.path.join(self.outputDir, "timings.csv"))
+
             if checkpoint_interval or self.step % 1 == 0 or nstep:
                 if uw.rank() == 0:
                     print("Step:" + str(stepDone) + " Model Time: ", str(self.time.to(units)),
@@ -1700,6 +2106,13 @@ class Model(Material):
 
             self.postSolveHook()
 
+        self.synchronize_surface_processes()
+        self.wait_for_checkpoints()
+
+        if timings_output == "json":
+            self.timings.write_json(
+                os.path.join(self.outputDir, "timings.json"))
+
         return 1
 
     @staticmethod
@@ -1721,6 +2134,7 @@ class Model(Material):
     @callback_post_solve.setter
     def callback_post_solve(self, value):
         def callback():
+            self._nonLinearIterations += 1
             if callable(value):
                 value()
             if rcParams["surface.pressure.normalization"]:
@@ -1728,7 +2142,7 @@ class Model(Material):
             if rcParams["pressure.smoothing"]:
                 self.pressSmoother.smooth()
             if self._isostasy:
-                self._isostasy.solve()
+                self._solve_isostasy()
             for material in self.materials:
                 if material.viscosity:
                     material.viscosity.firstIter.value = False
@@ -1736,6 +2150,32 @@ class Model(Material):
             self._solution_exist.value = True
         self._callback_post_solve = callback
 
+    def _solve_isostasy(self):
+        """ Update the isostatic basal velocities following the
+        isostasy.update policy:
+
+        - iteration: after every non-linear iteration
+        - step: after the first non-linear iteration of each solve only
+        - tolerance: after every iteration until the relative change of the
+          basal velocities drops below isostasy.update.tolerance, then
+          for the first iteration of the next solve.
+
+        The number of updates is reported with the step timings and their
+        time under the "Isostasy" phase (included in "Stokes solve").
+        """
+        policy = rcParams["isostasy.update"]
+        if self._isostasySolves:
+            if policy == "step":
+                return
+            if (policy == "tolerance" and
+                    self._isostasy.basal_velocity_change <
+                    rcParams["isostasy.update.tolerance"]):
+                return
+
+        with self.timings.record("Isostasy"):
+            self._isostasy.solve()
+        self._isostasySolves += 1
+
     def _update(self):
         """ Update Function
 
@@ -1746,65 +2186,82 @@ class Model(Material):
         """
 
         dt = self._dt
-
-        # Heal plastic strain
-        if any([material.healingRate for material in self.materials]):
-            healingRates = {}
-            for material in self.materials:
-                healingRates[material.index] = nd(material.healingRate)
-            HealingRateFn = fn.branching.map(fn_key=self.materialField,
-                                             mapping=healingRates)
-
-            plasticStrainIncHealing = dt * HealingRateFn.evaluate(self.swarm)
-            self.plasticStrain.data[:] -= plasticStrainIncHealing
-            self.plasticStrain.data[self.plasticStrain.data < 0.] = 0.
-
-        # Increment plastic strain
-        plasticStrainIncrement = dt * self._isYielding.evaluate(self.swarm)
-        self.plasticStrain.data[:] += plasticStrainIncrement
+        timings = self.timings
+
+        with timings.record("Plastic strain"):
+            # Heal plastic strain
+            if any([material.healingRate for material in self.materials]):
+                healingRates = {}
+                for material in self.materials:
+                    healingRates[material.index] = nd(material.healingRate)
+                HealingRateFn = fn.branching.map(fn_key=self.materialField,
+                                                 mapping=healingRates)
+
+                plasticStrainIncHealing = (
+                    dt * HealingRateFn.evaluate(self.swarm))
+                self.plasticStrain.data[:] -= plasticStrainIncHealing
+                self.plasticStrain.data[self.plasticStrain.data < 0.] = 0.
+
+            # Increment plastic strain
+            plasticStrainIncrement = dt * self._isYielding.evaluate(self.swarm)
+            self.plasticStrain.data[:] += plasticStrainIncrement
 
         if any([material.melt for material in self.materials]):
             # Calculate New meltField
-            self.update_melt_fraction()
+            with timings.record("Melt"):
+                self.update_melt_fraction()
 
         # Solve for temperature
         if self.temperature:
-            self._advdiffSystem.integrate(dt)
-
-        if self._advector:
-            self.swarm_advector.integrate(dt)
-            self._advector.advect_mesh(dt)
-        elif self._freeSurface:
-            self.swarm_advector.integrate(dt, update_owners=False)
-            self._freeSurface.solve(dt)
-            self.swarm.update_particle_owners()
-        else:
-            # Integrate Swarms in time
-            self.swarm_advector.integrate(dt, update_owners=True)
+            with timings.record("Temperature"):
+                self._advdiffSystem.integrate(dt)
+
+        with timings.record("Swarm advection"):
+            if self._advector:
+                self.swarm_advector.integrate(dt)
+                self._advector.advect_mesh(dt)
+            elif self._freeSurface:
+                self.swarm_advector.integrate(dt, update_owners=False)
+                self._freeSurface.solve(dt)
+                self.swarm.update_particle_owners()
+            else:
+                # Integrate Swarms in time
+                self.swarm_advector.integrate(dt, update_owners=True)
 
         # Update stress
         if any([material.elasticity for material in self.materials]):
-            self._update_stress_history(dt)
+            with timings.record("Stress history"):
+                self._update_stress_history(dt)
 
         if self.passive_tracers:
-            for key in self.passive_tracers:
-                self.passive_tracers[key].integrate(dt)
+            with timings.record("Passive tracers"):
+                for key in self.passive_tracers:
+                    self.passive_tracers[key].integrate(dt)
 
         # Do pop control
-        self.population_control.repopulate()
-        self.swarm.update_particle_owners()
+        with timings.record("Population control"):
+            self.population_control.repopulate()
+            self.swarm.update_particle_owners()
+
+        # The swarm has only been advected over dt (population control
+        # clones particles within their cell)
+        self._advectedState = self.swarm.stateId
 
         if self.surfaceProcesses:
-            self.surfaceProcesses.solve(dt)
+            with timings.record("Surface processes"):
+                self.surfaceProcesses.solve(dt)
 
         # Update Time Field
         self.timeField.data[...] += dt
 
-
         if self._visugrid:
-            self._visugrid.advect(dt)
+            with timings.record("Visugrid"):
+                self._visugrid.advect(dt)
+
+        with timings.record("Phase changes"):
+            self._phaseChangeFn()
 
-        self._phaseChangeFn()
+        self.invalidate_projections()
 
     def mesh_advector(self, axis):
         """ Initialize the mesh advector
@@ -1994,6 +2451,9 @@ class Model(Material):
 
         """
 
+        # The saved materials must include the last surface update
+        self.synchronize_surface_processes()
+
         if not fields:
             fields = rcParams["default.outputs"]
 
@@ -2008,17 +2468,21 @@ class Model(Material):
         uw.barrier()
 
         time = time if time else self.time
+        writer = self._get_checkpoint_writer()
+        single_file = rcParams["checkpoint.single.file"]
 
         if self._advector or self._freeSurface:
             mesh_name = 'mesh-%s' % checkpointID
             mesh_prefix = os.path.join(outputDir, mesh_name)
-            mH = self.mesh.save('%s.h5' % mesh_prefix, units=u.kilometers,
-                                time=time)
+            mH = save_mesh(writer, self.mesh, '%s.h5' % mesh_prefix,
+                           units=u.kilometers, time=time,
+                           dataset_options=dataset_options("mesh"))
         elif not self._mesh_saved:
             mesh_name = 'mesh'
             mesh_prefix = os.path.join(outputDir, mesh_name)
-            mH = self.mesh.save('%s.h5' % mesh_prefix, units=u.kilometers,
-                                time=time)
+            mH = save_mesh(writer, self.mesh, '%s.h5' % mesh_prefix,
+                           units=u.kilometers, time=time,
+                           dataset_options=dataset_options("mesh"))
             self._mesh_saved = True
         else:
             mesh_name = 'mesh'
@@ -2028,10 +2492,11 @@ class Model(Material):
         filename = "XDMF.fields." + str(checkpointID).zfill(5) + ".xmf"
         filename = os.path.join(outputDir, filename)
 
-        # First write the XDMF header
-        string = uw.utils._xdmfheader()
-        string += uw.utils._spacetimeschema(mH, mesh_name, time)
+        # Solve the out of date projections together
+        self._update_projections(fields)
 
+        handles = []
+        variables = []
         for field in fields:
             if field == "temperature" and not self.temperature:
                 continue
@@ -2042,22 +2507,64 @@ class Model(Material):
                 except KeyError:
                     units = None
 
-                # Save the h5 file and write the field schema for
-                # each one of the field variables
-                obj = getattr(self, field)
-                file_prefix = os.path.join(outputDir, field + '-%s' % checkpointID)
-                handle = obj.save('%s.h5' % file_prefix, units=units,
-                                  time=time)
-                string += uw.utils._fieldschema(handle, field)
-
-        # Write the footer to the xmf
-        string += uw.utils._xdmffooter()
+                if field in self._projectionSources:
+                    # Updated above
+                    obj = getattr(self, self._projectionSources[field][1])
+                else:
+                    obj = getattr(self, field)
+                options = dataset_options(field)
+                if single_file:
+                    # Saved together below
+                    variables.append((obj, field, units, options))
+                    continue
+
+                # Save the h5 file for each one of the field variables
+                file_prefix = os.path.join(outputDir,
+                                           field + '-%s' % checkpointID)
+                handle = save_mesh_variable(writer, obj,
+                                            '%s.h5' % file_prefix,
+                                            units=units, time=time,
+                                            dataset_options=options)
+                handles.append((handle, field, None, options))
+
+        if variables:
+            # Save the field variables to the groups of a single file,
+            # opened once
+            file_prefix = os.path.join(outputDir, 'fields-%s' % checkpointID)
+            saved = save_mesh_variables(writer, variables,
+                                        '%s.h5' % file_prefix, time=time)
+            for handle, (_, field, _, options) in zip(saved, variables):
+                handles.append((handle, field, field, options))
+
+        def write_xdmf():
+            # First write the XDMF header
+            string = uw.utils._xdmfheader()
+            string += uw.utils._spacetimeschema(mH, mesh_name, time)
+
+            # Write the field schema for each one of the field variables
+            for handle, field, group, options in handles:
+                schema = uw.utils._fieldschema(handle, field)
+                if group:
+                    schema = grouped_schema(schema, group)
+                if options.get("float32"):
+                    schema = downcast_schema(schema)
+                string += schema
+
+            # Write the footer to the xmf
+            string += uw.utils._xdmffooter()
+
+            # Write the string to file - only proc 0
+            if uw.rank() == 0:
+                with open(filename, "w") as xdmfFH:
+                    xdmfFH.write(string)
+            uw.barrier()
 
-        # Write the string to file - only proc 0
-        if uw.rank() == 0:
-            with open(filename, "w") as xdmfFH:
-                xdmfFH.write(string)
-        uw.barrier()
+        if writer:
+            # The XDMF file is written once the h5 files are on disk
+            writer.when_done(write_xdmf)
+            writer.finalize()
+        else:
+            write_xdmf()
 
     def checkpoint_swarms(self, fields=None, checkpointID=None, time=None,
                           outputDir=None):
@@ -2073,6 +2580,8 @@ class Model(Material):
 
         """
 
+        self.synchronize_surface_processes()
+
         if not fields:
             fields = rcParams["restart.fields"]
 
@@ -2087,20 +2596,20 @@ class Model(Material):
         uw.barrier()
 
         time = time if time else self.time
+        writer = self._get_checkpoint_writer()
+        single_file = rcParams["checkpoint.single.file"]
         swarm_name = 'swarm-%s.h5' % checkpointID
 
-        sH = self.swarm.save(os.path.join(outputDir,
-                             swarm_name),
-                             units=u.kilometers,
-                             time=time)
+        sH = save_swarm(writer, self.swarm,
+                        os.path.join(outputDir, swarm_name),
+                        units=u.kilometers, time=time,
+                        dataset_options=dataset_options("swarm"))
 
         filename = "XDMF.swarms." + str(checkpointID).zfill(5) + ".xmf"
         filename = os.path.join(outputDir, filename)
 
-        # First write the XDMF header
-        string = uw.utils._xdmfheader()
-        string += uw.utils._swarmspacetimeschema(sH, swarm_name, time)
-
+        handles = []
+        variables = []
         for field in fields:
             if field in rcParams["swarm.variables"]:
                 field = str(field)
@@ -2109,20 +2618,90 @@ class Model(Material):
                 except KeyError:
                     units = None
 
-                # Save the h5 file and write the field schema for
-                # each one of the field variables
                 obj = getattr(self, field)
-                file_prefix = os.path.join(outputDir, field + '-%s' % checkpointID)
-                handle = obj.save('%s.h5' % file_prefix, units=units, time=time)
-                string += uw.utils._swarmvarschema(handle, field)
+                options = dataset_options(field)
+                if single_file:
+                    # Saved together below
+                    variables.append((obj, field, units, options))
+                    continue
+
+                # Save the h5 file for each one of the field variables.
+                file_prefix = os.path.join(outputDir,
+                                           field + '-%s' % checkpointID)
+                handle = save_swarm_variable(writer, obj,
+                                             '%s.h5' % file_prefix,
+                                             units=units, time=time,
+                                             dataset_options=options)
+                handles.append((handle, field, None, options))
+
+        if variables:
+            # In the single file layout, the variables are stored alongside
+            # the swarm coordinates, the file is opened once
+            saved = save_swarm_variables(writer, variables,
+                                         os.path.join(outputDir, swarm_name),
+                                         time=time)
+            for handle, (_, field, _, options) in zip(saved, variables):
+                handles.append((handle, field, field, options))
+
+        def write_xdmf():
+            # First write the XDMF header
+            string = uw.utils._xdmfheader()
+            string += uw.utils._swarmspacetimeschema(sH, swarm_name, time)
+
+            # Write the schema for each one of the swarm variables
+            for handle, field, group, options in handles:
+                schema = uw.utils._swarmvarschema(handle, field)
+                if group:
+                    schema = grouped_schema(schema, group)
+                if options.get("float32"):
+                    schema = downcast_schema(schema)
+                string += schema
+
+            # Write the footer to the xmf
+            string += uw.utils._xdmffooter()
+
+            # Write the string to file - only proc 0
+            if uw.rank() == 0:
+                with open(filename, "w") as xdmfFH:
+                    xdmfFH.write(string)
+            uw.barrier()
+
+        if writer:
+            # The XDMF file is written once the h5 files are on disk
+            writer.when_done(write_xdmf)
+            writer.finalize()
+        else:
+            write_xdmf()
+
+    def _get_checkpoint_writer(self):
+        """ Return the asynchronous checkpoint writer if enabled """
+        if not rcParams["checkpoint.async"]:
+            return None
+        if not self._checkpointWriter:
+            budget = rcParams["checkpoint.async.buffer"] * 1024**2
+            self._checkpointWriter = CheckpointWriter(budget)
+        return self._checkpointWriter
+
+    def synchronize_surface_processes(self):
+        """ Wait for the surface processes running in the background
+        (lagged Badlands coupling) and apply their surface
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        if hasattr(self.surfaceProcesses, "synchronize"):
+            self.surfaceProcesses.synchronize()
 
-        # Write the footer to the xmf
-        string += uw.utils._xdmffooter()
+    def wait_for_checkpoints(self):
+        """ Wait for the asynchronous checkpoints to be written to disk
 
-        # Write the string to file - only proc 0
-        if uw.rank() == 0:
-            with open(filename, "w") as xdmfFH:
-                xdmfFH.write(string)
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        if self._checkpointWriter:
+            self._checkpointWriter.finalize(block=True)
         uw.barrier()
 
     @u.check([None, None, None, "[time]", None])
@@ -42,6 +42,15 @@ rcParams = {
                          "pressureField",
                          "plasticStrain",
                          "velocityField"], validate_stringlist],
+    "checkpoint.single.file": [False, validate_bool],
+    "checkpoint.compression": [None, validate_compression],
+    "checkpoint.compression.level": [4, validate_int],
+    "checkpoint.shuffle": [True, validate_bool],
+    "checkpoint.chunk.size": [None, validate_int_or_none],
+    "checkpoint.uncompressed.fields": [[], validate_stringlist],
+    "checkpoint.float32.fields": [[], validate_stringlist],
+    "checkpoint.async": [False, validate_bool],
+    "checkpoint.async.buffer": [1024.0, validate_float],
 
     "gravity": [9.81 * u.meter / u.second**2, validate_quantity],
     "swarm.particles.per.cell.2D": [40, validate_int],
@@ -67,6 +76,7 @@ rcParams = {
     "nonlinear.tolerance.adjust.factor": [2, validate_int],
     "nonlinear.tolerance.adjust.nsteps": [100, validate_int],
     "mg.levels": [None, validate_int_or_none],
+    "solver.reuse": [False, validate_bool],
 
     "rheology.default.uppercrust": ["Patterson et al., 1990", validate_viscosity],
     "rheology.default.midcrust": ["Patterson et al., 1990", validate_viscosity],
@@ -93,10 +103,14 @@ rcParams = {
     "projDensityField.SIunits" : [u.kilogram / u.metre**3, validate_quantity],
     "projTimeField.SIunits" : [u.megayears, validate_quantity],
 
+    "timings.output": [None, validate_timings_output],
+
     "useEquationResidual" : [False, validate_bool],
     "shearHeating": [False, validate_bool],
     "surface.pressure.normalization": [True, validate_bool],
     "pressure.smoothing": [True, validate_bool],
+    "isostasy.update": ["iteration", validate_isostasy_update],
+    "isostasy.update.tolerance": [1e-3, validate_float],
     "advection.diffusion.method": ["SUPG", validate_string]
     }
 
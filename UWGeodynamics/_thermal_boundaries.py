@@ -61,25 +61,31 @@ class TemperatureBCs(BoundaryConditions):
         rho = material.density.reference_density
         return heat_flow / (rho * cp)
 
-    def get_conditions(self):
+    def apply_values(self):
+        """ Write the boundary values into the Model fields
 
-        Model = self.Model
-        # Reinitialise neumnann and dirichlet condition
-        self.dirichlet_indices = []
-        self.neumann_indices = []
+        The fixed temperatures are written into Model.temperature and the
+        heat flows into Model._heatFlux. This must be done before each
+        thermal solve: the conditions only hold the index sets, the
+        values are overwritten by the solver, the mesh advection or the
+        user.
 
-        self.dirichlet_indices.append(Model.mesh.specialSets["Empty"])
-        self.neumann_indices.append(Model.mesh.specialSets["Empty"])
+        Returns the lists of Dirichlet and Neumann index sets.
+        """
+
+        Model = self.Model
+        dirichlet_indices = [Model.mesh.specialSets["Empty"]]
+        neumann_indices = [Model.mesh.specialSets["Empty"]]
 
         for wall in self.order_wall_conditions:
             condition, indexSet = self._wall_indexSets[wall]
             if condition:
                 if condition.dimensionality == _dim_temp:
                     Model.temperature.data[indexSet.data] = nd(condition)
-                    self.dirichlet_indices[0] += indexSet
+                    dirichlet_indices[0] += indexSet
                 elif condition.dimensionality == _dim_heat_flux:
                     material = self._material_boundaries[wall]
-                    self.neumann_indices[0] += indexSet
+                    neumann_indices[0] += indexSet
                     heat_flow = self._get_heat_flux(condition, material)
                     Model._heatFlux.data[indexSet.data] = nd(heat_flow)
 
@@ -94,14 +100,22 @@ class TemperatureBCs(BoundaryConditions):
                         size=self.Model.mesh.nodesGlobal,
                         fromObject=local_indices)
                     Model.temperature.data[local_indices] = nd(temp)
-                    self.dirichlet_indices[0] += indexSet
+                    dirichlet_indices[0] += indexSet
 
         if self.materials:
             for (material, temp) in self.materials:
                 if material and nd(temp):
                     indexSet = Model._get_material_indices(material)
                     Model.temperature.data[indexSet.data] = nd(temp)
-                    self.dirichlet_indices[0] += indexSet
+                    dirichlet_indices[0] += indexSet
+
+        return dirichlet_indices, neumann_indices
+
+    def get_conditions(self):
+
+        Model = self.Model
+        # Reinitialise neumnann and dirichlet condition
+        self.dirichlet_indices, self.neumann_indices = self.apply_values()
 
         conditions = []
 
@@ -5,8 +5,14 @@ import underworld.function as fn
 import shapefile
 import h5py
 import os
+import json
+import csv
+import time
 import operator as op
+from collections import OrderedDict
+from contextlib import contextmanager
 from .scaling import nonDimensionalize as nd
+from .scaling import nonDimensionalize_array as nd_array
 from .scaling import Dimensionalize
 from .scaling import UnitRegistry as u
 from .Underworld_extended import Swarm
@@ -60,8 +66,7 @@ class PassiveTracers(object):
         self.name = name
         self.particleEscape = particleEscape
 
-        for dim, _ in enumerate(vertices):
-            vertices[dim] = nd(vertices[dim])
+        vertices = [nd_array(vertex) for vertex in vertices]
 
         sizes = np.array([np.array(x).size for x in vertices])
         points = np.zeros((sizes.max(), len(vertices)))
@@ -220,11 +225,8 @@ class PassiveTracersGrid(object):
 
         self._sets = list()
 
-        for dim in range(len(vertices)):
-            vertices[dim] = nd(vertices[dim])
-
-        for dim in range(len(centroids)):
-            centroids[dim] = nd(centroids[dim])
+        vertices = [nd_array(vertex) for vertex in vertices]
+        centroids = [nd_array(centroid) for centroid in centroids]
 
         if mesh.dim == 2:
             for index, (x, y) in enumerate(zip(centroids[0], centroids[1])):
@@ -315,7 +317,7 @@ class Balanced_InflowOutflow(object):
         top = nd(self.top)
         pt1 = nd(self.pt1)
         pt2 = nd(self.pt2)
-        y = nd(self.ynodes)
+        y = nd_array(self.ynodes)
         tol = self.tol
         nitmin = self.nitmin
         default_vel = nd(self.default_vel)
@@ -442,6 +444,9 @@ class MoveImporter(object):
 
 def circles_grid(radius, minCoord, maxCoord, npoints=72):
 
+    minCoord = nd_array(minCoord)
+    maxCoord = nd_array(maxCoord)
+
     if len(minCoord) == 2:
         # Create points on circle
         angles = np.linspace(0, 360, npoints)
@@ -450,8 +455,9 @@ def circles_grid(radius, minCoord, maxCoord, npoints=72):
         y = radius * np.sin(np.radians(angles))
 
         # Calculate centroids
-        xc = np.arange(nd(minCoord[0]), nd(maxCoord[0]) + radius, 2. * radius)
-        yc = np.arange(nd(minCoord[1]) + radius, nd(maxCoord[1]), 2. * radius * np.sqrt(3) / 2.)
+        xc = np.arange(minCoord[0], maxCoord[0] + radius, 2. * radius)
+        yc = np.arange(minCoord[1] + radius, maxCoord[1],
+                       2. * radius * np.sqrt(3) / 2.)
         xc, yc = np.meshgrid(xc, yc)
         # Shift every other row by radius
         xc[::2, :] = xc[::2, :] + radius
@@ -480,9 +486,11 @@ def circles_grid(radius, minCoord, maxCoord, npoints=72):
         z = radius * np.cos(np.radians(theta.ravel()))
 
         # Calculate centroids
-        xc = np.arange(nd(minCoord[0]) + radius, nd(maxCoord[0]) + radius, 2. * radius)
-        yc = np.arange(nd(minCoord[1]) + radius, nd(maxCoord[1]) + radius, 2. * radius * np.sqrt(3)/2.)
-        zc = np.arange(nd(minCoord[2]) + radius, nd(maxCoord[2]) + radius, 2. * radius * np.sqrt(3)/2.)
+        xc = np.arange(minCoord[0] + radius, maxCoord[0] + radius, 2. * radius)
+        yc = np.arange(minCoord[1] + radius, maxCoord[1] + radius,
+                       2. * radius * np.sqrt(3) / 2.)
+        zc = np.arange(minCoord[2] + radius, maxCoord[2] + radius,
+                       2. * radius * np.sqrt(3) / 2.)
         xc, yc, zc = np.meshgrid(xc, yc, zc)
         # Shift every other row by radius
         yc[:, ::2, :] += radius
@@ -530,19 +538,269 @@ def sphere_points_tracers(radius, centre=tuple([0., 0., 0.]), npoints=30):
     return x, y, z
 
 
+class BatchedProjector(object):
+    """ Weighted average projection of several functions on a mesh
+
+    The functions registered on the same mesh are stacked into a single
+    vector function and projected with one MeshVariable_Projection
+    (type 0), so that the Voronoi integration weights and the lumped mass
+    matrix are computed once per solve for all the functions, and the
+    right hand sides assembled in one pass over the integration swarm.
+    The stacked projectors are kept between solves. Nodes where the
+    projection is undefined (no integration point nearby) keep their
+    previous value.
+
+    Example
+    -------
+
+    >>> projector = BatchedProjector(Model.mesh, voronoi_swarm=Model.swarm)
+    >>> projector.add("plasticStrain", projPlasticStrain, Model.plasticStrain)
+    >>> projector.add("timeField", projTimeField, Model.timeField)
+    >>> projector.solve()
+    >>> projector.view("timeField").solve()
+    """
+
+    def __init__(self, mesh, voronoi_swarm=None):
+        self.mesh = mesh
+        self.swarm = voronoi_swarm
+        self._targets = OrderedDict()
+        self._projectors = dict()
+
+    def add(self, name, meshVariable, function):
+        """ Register a function to be projected on a mesh variable
+
+        Parameters
+        ----------
+
+        name : name used to select the projection in `solve`
+        meshVariable : MeshVariable defined on the projector mesh
+        function : function (or swarm variable) with as many components
+                   as the mesh variable has degrees of freedom
+        """
+        if meshVariable.mesh is not self.mesh:
+            raise ValueError("{0} is not defined on the projector "
+                             "mesh".format(name))
+        self._targets[name] = (meshVariable, fn.Function.convert(function))
+        self._projectors = dict()
+
+    def __contains__(self, name):
+        return name in self._targets
+
+    def view(self, name):
+        """ Projector of the function `name` alone """
+        return ProjectorView(self, name)
+
+    def _get_projector(self, names):
+        if names not in self._projectors:
+            components = list()
+            for name in names:
+                meshVariable, function = self._targets[name]
+                if meshVariable.nodeDofCount == 1:
+                    components.append(function)
+                else:
+                    components += [function[dof] for dof in
+                                   range(meshVariable.nodeDofCount)]
+            buffer = uw.mesh.MeshVariable(self.mesh,
+                                          nodeDofCount=len(components))
+            if len(components) > 1:
+                function = tuple(components)
+            else:
+                function = components[0]
+            projector = uw.utils.MeshVariable_Projection(
+                buffer, function, voronoi_swarm=self.swarm, type=0)
+            self._projectors[names] = (buffer, projector)
+        return self._projectors[names]
+
+    def solve(self, names=None):
+        """ Project the functions `names` (all if None)
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        names = tuple(names) if names else tuple(self._targets.keys())
+        if not names:
+            return
+        buffer, projector = self._get_projector(names)
+        projector.solve()
+        valid = np.isfinite(buffer.data).all(axis=1)[:, None]
+
+        start = 0
+        for name in names:
+            meshVariable = self._targets[name][0]
+            end = start + meshVariable.nodeDofCount
+            meshVariable.data[...] = np.where(valid,
+                                              buffer.data[:, start:end],
+                                              meshVariable.data)
+            start = end
+
+
+class ProjectorView(object):
+    """ Projection of a single function registered with a projector shared
+    by several functions (BatchedProjector, Nearest_neighbors_projector)
+
+    Example
+    -------
+
+    >>> view = ProjectorView(projector, "plasticStrain")
+    >>> view.solve()
+    """
+
+    def __init__(self, projector, name):
+        self.projector = projector
+        self.name = name
+
+    def solve(self):
+        """ Project the function
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        self.projector.solve([self.name])
+
+
 class Nearest_neighbors_projector(object):
+    """ Nearest neighbour projection of swarm variables on a mesh
+
+    Each node (local + shadow) takes the value of the closest local
+    particle. This is much cheaper than a weighted average projection and
+    is meant for fields that are only used for visualisation.
 
-    def __init__(self, mesh, swarm, swarm_variable, mesh_variable):
+    The KD-tree of the particles and the node to particle map are built
+    once per swarm state (swarm.stateId) and mesh geometry and shared by
+    all the registered variables, whose values are then copied directly
+    from the particle data.
+
+    Example
+    -------
+
+    >>> projector = Nearest_neighbors_projector(Model.mesh, Model.swarm)
+    >>> projector.add("projPlasticStrain", projPlasticStrain,
+    ...               Model.plasticStrain)
+    >>> projector.solve()
+    """
+
+    def __init__(self, mesh, swarm, swarm_variable=None, mesh_variable=None):
+        self.mesh = mesh
+        self.swarm = swarm
+        self._targets = OrderedDict()
+        self._nearest = None
+        self._state = None
+        if swarm_variable is not None and mesh_variable is not None:
+            self.add("default", mesh_variable, swarm_variable)
+
+    def add(self, name, meshVariable, swarmVariable):
+        """ Register a swarm variable to be projected on a mesh variable """
+        if meshVariable.mesh is not self.mesh:
+            raise ValueError("{0} is not defined on the projector "
+                             "mesh".format(name))
+        self._targets[name] = (meshVariable, swarmVariable)
+
+    def __contains__(self, name):
+        return name in self._targets
+
+    def view(self, name):
+        """ Projector of the swarm variable `name` alone """
+        return ProjectorView(self, name)
+
+    def _get_nearest(self):
+        """ Index of the particle closest to each node """
+        state = (self.swarm.stateId,
+                 hash(np.asarray(self.mesh.data).tobytes()))
+        if state != self._state:
+            coords = self.swarm.particleCoordinates.data
+            if coords.shape[0]:
+                tree = spatial.cKDTree(coords)
+                _, self._nearest = tree.query(self.mesh.data)
+            else:
+                self._nearest = None
+            self._state = state
+        return self._nearest
+
+    def solve(self, names=None):
+        """ Project the swarm variables `names` (all if None) """
+        names = names if names else list(self._targets.keys())
+        nearest = self._get_nearest()
+        if nearest is None:
+            return
+        for name in names:
+            meshVariable, swarmVariable = self._targets[name]
+            meshVariable.data[...] = swarmVariable.data[nearest]
+
+
+class SurfaceBand(object):
+    """ Selection of the particles lying in a band around a surface
+
+    Only the particles close to a surface (topography, erosion or
+    sedimentation threshold) can change state when the surface or the
+    particles move. The band is defined per cell: a particle is selected
+    when the vertical extent of the local cell owning it intersects the
+    band bounds. The cell extents are computed from the current mesh
+    geometry and the particles are located with swarm.owningCell, so the
+    band follows the mesh deformation and the swarm advection.
+
+    Example
+    -------
+
+    >>> band = SurfaceBand(Model.mesh, Model.swarm)
+    >>> margin = band.displacement(Model.velocityField, dt)
+    >>> particles = band.select(threshold - margin, threshold + margin)
+    """
+
+    def __init__(self, mesh, swarm):
         self.mesh = mesh
         self.swarm = swarm
-        self.swarm_variable = swarm_variable
-        self.mesh_variable = mesh_variable
+        self._element_nodes = None
 
-    def solve(self):
-        tree = spatial.cKDTree(self.swarm.particleCoordinates.data)
-        ids = tree.query(self.mesh.data)
-        pts = self.swarm.particleCoordinates.data[ids, :]
-        self.mesh_variable.data[...] = self.swarm_variable.evaluate(pts)
+    @property
+    def element_nodes(self):
+        """ Local indices of the nodes of the local elements """
+        if self._element_nodes is None:
+            mesh = self.mesh
+            gids = np.asarray(mesh.data_nodegId).ravel()
+            order = np.argsort(gids)
+            elementNodes = np.asarray(
+                mesh.data_elementNodes[:mesh.elementsLocal])
+            self._element_nodes = order[np.searchsorted(gids, elementNodes,
+                                                        sorter=order)]
+        return self._element_nodes
+
+    def cell_coordinates(self):
+        """ Coordinates of the nodes of the local cells
+        (elements, nodes per element, dim)"""
+        return self.mesh.data[self.element_nodes]
+
+    def cell_bounds(self):
+        """ Vertical extent (min, max) of the local cells """
+        z = self.mesh.data[:, -1][self.element_nodes]
+        return z.min(axis=1), z.max(axis=1)
+
+    def displacement(self, velocityField, dt):
+        """ Upper bound of the vertical displacement of the particles over
+        a time step dt
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        velocities = np.abs(velocityField.data[:, -1])
+        local = velocities.max() if velocities.size else 0.
+        return MPI.COMM_WORLD.allreduce(local, op=MPI.MAX) * dt
+
+    def select(self, lower, upper):
+        """ Return the indices of the local particles owned by the cells
+        intersecting the band [lower, upper]
+
+        lower and upper are either scalars or arrays with one value per
+        local cell.
+        """
+        if not self.swarm.particleLocalCount:
+            return np.zeros(0, dtype="int")
+        cmin, cmax = self.cell_bounds()
+        cells = (cmax >= lower) & (cmin <= upper)
+        owners = self.swarm.owningCell.data[:, 0]
+        return np.where(cells[owners])[0]
 
 
 def fn_Tukey_window(r, centre, width, top, bottom):
@@ -745,6 +1003,163 @@ class LogFile(object):
         return self.nonLinear_blocks
 
 
+class Timings(object):
+    """ Per-step wall-clock timings of the phases of a Model run
+
+    The time spent in each phase is accumulated locally on each processor
+    and reduced over all the processors (min, max, mean) at the end of the
+    step.
+
+    Example
+    -------
+
+    >>> timings = Timings(["Stokes solve", "Swarm advection"])
+    >>> with timings.record("Stokes solve"):
+    ...     Model.solve()
+    >>> timings.end_step(step=1)
+    """
+
+    def __init__(self, phases=None, comm=None):
+        self.phases = list(phases) if phases else list()
+        self.comm = comm if comm else MPI.COMM_WORLD
+        self.steps = list()
+        self._current = dict()
+        self._headers = dict()
+
+    @contextmanager
+    def record(self, phase):
+        """ Context manager timing the enclosed block for a phase """
+        if phase not in self.phases:
+            self.phases.append(phase)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self._current[phase] = self._current.get(phase, 0.) + elapsed
+
+    def end_step(self, **kwargs):
+        """ Reduce the timings of the current step over all the processors
+
+        This is a collective call.
+
+        Parameters
+        ----------
+
+        kwargs : additional information stored with the step
+                 (step number, time, dt, number of iterations...)
+
+        Returns
+        -------
+
+        An OrderedDict containing kwargs followed by a (min, max, mean)
+        dictionary for each phase.
+        """
+        local = np.array([self._current.get(phase, 0.)
+                          for phase in self.phases])
+        mins = np.zeros_like(local)
+        maxs = np.zeros_like(local)
+        sums = np.zeros_like(local)
+        self.comm.Allreduce(local, mins, op=MPI.MIN)
+        self.comm.Allreduce(local, maxs, op=MPI.MAX)
+        self.comm.Allreduce(local, sums, op=MPI.SUM)
+        means = sums / self.comm.Get_size()
+
+        record = OrderedDict()
+        for key in sorted(kwargs.keys()):
+            record[key] = kwargs[key]
+        for phase, vmin, vmax, vmean in zip(self.phases, mins, maxs, means):
+            record[phase] = {"min": vmin, "max": vmax, "mean": vmean}
+
+        self.steps.append(record)
+        self._current = dict()
+        return record
+
+    @property
+    def last(self):
+        """ Timings of the last completed step """
+        if self.steps:
+            return self.steps[-1]
+        return None
+
+    def totals(self):
+        """ Sum of the maximum time spent in each phase over all steps """
+        totals = OrderedDict()
+        for phase in self.phases:
+            totals[phase] = sum([record[phase]["max"] for record in self.steps
+                                 if phase in record])
+        return totals
+
+    def new_output(self):
+        """ Start the csv files again on their next write
+
+        Called at the start of a run (Model.run_for), after a restart, so
+        that the rows of a previous run are not mixed with the new ones.
+        """
+        self._headers = dict()
+
+    def write_csv(self, filename, record=None):
+        """ Append a step record to a csv file (rank 0 only)
+
+        The file is truncated on the first write after new_output (or
+        after the creation of the Timings object). If the columns have
+        changed since the last write (new phase), the rows already
+        written are rewritten under the new header, with missing values
+        set to 0.
+        """
+        record = record if record else self.last
+        if uw.rank() != 0 or not record:
+            return
+
+        info = [key for key in record.keys() if key not in self.phases]
+        header = list(info)
+        values = [str(record[key]) for key in info]
+        for phase in self.phases:
+            stats = record.get(phase, {"min": 0., "max": 0., "mean": 0.})
+            for stat in ["min", "max", "mean"]:
+                header.append(phase.replace(" ", "_") + "_" + stat)
+                values.append(repr(float(stats[stat])))
+
+        previous = self._headers.get(filename)
+        if previous == header:
+            with open(filename, "a") as f:
+                f.write(",".join(values) + "\n")
+            return
+
+        rows = list()
+        if previous is not None and os.path.exists(filename):
+            with open(filename) as f:
+                reader = csv.DictReader(f)
+                rows = [[row.get(key) or repr(0.) for key in header]
+                        for row in reader]
+
+        with open(filename, "w") as f:
+            f.write(",".join(header) + "\n")
+            for row in rows:
+                f.write(",".join(row) + "\n")
+            f.write(",".join(values) + "\n")
+        self._headers[filename] = header
+
+    def write_json(self, filename):
+        """ Write all the step records to a json file (rank 0 only) """
+        if uw.rank() != 0:
+            return
+
+        def convert(value):
+            if isinstance(value, dict):
+                return OrderedDict([(key, convert(val))
+                                    for key, val in value.items()])
+            if isinstance(value, (np.floating, np.integer)):
+                return value.item()
+            if isinstance(value, u.Quantity):
+                return str(value)
+            return value
+
+        with open(filename, "w") as f:
+            json.dump([convert(record) for record in self.steps], f,
+                      indent=2)
+
+
 def extract_profile(field,
                     line,
                     nsamples=1000):
@@ -763,7 +1178,7 @@ def extract_profile(field,
         raise NotImplementedError("""The extract_profile function will not work
                                   in parallel""")
 
-    coords = np.array([(nd(x), nd(y)) for (x, y) in line])
+    coords = nd_array(line)
 
     x = np.linspace(coords[0, 0], coords[-1, 0], nsamples)
 
@@ -82,6 +82,34 @@ def validate_int_or_none(s):
         raise ValueError("Must be int or None")
 
 
+def validate_timings_output(s):
+    if s is None or (isinstance(s, six.string_types) and
+                     s.lower() == "none"):
+        return None
+    if isinstance(s, six.string_types) and s.lower() in ["csv", "json"]:
+        return s.lower()
+    raise ValueError("timings.output must be None, 'csv' or 'json'")
+
+
+def validate_compression(s):
+    # lzf is only applied by serial writes (asynchronous checkpoints),
+    # parallel (mpio) writes fall back to gzip (see create_dataset)
+    if s is None or (isinstance(s, six.string_types) and
+                     s.lower() == "none"):
+        return None
+    if isinstance(s, six.string_types) and s.lower() in ["gzip", "lzf"]:
+        return s.lower()
+    raise ValueError("checkpoint.compression must be None, 'gzip' or 'lzf'")
+
+
+def validate_isostasy_update(s):
+    if (isinstance(s, six.string_types) and
+            s.lower() in ["iteration", "step", "tolerance"]):
+        return s.lower()
+    raise ValueError("isostasy.update must be 'iteration', 'step' "
+                     "or 'tolerance'")
+
+
 def validate_path(s):
     return str(s)
 
@@ -3,6 +3,47 @@ import underworld as uw
 from .scaling import nonDimensionalize as nd
 import numpy as np
 from scipy import spatial
+from mpi4py import MPI
+
+
+def _evaluate_local(function, coords):
+    """ Evaluate a function at a set of coordinates, skipping the points
+    that are outside the local domain.
+
+    The points are evaluated in one call. If some of them are outside
+    the local domain, the set is split in two and each half is evaluated
+    again, so that the number of calls grows with the number of
+    contiguous blocks of outside points, not with the number of points.
+
+    Returns the values (None if no point was found) and a boolean mask of
+    the points found locally.
+    """
+    found = np.zeros(len(coords), dtype=bool)
+    values = None
+    blocks = [(0, len(coords))]
+    while blocks:
+        start, end = blocks.pop()
+        if start == end:
+            continue
+        try:
+            result = function.evaluate(coords[start:end])
+        except ValueError:
+            # Outside the local domain
+            if end - start > 1:
+                middle = (start + end) // 2
+                blocks.append((start, middle))
+                blocks.append((middle, end))
+            continue
+        if values is None:
+            values = np.zeros((len(coords), result.shape[1]))
+        values[start:end] = result
+        found[start:end] = True
+    return values, found
+
+
+def _in_box(coords, minCoord, maxCoord):
+    """ Return a mask of the points inside a bounding box """
+    return np.all((coords >= minCoord) & (coords <= maxCoord), axis=1)
 
 
 class Visugrid(object):
@@ -27,26 +68,88 @@ class Visugrid(object):
 
         self.Model = Model
 
-        # Build a KDTree to handle boundaries
+        # Build a KDTree to handle boundaries. The tree is built from the
+        # boundary nodes of all the processors so that the nearest node is
+        # found whatever the decomposition.
+        comm = MPI.COMM_WORLD
         self.boundaries = boundaryNodes.data
-        x = Model.mesh.data[self.boundaries, 0]
-        y = Model.mesh.data[self.boundaries, 1]
-        coords = np.zeros((x.size, 2))
-        coords[:, 0] = x.ravel()
-        coords[:, 1] = y.ravel()
-        self.tree = spatial.cKDTree(coords)
+        coords = Model.mesh.data[self.boundaries, :Model.mesh.dim]
+        self._boundaryCounts = comm.allgather(len(self.boundaries))
+        coords = comm.allgather(coords)
+        self.tree = spatial.cKDTree(np.concatenate(coords))
 
-    def advect(self, dt):
+    def _boundary_velocities(self):
+        """ Gather the velocities of the boundary nodes of all processors,
+        ordered as the KD-tree nodes"""
+        comm = MPI.COMM_WORLD
+        velocities = self.velocityField.data[self.boundaries]
+        return np.concatenate(comm.allgather(velocities))
 
-        with self.mesh.deform_mesh():
-            for index, coords in enumerate(self.mesh.data):
-                try:
-                    self.mesh.data[index] += self.velocityField.evaluate(np.array([coords]))[0] * dt
-                except:
-                    _, loc = self.tree.query(self.mesh.data[index])
-                    loc = self.boundaries[loc]
-                    coords = self.Model.mesh.data[loc]
-                    self.mesh.data[index] += self.velocityField.data[loc] * dt
+    def _velocities(self, coords):
+        """ Evaluate the velocity field at the visugrid nodes
+
+        Points that are outside the local domain are evaluated by the
+        processors owning them. Points that are outside the Model domain
+        take the velocity of the nearest boundary node.
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        comm = MPI.COMM_WORLD
+        mesh = self.Model.mesh
+        dim = mesh.dim
+        minCoord = mesh.data.min(axis=0)
+        maxCoord = mesh.data.max(axis=0)
 
+        velocities = np.zeros((len(coords), dim))
+        found = np.zeros(len(coords), dtype=bool)
 
+        inside = np.where(_in_box(coords, minCoord, maxCoord))[0]
+        values, mask = _evaluate_local(self.velocityField, coords[inside])
+        if values is not None:
+            velocities[inside[mask]] = values[mask]
+        found[inside[mask]] = True
 
+        # Share the points not found locally with the other processors
+        missing = np.where(~found)[0]
+        if not comm.allreduce(len(missing), op=MPI.SUM):
+            return velocities
+
+        counts = comm.allgather(len(missing))
+        others = np.concatenate(comm.allgather(coords[missing]))
+        others = others.reshape((-1, dim))
+
+        local_values = np.zeros((len(others), dim))
+        local_count = np.zeros(len(others))
+        inside = np.where(_in_box(others, minCoord, maxCoord))[0]
+        values, mask = _evaluate_local(self.velocityField, others[inside])
+        if values is not None:
+            local_values[inside[mask]] = values[mask]
+        local_count[inside[mask]] = 1.0
+
+        # Points on a processor boundary may be found more than once
+        global_values = np.zeros_like(local_values)
+        global_count = np.zeros_like(local_count)
+        comm.Allreduce(local_values, global_values, op=MPI.SUM)
+        comm.Allreduce(local_count, global_count, op=MPI.SUM)
+
+        # Points outside the domain take the velocity of the
+        # nearest boundary node
+        outside = global_count == 0
+        if np.any(outside):
+            _, loc = self.tree.query(others[outside])
+            global_values[outside] = self._boundary_velocities()[loc]
+            global_count[outside] = 1.0
+
+        global_values /= global_count[:, np.newaxis]
+
+        offset = int(np.sum(counts[:comm.rank]))
+        velocities[missing] = global_values[offset:offset + len(missing)]
+        return velocities
+
+    def advect(self, dt):
+
+        velocities = self._velocities(np.array(self.mesh.data))
+        with self.mesh.deform_mesh():
+            self.mesh.data[...] += velocities * dt
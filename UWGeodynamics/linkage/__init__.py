@@ -1,3 +1,3 @@
 from __future__ import print_function,  absolute_import
-from linkage import *
+from .linkage import *
 __version__ = "0.1"
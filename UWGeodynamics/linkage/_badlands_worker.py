@@ -0,0 +1,45 @@
+""" Badlands worker process
+
+This script is started by linkage.BadlandsProcess with MPI.COMM_SELF.Spawn.
+The worker has its own MPI_COMM_WORLD, which pyBadlands can use, and talks
+to the Underworld processor that spawned it through the parent
+intercommunicator. It only imports the Badlands driver once the python
+path of the parent is known.
+"""
+from __future__ import print_function,  absolute_import
+import sys
+import traceback
+from mpi4py import MPI
+
+
+def serve(parent):
+    """ Build a Badlands driver and run the calls received from the parent
+    until None is received. Each call is answered with (error, result). """
+    # The driver factory may live in a module only known to the parent
+    # (e.g. a source tree on its python path)
+    paths = parent.recv(source=0)
+    sys.path.extend([path for path in paths if path not in sys.path])
+
+    try:
+        factory, args = parent.recv(source=0)
+        driver = factory(*args)
+    except Exception:
+        parent.send((traceback.format_exc(), None), dest=0)
+        return
+    parent.send((None, None), dest=0)
+
+    while True:
+        message = parent.recv(source=0)
+        if message is None:
+            break
+        name, args = message
+        try:
+            parent.send((None, driver.call(name, *args)), dest=0)
+        except Exception:
+            parent.send((traceback.format_exc(), None), dest=0)
+
+
+if __name__ == "__main__":
+    parent = MPI.Comm.Get_parent()
+    serve(parent)
+    parent.Disconnect()
@@ -1,16 +1,18 @@
 from __future__ import print_function,  absolute_import
+import os
 import sys
-from pyBadlands.model import Model as BadlandsModel
-from scipy.interpolate import griddata, interp1d
+import shutil
+import tempfile
+import traceback
+import warnings
+from scipy.interpolate import griddata
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
 from UWGeodynamics.scaling import COEFFICIENTS as scaling_coefficients
 from UWGeodynamics.scaling import Dimensionalize, UnitRegistry
+from UWGeodynamics._utils import SurfaceBand
 
-from tempfile import gettempdir
-from .uw_utilities import get_UW_velocities
-
-_tempdir = gettempdir()
+from .uw_utilities import SurfaceVelocities
 
 from mpi4py import MPI
 
@@ -18,17 +20,360 @@ comm = MPI.COMM_WORLD
 size = comm.Get_size()
 rank = comm.rank
 
+
+class _ProfileSurface(object):
+    """ Badlands surface of a 2D model: profile of the elevations along x
+    (linear interpolation) """
+
+    def __init__(self, xs, elevations):
+        self.xs = xs
+        self.elevations = elevations
+
+    def elevation(self, points):
+        """ Elevation of the surface at the points (..., dim) """
+        return np.interp(points[..., 0], self.xs, self.elevations)
+
+    def bounds(self, cells):
+        """ Lower and upper bounds of the surface elevation over the
+        horizontal extent of the cells (cells, nodes, dim) """
+        elevations = self.elevation(cells)
+        widths = cells[..., 0].max(axis=1) - cells[..., 0].min(axis=1)
+        slope = np.abs(np.diff(self.elevations) / np.diff(self.xs)).max()
+        return (elevations.min(axis=1) - slope * widths,
+                elevations.max(axis=1) + slope * widths)
+
+
+class _GridSurface(object):
+    """ Badlands surface of a 3D model: elevations sampled on the regular
+    Badlands grid. The elevation of a point is the one of the closest node
+    of the grid, found by rounding its coordinates (no search structure).
+    """
+
+    def __init__(self, xs, ys, elevations):
+        self.origin = np.array([xs[0], ys[0]])
+        self.spacing = np.array([xs[1] - xs[0], ys[1] - ys[0]])
+        self.shape = np.array(elevations.shape)
+        self.elevations = elevations
+
+    def _index(self, coords):
+        """ Indices of the closest nodes of the grid to the horizontal
+        coordinates (..., 2) """
+        index = np.rint((coords - self.origin) / self.spacing).astype(int)
+        return np.clip(index, 0, self.shape - 1)
+
+    def elevation(self, points):
+        """ Elevation of the surface at the points (..., dim) """
+        index = self._index(points[..., :2])
+        return self.elevations[index[..., 0], index[..., 1]]
+
+    def bounds(self, cells):
+        """ Lower and upper bounds of the surface elevation over the
+        horizontal extent of the cells (cells, nodes, dim)
+
+        The closest node of any point of a cell lies between the closest
+        nodes of its lower and upper corners: the bounds are the extreme
+        elevations of the nodes of that window.
+        """
+        if not len(cells):
+            return np.zeros(0), np.zeros(0)
+        lower = self._index(cells[..., :2].min(axis=1))
+        upper = self._index(cells[..., :2].max(axis=1))
+        low = np.full(len(cells), np.inf)
+        high = np.full(len(cells), -np.inf)
+        # Loop over the offsets in the windows (a few nodes per cell), each
+        # iteration processes all the cells
+        sizes = (upper - lower).max(axis=0) + 1
+        for i in range(sizes[0]):
+            for j in range(sizes[1]):
+                ix = np.minimum(lower[:, 0] + i, upper[:, 0])
+                iy = np.minimum(lower[:, 1] + j, upper[:, 1])
+                elevations = self.elevations[ix, iy]
+                low = np.minimum(low, elevations)
+                high = np.maximum(high, elevations)
+        return low, high
+
+
+class BadlandsDriver(object):
+    """ Badlands model driven by the coupling
+
+    The driver holds the Badlands model and exchanges the surface, the
+    elevations and the tectonic displacements with SPM in Badlands units
+    (metres, years). `call` and `start` run a method of the driver in the
+    calling process, `wait` raises the error of the last call to `start`
+    (see BadlandsProcess for the asynchronous version).
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._disp_inserted = False
+        self._error = None
+
+    @classmethod
+    def build(cls, XML, dem, checkpoint_interval, time_years,
+              restartFolder=None, restartStep=None):
+        """ Build the Badlands model from its XML input and a DEM """
+        try:
+            # pyBadlands is only required where Badlands runs
+            from pyBadlands.model import Model as BadlandsModel
+        except ImportError:
+            raise ImportError("""pyBadlands import as failed. Please check your
+                              installation, PYTHONPATH and PATH environment
+                              variables""")
+
+        badlands_model = BadlandsModel()
+        badlands_model.load_xml(XML)
+        if restartStep:
+            badlands_model.input.restart = True
+            badlands_model.input.rstep = restartStep
+            badlands_model.input.rfolder = restartFolder
+            badlands_model.input.outDir = restartFolder
+            badlands_model.outputStep = restartStep
+
+        # Badlands only reads the DEM from a text file. The file is
+        # written in a directory unique to this job (several jobs may
+        # share the same temporary directory) and removed once the
+        # Badlands mesh is built.
+        tmp = tempfile.mkdtemp(prefix="UWGeodynamics-badlands-")
+        demfile = tmp + "/dem.csv"
+        try:
+            cls._write_dem(demfile, dem)
+            # Build Mesh
+            badlands_model.build_mesh(demfile, verbose=False)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        badlands_model.input.disp3d = True  # enable 3D displacements
+        badlands_model.input.region = 0  # TODO: check what this does
+        badlands_model.input.tStart = time_years
+        badlands_model.tNow = time_years
+
+        # Override the checkpoint/display interval in the Badlands model to
+        # ensure BL and UW are synced
+        badlands_model.input.tDisplay = checkpoint_interval
+
+        # Set Badlands minimal distance between nodes before regridding
+        badlands_model.force.merge3d = (badlands_model.input.Afactor *
+                                        badlands_model.recGrid.resEdges * 0.5)
+
+        # Bodge Badlands to perform an initial checkpoint
+        # FIXME: we need to run the model for at least one iteration before
+        # this is generated. It would be nice if this wasn't the case.
+        badlands_model.force.next_display = 0
+
+        return cls(badlands_model)
+
+    @staticmethod
+    def _write_dem(filename, dem, fmt="%.9g"):
+        """ Write the DEM points (x, y, z) as text in a single write
+
+        The whole array is formatted at once, which is much cheaper than
+        np.savetxt (one formatting per row). 9 significant digits keep the
+        coordinates, from which Badlands computes its resolution, to the
+        millimetre over a thousand kilometres.
+        """
+        dem = np.asarray(dem, dtype=np.float64)
+        row = " ".join([fmt] * dem.shape[1]) + "\n"
+        with open(filename, "w") as f:
+            f.write((row * dem.shape[0]) % tuple(dem.ravel()))
+
+    def call(self, name, *args):
+        """ Run the method `name` and return its result """
+        return getattr(self, name)(*args)
+
+    def start(self, name, *args):
+        """ Run the method `name`, its errors are raised by `wait` """
+        try:
+            self.call(name, *args)
+        except Exception:
+            self._error = traceback.format_exc()
+
+    def wait(self):
+        """ Raise the error of the last call to start """
+        error, self._error = self._error, None
+        if error:
+            raise RuntimeError(error)
+
+    def close(self):
+        pass
+
+    def surface(self, dim):
+        """ Points of the Badlands surface """
+        rg = self.model.recGrid
+        if dim == 2:
+            zVals = rg.regZ.mean(axis=1)
+            return np.column_stack((rg.regX, zVals))
+        return np.column_stack((rg.rectX, rg.rectY, rg.rectZ))
+
+    def surface_elevations(self, dim):
+        """ Elevations of the Badlands surface used to classify the
+        particles
+
+        The TIN elevations are sampled on the regular grid (nearest
+        neighbour). In 3D, the x and y coordinates of the grid and the
+        elevations (x, y). In 2D, the x coordinates of the grid and the
+        elevation profile (averaged along y).
+        """
+        # points that we have known elevation for
+        known_xy = self.model.recGrid.tinMesh['vertices']
+        known_z = self.model.elevation  # elevation for those points
+        xs = self.model.recGrid.regX
+        ys = self.model.recGrid.regY
+        grid_x, grid_y = np.meshgrid(xs, ys)
+        zs = griddata(known_xy, known_z, (grid_x, grid_y), method='nearest').T
+        if dim == 3:
+            return xs, ys, zs
+        return xs, zs.mean(axis=1)
+
+    def run_to_time(self, time):
+        self.model.run_to_time(time)
+
+    def inject_displacement(self, time, dt, disp, sigma, dim):
+        """
+        Takes a plane of tracer points and their DISPLACEMENTS in 3D over time
+        period dt applies a gaussian filter on it. Injects it into Badlands as 3D
+        tectonic movement.
+        """
+
+        # The Badlands 3D interpolation map is the displacement of each DEM
+        # node at the end of the time period relative to its starting position.
+        # If you start a new displacement file, it is treated as starting at
+        # the DEM starting points (and interpolated onto the TIN as it was at
+        # that tNow).
+
+        badlands_model = self.model
+
+        # kludge; don't keep adding new entries
+        if self._disp_inserted:
+            badlands_model.force.T_disp[0, 0] = time
+            badlands_model.force.T_disp[0, 1] = (time + dt)
+        else:
+            badlands_model.force.T_disp = np.vstack(
+                ([time, time + dt], badlands_model.force.T_disp))
+            self._disp_inserted = True
+
+        rnx = badlands_model.recGrid.rnx
+        rny = badlands_model.recGrid.rny
+
+        # Extent the velocity field in the third dimension
+        if dim == 2:
+            dispX = np.tile(disp[:,0], rny)
+            dispY = np.zeros((rnx * rny,))
+            dispZ = np.tile(disp[:,1], rny)
+
+            disp = np.zeros((rnx * rny,3))
+            disp[:,0] = dispX
+            disp[:,1] = dispY
+            disp[:,2] = dispZ
+
+        # Gaussian smoothing
+        if sigma>0:
+            dispX = np.copy(disp[:,0]).reshape(rnx, rny)
+            dispY = np.copy(disp[:,1]).reshape(rnx, rny)
+            dispZ = np.copy(disp[:,2]).reshape(rnx, rny)
+            smoothX = gaussian_filter(dispX, sigma)
+            smoothY = gaussian_filter(dispY, sigma)
+            smoothZ = gaussian_filter(dispZ, sigma)
+            disp[:,0] = smoothX.flatten()
+            disp[:,1] = smoothY.flatten()
+            disp[:,2] = smoothZ.flatten()
+
+        badlands_model.force.injected_disps = disp
+
+
+def build_badlands_driver(XML, dem, checkpoint_interval, time_years,
+                          restartFolder=None, restartStep=None):
+    """ Build the default Badlands driver (see BadlandsDriver.build)
+
+    Module level function so that it can be sent to a Badlands process
+    (bound methods cannot be pickled with python 2).
+    """
+    return BadlandsDriver.build(XML, dem, checkpoint_interval, time_years,
+                                restartFolder, restartStep)
+
+
+class BadlandsProcess(object):
+    """ Badlands driver running in a separate process
+
+    The driver is built by factory(*args) in a worker process spawned by
+    the Badlands processor (rank 0) with MPI.COMM_SELF.Spawn, and the calls
+    are sent to it through the intercommunicator. The worker is a new
+    MPI process with its own MPI_COMM_WORLD: it does not share the MPI
+    state of Underworld and can use MPI itself (pyBadlands does). `start`
+    returns as soon as the call is sent so that Badlands runs while
+    Underworld goes on. `wait` blocks until the call is done and raises the
+    errors of the driver.
+
+    The factory and its arguments must be picklable (e.g. a module level
+    function or class).
+
+    The MPI library and the launcher must support dynamic processes
+    (MPI_Comm_spawn), many batch launchers do not. The MPI.Exception
+    raised when the worker cannot be spawned is passed on.
+    """
+
+    def __init__(self, factory, *args):
+        worker = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "_badlands_worker.py")
+        self._comm = MPI.COMM_SELF.Spawn(sys.executable, args=[worker],
+                                         maxprocs=1)
+        self._comm.send(sys.path, dest=0)
+        self._comm.send((factory, args), dest=0)
+        self._pending = False
+        try:
+            self._receive()
+        except RuntimeError:
+            self._comm.Disconnect()
+            self._comm = None
+            raise
+
+    def _receive(self):
+        error, result = self._comm.recv(source=0)
+        if error:
+            raise RuntimeError(error)
+        return result
+
+    def call(self, name, *args):
+        """ Run the method `name` of the driver and return its result """
+        self.wait()
+        self._comm.send((name, args), dest=0)
+        return self._receive()
+
+    def start(self, name, *args):
+        """ Start the method `name` of the driver """
+        self.wait()
+        self._comm.send((name, args), dest=0)
+        self._pending = True
+
+    def wait(self):
+        """ Wait for the call started last """
+        if self._pending:
+            self._pending = False
+            self._receive()
+
+    def close(self):
+        """ Stop the worker process """
+        if self._comm is None:
+            return
+        try:
+            self.wait()
+        finally:
+            self._comm.send(None, dest=0)
+            self._comm.Disconnect()
+            self._comm = None
+
+
 class SPM(object):
 
     def __init__(self, mesh, velocityField, swarm, materialField, airIndex,
                  sedimentIndex, XML, resolution, checkpoint_interval,
                  surfElevation=0., verbose=True, restartFolder=None,
-                 restartStep=None):
+                 restartStep=None, lagged=False, driver=None):
 
         self.SECONDS_PER_YEAR = 31556925.9747  # Tropical year in seconds
         self.verbose = verbose
         self.restartStep = restartStep
         self.restartFolder = restartFolder
+        self.lagged = lagged
 
         # AutoScaling
         self.scaleDIM = 1.0 / scaling_coefficients["[length]"].magnitude
@@ -46,16 +391,6 @@ class SPM(object):
 
         self.XML = XML
 
-        if rank == 0:
-            self.badlands_model = BadlandsModel()
-            self.badlands_model.load_xml(self.XML)
-            if self.restartStep:
-                self.badlands_model.input.restart = True
-                self.badlands_model.input.rstep = self.restartStep
-                self.badlands_model.input.rfolder = self.restartFolder
-                self.badlands_model.input.outDir = self.restartFolder
-                self.badlands_model.outputStep = self.restartStep
-
         self.minCoord = self.mesh.minCoord
         self.maxCoord = self.mesh.maxCoord
 
@@ -68,40 +403,42 @@ class SPM(object):
             root = tree.getroot()
             self.time_years = float(root[0][0][0].attrib["Value"])
 
-        self._tmp = _tempdir
-        self._demfile = self._tmp+"/dem.csv"
-
-        # Create Initial Flat DEM
+        # Create Initial Flat DEM and start Badlands
         if rank == 0:
-            self.dem = self._generate_flat_dem(self.minCoord,
-                                               self.maxCoord,
-                                               self.resolution,
-                                               self.surfElevation,
-                                               self.scaleDIM)
-
-            np.savetxt(self._demfile, self.dem)
-            # Build Mesh
-            self.badlands_model.build_mesh(self._demfile, verbose=False)
-
-            self.badlands_model.input.disp3d = True  # enable 3D displacements
-            self.badlands_model.input.region = 0  # TODO: check what this does
-            self.badlands_model.input.tStart = self.time_years
-            self.badlands_model.tNow = self.time_years
-
-            # Override the checkpoint/display interval in the Badlands model to
-            # ensure BL and UW are synced
-            self.badlands_model.input.tDisplay = self.checkpoint_interval
-
-            # Set Badlands minimal distance between nodes before regridding
-            self.badlands_model.force.merge3d = self.badlands_model.input.Afactor * self.badlands_model.recGrid.resEdges * 0.5
-
-            # Bodge Badlands to perform an initial checkpoint
-            # FIXME: we need to run the model for at least one iteration before this is generated. It would be nice if this wasn't the case.
-            self.badlands_model.force.next_display = 0
-
+            dem = self._generate_flat_dem(self.minCoord,
+                                          self.maxCoord,
+                                          self.resolution,
+                                          self.surfElevation,
+                                          self.scaleDIM)
+            factory = driver if driver else build_badlands_driver
+            args = (self.XML, dem, self.checkpoint_interval,
+                    self.time_years, self.restartFolder, self.restartStep)
+            if self.lagged:
+                try:
+                    self._badlands = BadlandsProcess(factory, *args)
+                except MPI.Exception as error:
+                    warnings.warn(
+                        "The Badlands process could not be spawned (the "
+                        "lagged coupling needs MPI dynamic process "
+                        "support): Badlands runs without lag. "
+                        "{0}".format(error))
+                    self.lagged = False
+            if not self.lagged:
+                self._badlands = factory(*args)
+
+        # Rank 0 falls back to the coupling without lag if the Badlands
+        # process cannot be spawned
+        self.lagged = comm.bcast(self.lagged, root=0)
         comm.Barrier()
 
-        self._disp_inserted = False
+        self._band = SurfaceBand(self.mesh, self.swarm)
+        self._surface_velocities = SurfaceVelocities(self.velocityField)
+        self._pending = False
+        self._surface = None
+        self._checkAll = True
+        # Time over which the particles have moved since the last update of
+        # the materials
+        self._elapsed = 0.
 
         # Transfer the initial DEM state to Underworld
         self._update_material_types()
@@ -117,39 +454,41 @@ class SPM(object):
             sys.stdout.flush()
 
         dt_years = Dimensionalize(dt, UnitRegistry.years).magnitude
+        self._elapsed += dt
 
-        if rank == 0:
-            rg = self.badlands_model.recGrid
-            if self.mesh.dim == 2:
-                zVals = rg.regZ.mean(axis = 1)
-                np_surface = np.column_stack((rg.regX, zVals)) * self.scaleDIM
+        if self.lagged:
+            # Apply the surface computed during the previous step
+            self.synchronize()
 
-            if self.mesh.dim == 3:
-                np_surface = np.column_stack((rg.rectX, rg.rectY, rg.rectZ))*self.scaleDIM
+        if rank == 0:
+            np_surface = self._badlands.call("surface", self.mesh.dim)
+            np_surface = np_surface * self.scaleDIM
         else:
 
             np_surface = None
 
         np_surface = comm.bcast(np_surface, root=0)
-        comm.Barrier()
 
         # Get Velocity Field at the surface
-        tracer_velocity_mps = get_UW_velocities(np_surface, self.velocityField) * self.scaleTIME / self.scaleDIM
+        tracer_velocity_mps = (self._surface_velocities(np_surface) *
+                               self.scaleTIME / self.scaleDIM)
 
         if rank == 0:
             # Use the tracer vertical velocities to deform the Badlands TIN
             # convert from meters per second to meters displacement over the whole iteration
             tracer_disp = tracer_velocity_mps * self.SECONDS_PER_YEAR * dt_years
-            self._inject_badlands_displacement(self.time_years, dt_years, tracer_disp, sigma)
+            self._badlands.call("inject_displacement", self.time_years,
+                                dt_years, tracer_disp, sigma, self.mesh.dim)
 
-            # Run the Badlands model to the same time point
-            self.badlands_model.run_to_time(self.time_years+dt_years)
+            # Run the Badlands model to the same time point. In lagged mode
+            # Badlands runs in its own process while Underworld goes on.
+            self._badlands.start("run_to_time", self.time_years + dt_years)
 
+        self._pending = True
         self.time_years += dt_years
 
-        # TODO: Improve the performance of this function
-        self._update_material_types()
-        comm.Barrier()
+        if not self.lagged:
+            self.synchronize()
 
         if rank == 0 and self.verbose:
             purple = "\033[0;35m"
@@ -159,40 +498,84 @@ class SPM(object):
 
         return
 
-    def _determine_particle_state_2D(self):
+    def _apply_surface(self):
+        """ Update the materials from the current Badlands surface """
+        self._update_material_types(self._elapsed)
+        self._elapsed = 0.
+
+    def synchronize(self):
+        """ Wait for the Badlands run started by the last call to solve
+        and update the materials from its surface. Nothing is done if no
+        run is pending.
 
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        if not self._pending:
+            return
+        self._pending = False
+
+        error = None
         if rank == 0:
-            known_xy = self.badlands_model.recGrid.tinMesh['vertices']*self.scaleDIM  # points that we have known elevation for
-            known_z = self.badlands_model.elevation*self.scaleDIM  # elevation for those points
-            xs = self.badlands_model.recGrid.regX*self.scaleDIM
-            ys = self.badlands_model.recGrid.regY*self.scaleDIM
-        else:
-            known_xy = None
-            known_z = None
-            xs = None
-            ys = None
+            try:
+                self._badlands.wait()
+            except RuntimeError as exception:
+                error = str(exception)
+        error = comm.bcast(error, root=0)
 
-        known_xy = comm.bcast(known_xy, root=0)
-        known_z = comm.bcast(known_z, root=0)
-        xs = comm.bcast(xs, root=0)
-        ys = comm.bcast(ys, root=0)
+        if error:
+            raise RuntimeError("Badlands failed: " + error)
 
-        comm.Barrier()
+        self._apply_surface()
 
-        grid_x, grid_y = np.meshgrid(xs, ys)
-        interpolate_z = griddata(known_xy, known_z, (grid_x, grid_y), method='nearest').T
-        interpolate_z = interpolate_z.mean(axis=1)
+    def close(self):
+        """ Stop the Badlands process (lagged coupling) """
+        if rank == 0:
+            self._badlands.close()
+
+    def reset_band(self):
+        """ Check all the particles at the next update of the materials
+        (the swarm or the materials have been changed) """
+        self._checkAll = True
+
+    def _get_surface(self):
+        """ Badlands surface used to classify the particles
 
-        f = interp1d(xs, interpolate_z)
+        The elevations are sampled on the regular Badlands grid by rank 0
+        and broadcast to all the processors (the grid is smaller than the
+        TIN and the particles are located on it without a search).
+        """
+        if rank == 0:
+            surface = self._badlands.call("surface_elevations",
+                                          self.mesh.dim)
+            surface = [values * self.scaleDIM for values in surface]
+        else:
+            surface = None
+
+        surface = comm.bcast(surface, root=0)
+        if self.mesh.dim == 2:
+            return _ProfileSurface(*surface)
+        return _GridSurface(*surface)
 
-        uw_surface = self.swarm.particleCoordinates.data
-        bdl_surface = f(uw_surface[:,0])
+    def _band_particles(self, surface, dt):
+        """ Return the local particles that may have changed state
 
-        flags = uw_surface[:,1] < bdl_surface
+        A particle can only change state if it has crossed the surface
+        during the time step, either because it has been advected or
+        because the surface has moved. The band is bounded, per cell, by
+        the extreme elevations of the previous and current surfaces over
+        the cell, widened by the displacement of the particles.
+        """
+        cells = self._band.cell_coordinates()
+        lower, upper = self._surface.bounds(cells)
+        low, high = surface.bounds(cells)
+        lower, upper = np.minimum(lower, low), np.maximum(upper, high)
 
-        return flags
+        margin = self._band.displacement(self.velocityField, dt)
+        return self._band.select(lower - margin, upper + margin)
 
-    def _determine_particle_state(self):
+    def _determine_particle_state(self, surface, volume):
         # Given Badlands' mesh, determine if each particle in 'volume' is above
         # (False) or below (True) it.
 
@@ -204,99 +587,46 @@ class SPM(object):
         # TODO: we only support air/sediment layers right now; erodibility
         # layers are not implemented
 
-        if rank == 0:
-            known_xy = self.badlands_model.recGrid.tinMesh['vertices']*self.scaleDIM  # points that we have known elevation for
-            known_z = self.badlands_model.elevation*self.scaleDIM  # elevation for those points
-        else:
-            known_xy = None
-            known_z = None
-
-        known_xy = comm.bcast(known_xy, root=0)
-        known_z = comm.bcast(known_z, root=0)
-
-        comm.Barrier()
-
-        volume = self.swarm.particleCoordinates.data
-
-        interpolate_xy = volume[:, [0, 1]]
-
-        # NOTE: we're using nearest neighbour interpolation. This should be
-        # sufficient as Badlands will normally run at a much higher resolution
-        # than Underworld. 'linear' interpolation is much, much slower.
-        interpolate_z = griddata(points=known_xy, values=known_z, xi=interpolate_xy, method='nearest')
+        # NOTE: we're using nearest neighbour interpolation in 3D (closest
+        # node of the Badlands grid). This should be sufficient as Badlands
+        # will normally run at a much higher resolution than Underworld.
+        interpolate_z = surface.elevation(volume)
 
         # True for sediment, False for air
-        flags = volume[:, 2] < interpolate_z
+        flags = volume[:, -1] < interpolate_z
 
         return flags
 
-    def _update_material_types(self):
+    def _update_material_types(self, dt=None):
+
+        surface = self._get_surface()
+
+        # Only the particles close to the surface can change state. All the
+        # particles are checked when the previous surface is unknown or
+        # after a change of the swarm or of the materials. The band
+        # selection communicates, the decision must be the same on all the
+        # processors.
+        full = comm.allreduce(self._checkAll, op=MPI.LOR)
+        if dt is None or self._surface is None or full:
+            particles = np.arange(self.swarm.particleLocalCount)
+        else:
+            particles = self._band_particles(surface, dt)
+        self._surface = surface
+        self._checkAll = False
 
         # What do the materials (in air/sediment terms) look like now?
-        if self.mesh.dim == 3:
-            material_flags = self._determine_particle_state()
-        if self.mesh.dim == 2:
-            material_flags = self._determine_particle_state_2D()
+        volume = self.swarm.particleCoordinates.data[particles]
+        material_flags = self._determine_particle_state(surface, volume)
 
         # If any materials changed state, update the Underworld material types
         mi = self.material_index.data
+        isAir = np.isin(mi[particles, 0], self.airIndex)
 
         # convert air to sediment
-        for air_material in self.airIndex:
-            sedimented_mask = np.logical_and(np.in1d(mi, air_material), material_flags)
-            mi[sedimented_mask] = self.sedimentIndex
+        mi[particles[isAir & material_flags]] = self.sedimentIndex
 
         # convert sediment to air
-        for air_material in self.airIndex:
-            eroded_mask = np.logical_and(~np.in1d(mi, air_material), ~material_flags)
-            mi[eroded_mask] = self.airIndex[0]
-
-    def _inject_badlands_displacement(self, time, dt, disp, sigma):
-        """
-        Takes a plane of tracer points and their DISPLACEMENTS in 3D over time
-        period dt applies a gaussian filter on it. Injects it into Badlands as 3D
-        tectonic movement.
-        """
-
-        # The Badlands 3D interpolation map is the displacement of each DEM
-        # node at the end of the time period relative to its starting position.
-        # If you start a new displacement file, it is treated as starting at
-        # the DEM starting points (and interpolated onto the TIN as it was at
-        # that tNow).
-
-
-        # kludge; don't keep adding new entries
-        if self._disp_inserted:
-            self.badlands_model.force.T_disp[0, 0] = time
-            self.badlands_model.force.T_disp[0, 1] = (time + dt)
-        else:
-            self.badlands_model.force.T_disp = np.vstack(([time, time + dt], self.badlands_model.force.T_disp))
-            self._disp_inserted = True
-
-        # Extent the velocity field in the third dimension
-        if self.mesh.dim == 2:
-            dispX = np.tile(disp[:,0], self.badlands_model.recGrid.rny)
-            dispY = np.zeros((self.badlands_model.recGrid.rnx * self.badlands_model.recGrid.rny,))
-            dispZ = np.tile(disp[:,1], self.badlands_model.recGrid.rny)
-
-            disp = np.zeros((self.badlands_model.recGrid.rnx * self.badlands_model.recGrid.rny,3))
-            disp[:,0] = dispX
-            disp[:,1] = dispY
-            disp[:,2] = dispZ
-
-        # Gaussian smoothing
-        if sigma>0:
-            dispX = np.copy(disp[:,0]).reshape(self.badlands_model.recGrid.rnx, self.badlands_model.recGrid.rny)
-            dispY = np.copy(disp[:,1]).reshape(self.badlands_model.recGrid.rnx, self.badlands_model.recGrid.rny)
-            dispZ = np.copy(disp[:,2]).reshape(self.badlands_model.recGrid.rnx, self.badlands_model.recGrid.rny)
-            smoothX = gaussian_filter(dispX, sigma)
-            smoothY = gaussian_filter(dispY, sigma)
-            smoothZ = gaussian_filter(dispZ, sigma)
-            disp[:,0] = smoothX.flatten()
-            disp[:,1] = smoothY.flatten()
-            disp[:,2] = smoothZ.flatten()
-
-        self.badlands_model.force.injected_disps = disp
+        mi[particles[~material_flags]] = self.airIndex[0]
 
     def _generate_flat_dem(self, minCoord, maxCoord, resolution, elevation, scale=1.):
         """
@@ -323,21 +653,21 @@ class SPM(object):
         """
 
         # Calculate number of nodes from required resolution.
-        nx = np.int((maxCoord[0] - minCoord[0]) / resolution)
-        ny = np.int((maxCoord[1] - minCoord[1]) / resolution)
+        nx = int((maxCoord[0] - minCoord[0]) / resolution)
+        ny = int((maxCoord[1] - minCoord[1]) / resolution)
 
         if self.mesh.dim == 2:
             minCoord = (minCoord[0], minCoord[0])
             maxCoord = (maxCoord[0], maxCoord[0])
             ny = nx
 
-        items = []
-        # FIXME: there should be a fast numpy way to do this
-        for y in np.linspace(minCoord[1]/scale, maxCoord[1]/scale, ny):
-            for x in np.linspace(minCoord[0]/scale, maxCoord[0]/scale, nx):
-                items.append([x, y, elevation/scale])
+        x = np.linspace(minCoord[0]/scale, maxCoord[0]/scale, nx)
+        y = np.linspace(minCoord[1]/scale, maxCoord[1]/scale, ny)
 
         # NOTE: Badlands uses the difference in X coord of the first two points to determine the resolution.
         # This is something we should fix.
-        # This is why we loop in y/x order instead of x/y order.
-        return np.array(items)
+        # This is why the points are ordered in y/x order (x varies fastest)
+        # instead of x/y order.
+        x, y = np.meshgrid(x, y)
+        return np.column_stack((x.ravel(), y.ravel(),
+                                np.full(x.size, elevation/scale)))
@@ -4,28 +4,105 @@ from __future__ import print_function,  absolute_import
 # romain.beucher@unimelb.edu.au
 import numpy as np
 from mpi4py import MPI
+from UWGeodynamics._visugrid import _evaluate_local, _in_box
 
 comm = MPI.COMM_WORLD
 
+
+class SurfaceVelocities(object):
+    """ Sample a velocity field at the Badlands surface points
+
+    The points are located once: the local processor remembers the points
+    it owns for the current mesh geometry and only evaluates those at the
+    following calls, in a single evaluation. The values and the counts are
+    combined in one reduction. Points that have moved out of their owning
+    domain (the surface points move vertically) are found by a second pass
+    restricted to the points not found by any processor. The mesh
+    geometry is tracked with the mesh deformation counter (geometryId) when
+    the mesh provides one.
+
+    Notes
+    -----
+    Calls must be made collectively by all processes.
+    """
+
+    def __init__(self, velocityField):
+        self.velocityField = velocityField
+        self._owned = None
+        self._state = None
+        self._geometry = None
+        self._geometryId = 0
+
+    def _geometry_state(self):
+        """ Counter of the mesh deformations, identical on all the
+        processors"""
+        mesh = self.velocityField.mesh
+        geometryId = getattr(mesh, "geometryId", None)
+        if geometryId is None:
+            # Meshes without a deformation counter are hashed
+            geometry = hash(np.asarray(mesh.data).tobytes())
+            if geometry != self._geometry:
+                self._geometry = geometry
+                self._geometryId += 1
+            geometryId = self._geometryId
+        return comm.allreduce(geometryId, op=MPI.MAX)
+
+    def _sample(self, points, candidates, values):
+        """ Evaluate the points candidates found locally, store the
+        velocities and a count in values, return the points found"""
+        mesh = self.velocityField.mesh
+        dim = points.shape[1]
+        minCoord = mesh.data.min(axis=0)
+        maxCoord = mesh.data.max(axis=0)
+        candidates = candidates[_in_box(points[candidates],
+                                        minCoord, maxCoord)]
+        result, mask = _evaluate_local(self.velocityField,
+                                       points[candidates])
+        found = candidates[mask]
+        if found.size:
+            values[found, :dim] = result[mask]
+            values[found, dim] = 1.0
+        return found
+
+    def __call__(self, surfacePoints):
+        points = np.asarray(surfacePoints, dtype="float")
+        dim = points.shape[1]
+        state = (points.shape, self._geometry_state())
+        # The points are located again on all the processors as soon as
+        # one of them needs it.
+        reset = comm.allreduce(self._owned is None or state != self._state,
+                               op=MPI.LOR)
+        if reset:
+            self._owned = None
+        self._state = state
+
+        local = np.zeros((len(points), dim + 1))
+        if self._owned is None:
+            candidates = np.arange(len(points))
+        else:
+            candidates = self._owned
+        owned = [self._sample(points, candidates, local)]
+
+        # reduce local arrays into global_array
+        total = np.zeros_like(local)
+        comm.Allreduce(local, total)
+
+        missing = np.where(total[:, dim] == 0)[0]
+        if not reset and missing.size:
+            # reset and the counts are known by all the processors, the
+            # second pass is done (or not) collectively.
+            local = np.zeros_like(local)
+            owned.append(self._sample(points, missing, local))
+            extra = np.zeros_like(local)
+            comm.Allreduce(local, extra)
+            total += extra
+
+        self._owned = np.unique(np.concatenate(owned))
+
+        # Points found by several processors are averaged
+        return total[:, :dim] / total[:, dim:]
+
+
 def get_UW_velocities(surfacePoints, velocityField):
 
-    local_top_vy = np.zeros_like(surfacePoints)
-    global_top_vy = np.zeros_like(surfacePoints)
-    local_counts = np.zeros_like(surfacePoints)
-    global_counts = np.zeros_like(surfacePoints)
-
-    for i, coords in enumerate(surfacePoints):
-        try:
-            local_top_vy[i] = velocityField.evaluate(np.array([coords]))[0]
-            local_counts[i] += 1
-        except ValueError:
-            pass
-
-    # reduce local arrays into global_array
-    comm.Allreduce(local_top_vy, global_top_vy)
-    comm.Allreduce(local_counts, global_counts)
-       
-    global_top_vy /= global_counts
-
-    # Calculate and return sep velocities
-    return global_top_vy
+    return SurfaceVelocities(velocityField)(surfacePoints)
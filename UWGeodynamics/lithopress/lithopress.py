@@ -4,6 +4,7 @@ from __future__ import print_function,  absolute_import
 import underworld as uw
 import numpy as np
 from mpi4py import MPI
+from ..Underworld_extended import get_structured_topology
 
 comm = MPI.COMM_WORLD
 size = comm.Get_size()
@@ -13,6 +14,35 @@ supported_elem_mesh = ["Q1", "Q2"]
 supported_elem_subMesh = ["DQ1", "DQ0"]
 
 
+def _local_block(elements, nodes):
+    """ Check that the local elements form a block covered by the nodes
+
+    Parameters
+    ----------
+
+    elements : structured (I, J[, K]) indices of the local elements
+    nodes : structured (I, J[, K]) indices of the local + shadow nodes
+
+    Returns
+    -------
+
+    The lower and upper element indices of the block and the mask of the
+    nodes lying in the block, or None if the elements do not form a block
+    or if the nodes do not cover it.
+    """
+    lower = np.array([idx.min() for idx in elements])
+    upper = np.array([idx.max() for idx in elements])
+
+    inside = np.all([(idx >= low) & (idx <= high + 1)
+                     for idx, low, high in zip(nodes, lower, upper)],
+                    axis=0)
+
+    if (np.prod(upper - lower + 1) == elements[0].size and
+       np.count_nonzero(inside) == np.prod(upper - lower + 2)):
+        return lower, upper, inside
+    return None
+
+
 class LithostaticPressure(object):
     """Class that calculates the lithostatic pressure field based on
     material densities.
@@ -27,6 +57,12 @@ class LithostaticPressure(object):
 
     tuple: lithostatic pressure field, pressure at the bottom of the
     model
+
+    On Q1/dQ0 meshes, the pressure is integrated along the columns of
+    elements: each processor only handles its local elements and the
+    partial sums are exchanged between the processors sharing the same
+    columns (prefix scan on a column communicator). Other configurations
+    use a global reduction of the whole mesh.
     """
 
     def __init__(self, mesh, densityFn, gravity):
@@ -38,6 +74,7 @@ class LithostaticPressure(object):
         # Create Utilities
         self.DensityVar = uw.mesh.MeshVariable(self.mesh, nodeDofCount=1)
         self.projectorDensity = uw.utils.MeshVariable_Projection(self.DensityVar, self._densityFn, type=0 )
+        self._layout = False
 
         if not self.mesh.elementType.upper() in supported_elem_mesh:
             raise ValueError("Unsupported element: {0}".format(self.mesh.elementType))
@@ -47,6 +84,11 @@ class LithostaticPressure(object):
 
     def solve(self):
 
+        self.projectorDensity.solve()
+
+        if self._column_layout():
+            return self._lithoPressureColumns()
+
         # 2D case
         if self.mesh.dim == 2:
             return self._lithoPressure2D()
@@ -54,9 +96,138 @@ class LithostaticPressure(object):
         if self.mesh.dim == 3:
             return self._lithoPressure3D()
 
-    def _lithoPressure2D(self):
+    def _column_layout(self):
+        """ Describe the local block of elements and the column
+        communicator used by the column-distributed calculation.
+
+        Returns None on all the processors if the mesh or its
+        decomposition do not allow the column-distributed calculation.
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        if self._layout is not False:
+            return self._layout
+
+        mesh = self.mesh
+        subMesh = mesh.subMesh
+        extent = None
+        block = None
+
+        if (mesh.elementType.upper() == "Q1" and
+           subMesh.elementType.upper() == "DQ0" and subMesh.nodesLocal):
+
+            topology = get_structured_topology(mesh)
+
+            # The local elements must form a block covered by the nodes
+            # (local + shadow)
+            elements = [idx[:subMesh.nodesLocal]
+                        for idx in topology.element_indices]
+            block = _local_block(elements, topology.node_indices)
+
+        if block is not None:
+            lower, upper, inside = block
+            extent = (tuple(lower[:-1]), tuple(upper[:-1]))
+
+        # Group the processors sharing the same columns. Within a group,
+        # processors are ordered from the top to the bottom of the mesh.
+        extents = comm.allgather(extent)
+        if any([val is None for val in extents]):
+            self._layout = None
+            return self._layout
+
+        color = sorted(set(extents)).index(extent)
+        colcomm = comm.Split(color, -int(lower[-1]))
+
+        # The processors of a group must cover all the layers
+        layers = colcomm.allreduce(int(upper[-1] - lower[-1] + 1))
+        if not comm.allreduce(layers == mesh.elementRes[-1], op=MPI.LAND):
+            colcomm.Free()
+            self._layout = None
+            return self._layout
+
+        self.PressureVar = uw.mesh.MeshVariable(subMesh, nodeDofCount=1)
+        self._layout = {
+            "comm": colcomm,
+            "lower": lower,
+            "shape": tuple((upper - lower + 2)[::-1]),
+            "elements": tuple([idx - low for idx, low in
+                               zip(elements, lower)][::-1]),
+            "inside": inside,
+            "nodes": tuple([idx[inside] - low for idx, low in
+                            zip(topology.node_indices, lower)][::-1])}
+        return self._layout
+
+    def _lithoPressureColumns(self):
+
+        layout = self._layout
+        mesh = self.mesh
+        lower = layout["lower"]
+
+        # Load the block of nodes surrounding the local elements
+        # (arrays are indexed K, J, I)
+        self.DensityVar.syncronise()
+        z = np.zeros(layout["shape"])
+        density = np.zeros(layout["shape"])
+        z[layout["nodes"]] = mesh.data[layout["inside"], -1]
+        density[layout["nodes"]] = self.DensityVar.data[layout["inside"], 0]
+
+        if mesh.dim == 2:
+            # Top Left - Bottom Left, Top Right - Bottom Right
+            dy = (np.abs(z[1:, :-1] - z[:-1, :-1]) +
+                  np.abs(z[1:, 1:] - z[:-1, 1:])) / 2.
+            densityTop = (density[1:, :-1] + density[1:, 1:]) / 2.0
+            densityBot = (density[:-1, :-1] + density[:-1, 1:]) / 2.0
+        else:
+            dy = ((z[1:, :-1, :-1] + z[1:, 1:, :-1] +
+                   z[1:, 1:, 1:] + z[1:, :-1, 1:]) / 4.0 -
+                  (z[:-1, :-1, :-1] + z[:-1, 1:, :-1] +
+                   z[:-1, 1:, 1:] + z[:-1, :-1, 1:]) / 4.0)
+            densityTop = (density[1:, :-1, :-1] + density[1:, 1:, :-1] +
+                          density[1:, 1:, 1:] + density[1:, :-1, 1:]) / 4.0
+            densityBot = (density[:-1, :-1, :-1] + density[:-1, 1:, :-1] +
+                          density[:-1, 1:, 1:] + density[:-1, :-1, 1:]) / 4.0
+
+        # Pressure from the top and bottom halves of the elements.
+        EpressureTop = self.gravity * dy / 2.0 * densityTop
+        EpressureBot = self.gravity * dy / 2.0 * densityBot
+        Epressure = EpressureTop + EpressureBot
+
+        # Pressure from the elements above, within the local block...
+        above = np.cumsum(Epressure[::-1], axis=0)[::-1] - Epressure
+        totals = Epressure.sum(axis=0)
+
+        # ... and from the processors above.
+        colcomm = layout["comm"]
+        offset = np.zeros_like(totals)
+        colcomm.Exscan(totals, offset, op=MPI.SUM)
+        if colcomm.rank == 0:
+            offset[...] = 0.
+
+        Tpressure = EpressureTop + above + offset
+
+        # Assemble the pressure at the bottom of the model from the
+        # processors holding the base of the columns.
+        patch = None
+        if lower[-1] == 0:
+            patch = (tuple(lower[:-1]), offset + totals)
+
+        bottom = np.zeros(tuple(mesh.elementRes[:-1])[::-1])
+        for item in comm.allgather(patch):
+            if item is None:
+                continue
+            low, values = item
+            bottom[tuple([slice(l, l + n) for l, n in
+                          zip(low[::-1], values.shape)])] = values
+
+        nodesLocal = mesh.subMesh.nodesLocal
+        self.PressureVar.data[:nodesLocal, 0] = Tpressure[layout["elements"]]
+        self.PressureVar.syncronise()
+
+        return np.copy(self.PressureVar.data), bottom
 
-        self.projectorDensity.solve()
+    def _lithoPressure2D(self):
 
         # Get Dimension of the global domain
         ncol, nrow = self.mesh.elementRes
@@ -81,11 +252,11 @@ class LithostaticPressure(object):
 
         # Get the global ids, note that we must get rid of the shadow nodes
         all_nodes = self.mesh.subMesh.data_nodegId  # local + shadow
-        node_gids = self.mesh.data_nodegId[:self.mesh.nodesLocal]
 
         # Get an I,J representation of the node coordinates
-        Jpositions = (node_gids.astype("float") / (ncol + 1)).astype("int")
-        Ipositions = node_gids - Jpositions * (ncol + 1)
+        Ipositions, Jpositions = [
+            idx[:self.mesh.nodesLocal]
+            for idx in get_structured_topology(self.mesh).node_indices]
 
         # Get local domain data
         local_y[Jpositions, Ipositions] = self.mesh.data[:self.mesh.nodesLocal, 1][:, np.newaxis]
@@ -125,8 +296,6 @@ class LithostaticPressure(object):
 
     def _lithoPressure3D(self):
 
-        self.projectorDensity.solve()
-
         # Get Dimension of the global domain
         nx, ny, nz = self.mesh.elementRes
         if self.mesh.elementType == "Q2":
@@ -147,13 +316,11 @@ class LithostaticPressure(object):
 
         # Get the global ids, note that we must get rid of the shadow nodes
         all_nodes = self.mesh.subMesh.data_nodegId # local + shadow
-        node_gids = self.mesh.data_nodegId[:self.mesh.nodesLocal]
 
-        GlobalIndices3d = np.arange(self.mesh.nodesGlobal).reshape(nz + 1, ny + 1, nx + 1)
-        # Get an I,J representation of the node coordinates
-        Ipositions = np.array([int(np.where(GlobalIndices3d == i)[2]) for i in node_gids])
-        Jpositions = np.array([int(np.where(GlobalIndices3d == i)[1]) for i in node_gids])
-        Kpositions = np.array([int(np.where(GlobalIndices3d == i)[0]) for i in node_gids])
+        # Get an I,J,K representation of the node coordinates
+        Ipositions, Jpositions, Kpositions = [
+            idx[:self.mesh.nodesLocal]
+            for idx in get_structured_topology(self.mesh).node_indices]
 
         # Get local domain data
         local_z[Kpositions, Jpositions, Ipositions] = self.mesh.data[:self.mesh.nodesLocal, 2]
@@ -1,6 +1,7 @@
 __version__ = "0.1"
 
 from ._scaling import nonDimensionalize
+from ._scaling import nonDimensionalize_array
 from ._scaling import Dimensionalize
 from ._coefficients import COEFFICIENTS
 from ._utils import UnitRegistry
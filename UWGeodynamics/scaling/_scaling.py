@@ -1,11 +1,27 @@
 # Utilities to convert between dimensional and non-dimensional values.
 # Romain BEUCHER, December 2016
 from __future__ import print_function,  absolute_import
+from numbers import Number
+import numpy as np
 import underworld as uw
 from ._coefficients import COEFFICIENTS as scaling
 from ._utils import u
 
 
+# Scaling factors cached for the current state of the scaling
+# coefficients: units -> (scale, offset), None for unitless values
+_cache = {"state": None, "nd": dict(), "dim": dict()}
+
+
+def _get_cache(name):
+    state = (id(scaling), scaling.version)
+    if state != _cache["state"]:
+        _cache["state"] = state
+        _cache["nd"] = dict()
+        _cache["dim"] = dict()
+    return _cache[name]
+
+
 def nonDimensionalize(dimValue):
     """
     This function uses pint object to perform a dimension analysis and
@@ -39,16 +55,84 @@ def nonDimensionalize(dimValue):
 
     # Get a scaled value:
     gravity = nonDimensionalize(9.81 * u.meter / u.second**2)
-    """
-    global scaling
 
+    The conversion is affine in the magnitude (offset units such as degC).
+    Its scale and offset are computed once per units and cached until the
+    scaling coefficients change.
+    """
     try:
-        val = dimValue.unitless
-        if val:
-            return dimValue
+        scale, offset, unitless = _get_nd_factors(dimValue)
     except AttributeError:
         return dimValue
+    except TypeError:
+        # Units that can not be cached
+        if dimValue.unitless:
+            return dimValue
+        return _nonDimensionalize(dimValue)
+
+    if unitless:
+        return dimValue
+    if offset:
+        return dimValue.magnitude * scale + offset
+    return dimValue.magnitude * scale
+
 
+def nonDimensionalize_array(values):
+    """
+    Non-dimensionalise a set of values in bulk and return them as a numpy
+    array of floats.
+
+    values can be a Quantity (scalar or array), a numpy array or a number
+    (considered non-dimensional), or a nested list / tuple of those,
+    e.g. a list of (x, y) vertices. The scaling factors are computed once
+    per units (see nonDimensionalize), the magnitudes are then scaled
+    with numpy.
+
+    example:
+
+    coords = nonDimensionalize_array([(0. * u.km, 10. * u.km),
+                                      (50. * u.km, 10. * u.km)])
+    """
+    return np.asarray(_nonDimensionalize_values(values), dtype="float")
+
+
+def _nonDimensionalize_values(values):
+    if isinstance(values, u.Quantity):
+        scale, offset, _ = _get_nd_factors(values)
+        magnitude = values.magnitude
+        if np.ndim(magnitude):
+            magnitude = np.asarray(magnitude, dtype="float")
+        if offset:
+            return magnitude * scale + offset
+        return magnitude * scale
+
+    if isinstance(values, Number):
+        return values
+
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        return values
+
+    return [_nonDimensionalize_values(value) for value in values]
+
+
+def _get_nd_factors(dimValue):
+    """ Cached (scale, offset, unitless) of the non-dimensionalisation of
+    a quantity"""
+    cache = _get_cache("nd")
+    units = dimValue._units
+    if units not in cache:
+        if dimValue.unitless:
+            scale = u.Quantity(1.0, dimValue.units).to_base_units().magnitude
+            cache[units] = (scale, 0.0, True)
+        else:
+            offset = _nonDimensionalize(u.Quantity(0.0, dimValue.units))
+            scale = _nonDimensionalize(u.Quantity(1.0, dimValue.units))
+            cache[units] = (scale - offset, offset, False)
+    return cache[units]
+
+
+def _nonDimensionalize(dimValue):
+    """ Non-dimensionalise a quantity (uncached) """
     dimValue = dimValue.to_base_units()
 
     length = scaling["[length]"]
@@ -90,9 +174,33 @@ def nonDimensionalize(dimValue):
 
 
 def Dimensionalize(Value, units):
+    """
+    Convert a non-dimensional value (or a mesh / swarm variable) to a
+    quantity expressed in `units`.
+
+    The conversion is affine in the value (offset units such as degC).
+    Its scale and offset are computed once per units and cached until the
+    scaling coefficients change.
+    """
+    if not (isinstance(units, u.Unit) and
+            isinstance(Value, (Number, np.ndarray))):
+        return _Dimensionalize(Value, units)
+
+    cache = _get_cache("dim")
+    factors = cache.get(units)
+    if factors is None:
+        offset = _Dimensionalize(0.0, units).magnitude
+        scale = _Dimensionalize(1.0, units).magnitude
+        factors = cache[units] = (scale - offset, offset)
+
+    scale, offset = factors
+    if offset:
+        return u.Quantity(Value * scale + offset, units)
+    return u.Quantity(Value * scale, units)
 
-    global scaling
 
+def _Dimensionalize(Value, units):
+    """ Dimensionalise a value (uncached) """
     unit = (1.0 * units).to_base_units()
 
     length = scaling["[length]"]
@@ -30,6 +30,14 @@ def ensure_to_base_units(val):
 class TransformedDict(dict):  # dicts take a mapping or iterable as their optional first argument
     __slots__ = () # no __dict__ - that would be redundant
 
+    # Incremented each time a TransformedDict is modified (used to
+    # invalidate the cached scaling factors)
+    version = 0
+
+    @classmethod
+    def _modified(cls):
+        TransformedDict.version += 1
+
     @staticmethod # because this doesn't make sense as a global function.
     def _process_args(mapping=(), **kwargs):
         if hasattr(mapping, items):
@@ -43,23 +51,28 @@ class TransformedDict(dict):  # dicts take a mapping or iterable as their option
         return super(TransformedDict, self).__getitem__(ensure_lower(k))
 
     def __setitem__(self, k, v):
+        self._modified()
         return super(TransformedDict, self).__setitem__(ensure_lower(k), ensure_to_base_units(v))
 
     def __delitem__(self, k):
+        self._modified()
         return super(TransformedDict, self).__delitem__(ensure_lower(k))
 
     def get(self, k, default=None):
         return super(TransformedDict, self).get(ensure_lower(k), default)
 
     def setdefault(self, k, default=None):
+        self._modified()
         return super(TransformedDict, self).setdefault(ensure_lower(k), default)
 
     def pop(self, k, v=_RaiseKeyError):
+        self._modified()
         if v is _RaiseKeyError:
             return super(TransformedDict, self).pop(ensure_lower(k))
         return super(TransformedDict, self).pop(ensure_lower(k), v)
 
     def update(self, mapping=(), **kwargs):
+        self._modified()
         super(TransformedDict, self).update(self._process_args(mapping, **kwargs))
 
     def __contains__(self, k):
@@ -1,8 +1,8 @@
 from __future__ import print_function,  absolute_import
-import numpy as np
 import underworld as uw
 import underworld.function as fn
 from .scaling import nonDimensionalize as nd
+from .scaling import nonDimensionalize_array as nd_array
 
 
 class Shape(object):
@@ -39,8 +39,11 @@ class Polygon(Shape):
 
     def __init__(self, vertices):
         self.vertices = vertices
-        vertices = [(nd(x), nd(y)) for x, y in self.vertices]
-        self._fn = uw.function.shape.Polygon(np.array(vertices))
+        vertices = nd_array(self.vertices)
+        if vertices.ndim != 2 or vertices.shape[1] != 2:
+            raise ValueError("{0} must be a list of (x, y) "
+                             "vertices".format(self.vertices))
+        self._fn = uw.function.shape.Polygon(vertices)
 
 
 class HalfSpace(Shape):
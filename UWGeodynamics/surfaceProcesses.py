@@ -4,8 +4,10 @@ try:
     from .linkage import SPM
 except ImportError:
     pass
-import underworld.function as fn
+import numpy as np
+from mpi4py import MPI
 from .scaling import nonDimensionalize as nd
+from ._utils import SurfaceBand
 
 
 ABC = abc.ABCMeta('ABC', (object,), {})
@@ -35,22 +37,80 @@ class SurfaceProcesses(ABC):
     def solve(self, dt):
         pass
 
+    def _full_pass(self):
+        """ Return True when all the particles must be checked
+
+        Only the particles moving with the velocity field can cross the
+        surface between two updates. All the particles are checked on the
+        first call and when the swarm (swarm.stateId) or the materials have
+        changed otherwise than by a time step of the Model since the last
+        call (add_material, phase changes, restart...).
+
+        Notes
+        -----
+        This method must be called collectively by all processes: the
+        band selection communicates, all the processors must take the
+        same decision.
+        """
+        Model = self.Model
+        stateId = Model.swarm.stateId
+        state = (Model.swarm, Model._materialsVersion)
+        full = (self._bandState is None or state != self._bandState[0] or
+                stateId not in (self._bandState[1], Model._advectedState))
+        self._bandState = (state, stateId)
+        return MPI.COMM_WORLD.allreduce(full, op=MPI.LOR)
+
+    def _band_particles(self, dt):
+        """ Return the local particles that may have crossed the threshold
+        during the last time step. All the particles are returned on the
+        first call and after a change of the swarm or of the materials."""
+        swarm = self.Model.swarm
+        if self._band is None or self._band.swarm is not swarm:
+            self._band = SurfaceBand(self.Model.mesh, swarm)
+        if self._full_pass():
+            return np.arange(swarm.particleLocalCount)
+        threshold = nd(self.threshold)
+        margin = self._band.displacement(self.Model.velocityField, dt)
+        return self._band.select(threshold - margin, threshold + margin)
+
 
 class Badlands(SurfaceProcesses):
     """ A wrapper class for Badlands Linkage"""
 
     def __init__(self, airIndex,
                  sedimentIndex, XML, resolution, checkpoint_interval,
-                 surfElevation=0., verbose=True, Model=None, restartFolder=None,
-                 restartStep=None, timeField=None, surfaceTracers=None):
-        try:
-
-            import pyBadlands
-
-        except ImportError :
-            raise ImportError("""pyBadlands import as failed. Please check your
-                              installation, PYTHONPATH and PATH environment
-                              variables""")
+                 surfElevation=0., verbose=True, Model=None,
+                 restartFolder=None, restartStep=None, timeField=None,
+                 surfaceTracers=None,
+                 lagged=False, driver=None):
+        """
+        Parameters
+        ----------
+
+        lagged : if True, Badlands runs in a separate MPI process spawned
+                 by rank 0 (MPI.COMM_SELF.Spawn) while Underworld proceeds
+                 with the next time step.
+                 The materials are updated from the Badlands surface at the
+                 next call to solve (one time step lag), before the
+                 checkpoints and at the end of Model.run_for.
+                 This requires an MPI library and a launcher supporting
+                 dynamic processes (MPI_Comm_spawn), which many batch
+                 launchers do not. If the process cannot be spawned, a
+                 warning is issued and Badlands runs without lag.
+        driver : function building the Badlands driver (see
+                 linkage.BadlandsDriver), default builds the pyBadlands
+                 model from the XML input. It must be picklable (module
+                 level function or class) when lagged is True.
+        """
+        if driver is None:
+            try:
+
+                import pyBadlands
+
+            except ImportError :
+                raise ImportError("pyBadlands import as failed. Please "
+                                  "check your installation, PYTHONPATH and "
+                                  "PATH environment variables")
 
         self.airIndex = airIndex
         self.sedimentIndex = sedimentIndex
@@ -62,6 +122,8 @@ class Badlands(SurfaceProcesses):
         self.restartFolder = restartFolder
         self.restartStep = restartStep
         self.surfaceTracers = surfaceTracers
+        self.lagged = lagged
+        self.driver = driver
 
         self.timeField = timeField
         self.Model = Model
@@ -72,19 +134,45 @@ class Badlands(SurfaceProcesses):
         self.swarm = self._Model.swarm
         self.materialField = self._Model.materialField
 
+        if self.lagged:
+            # No checkpoint may be written in the background while the
+            # Badlands process is started
+            self._Model.wait_for_checkpoints()
+
         self._BadlandsModel = SPM(self.mesh, self.velocityField, self.swarm,
                                   self.materialField, self.airIndex,
                                   self.sedimentIndex,
                                   self.XML, nd(self.resolution),
                                   nd(self.checkpoint_interval),
                                   nd(self.surfElevation), self.verbose,
-                                  self.restartFolder, self.restartStep)
+                                  self.restartFolder, self.restartStep,
+                                  self.lagged, self.driver)
+        self._bandState = None
         return
 
+    def _check_band(self):
+        if self._full_pass():
+            self._BadlandsModel.reset_band()
+
     def solve(self, dt):
+        self._check_band()
         self._BadlandsModel.solve(dt)
         return
 
+    def synchronize(self):
+        """ Wait for a lagged Badlands run and apply its surface
+
+        Notes
+        -----
+        This method must be called collectively by all processes.
+        """
+        self._check_band()
+        self._BadlandsModel.synchronize()
+
+    def close(self):
+        """ Stop the Badlands process (lagged coupling) """
+        self._BadlandsModel.close()
+
 
 class ErosionThreshold(SurfaceProcesses):
 
@@ -101,31 +189,30 @@ class ErosionThreshold(SurfaceProcesses):
 
     def _init_model(self):
 
-        materialField = self.Model.materialField
+        self._airIndices = [material.index for material in self.air]
+        self._band = None
+        self._bandState = None
 
-        materialMap = {}
-        for material in self.air:
-            materialMap[material.index] = 1.0
+    def _erode(self, particles):
 
-        isAirMaterial = fn.branching.map(fn_key=materialField,
-                                         mapping=materialMap,
-                                         fn_default=0.0)
+        material = self.Model.materialField.data
+        coords = self.Model.swarm.particleCoordinates.data
 
-        belowthreshold = [(((isAirMaterial < 0.5) & (fn.input()[1] > nd(self.threshold))), self.air[0].index),
-                          (True, materialField)]
-
-        self._fn = fn.branching.conditional(belowthreshold)
+        isAir = np.isin(material[particles, 0], self._airIndices)
+        above = coords[particles, -1] > nd(self.threshold)
+        material[particles[~isAir & above]] = self.air[0].index
 
     def solve(self, dt):
 
         if not self.Model:
             raise ValueError("Model is not defined")
 
-        self.Model.materialField.data[:] = self._fn.evaluate(self.Model.swarm)
+        self._erode(self._band_particles(dt))
         if self.surfaceTracers:
             if self.surfaceTracers.swarm.particleCoordinates.data.size > 0:
                 coords = self.surfaceTracers.swarm.particleCoordinates
-                coords.data[coords.data[:, -1] > nd(self.threshold), -1] = nd(self.threshold)
+                threshold = nd(self.threshold)
+                coords.data[coords.data[:, -1] > threshold, -1] = threshold
         return
 
 
@@ -146,44 +233,40 @@ class SedimentationThreshold(SurfaceProcesses):
 
     def _init_model(self):
 
-        materialField = self.Model.materialField
-
-        materialMap = {}
-        for material in self.air:
-            materialMap[material.index] = 1.0
+        self._airIndices = [material.index for material in self.air]
+        self._band = None
+        self._bandState = None
 
-        isAirMaterial = fn.branching.map(fn_key=materialField,
-                                         mapping=materialMap,
-                                         fn_default=0.0)
+    def _sediment(self, particles):
 
-        belowthreshold = [(((isAirMaterial > 0.5) & (fn.input()[1] < nd(self.threshold))), 0.),
-                          (True, 1.)]
+        material = self.Model.materialField.data
+        coords = self.Model.swarm.particleCoordinates.data
 
-        self._change_material = fn.branching.conditional(belowthreshold)
+        isAir = np.isin(material[particles, 0], self._airIndices)
+        below = coords[particles, -1] < nd(self.threshold)
+        sedimented = particles[isAir & below]
 
-        conditions = [(self._change_material < 0.5, self.sediment[0].index),
-                      (True, materialField)]
+        if self.timeField:
+            self.timeField.data[sedimented] = 0.
 
-        self._fn = fn.branching.conditional(conditions)
+        material[sedimented] = self.sediment[0].index
 
     def solve(self, dt):
 
         if not self.Model:
             raise ValueError("Model is not defined")
 
-        if self.timeField:
-            fn = self._change_material * self.timeField
-            self.timeField.data[...] = fn.evaluate(self.Model.swarm)
-
-        self.Model.materialField.data[:] = self._fn.evaluate(self.Model.swarm)
+        self._sediment(self._band_particles(dt))
 
         if self.surfaceTracers:
             if self.surfaceTracers.swarm.particleCoordinates.data.size > 0:
                 coords = self.surfaceTracers.swarm.particleCoordinates
-                coords.data[coords.data[:, -1] < nd(self.threshold), -1] = nd(self.threshold)
+                threshold = nd(self.threshold)
+                coords.data[coords.data[:, -1] < threshold, -1] = threshold
 
 
-class ErosionAndSedimentationThreshold(SedimentationThreshold, ErosionThreshold):
+class ErosionAndSedimentationThreshold(SedimentationThreshold,
+                                       ErosionThreshold):
 
     def __init__(self, air=None, sediment=None,
                  threshold=None, timeField=None,
@@ -205,5 +288,16 @@ class ErosionAndSedimentationThreshold(SedimentationThreshold, ErosionThreshold)
 
     def solve(self, dt):
 
-        ErosionThreshold.solve(self, dt)
-        SedimentationThreshold.solve(self, dt)
+        if not self.Model:
+            raise ValueError("Model is not defined")
+
+        particles = self._band_particles(dt)
+        self._erode(particles)
+        self._sediment(particles)
+
+        if self.surfaceTracers:
+            if self.surfaceTracers.swarm.particleCoordinates.data.size > 0:
+                coords = self.surfaceTracers.swarm.particleCoordinates
+                threshold = nd(self.threshold)
+                coords.data[coords.data[:, -1] > threshold, -1] = threshold
+                coords.data[coords.data[:, -1] < threshold, -1] = threshold
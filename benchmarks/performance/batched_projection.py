@@ -0,0 +1,94 @@
+"""
+Benchmark: projection of the Model swarm fields on the mesh with one
+MeshVariable_Projection per field versus the BatchedProjector shared by
+all the fields projected on the same mesh.
+
+Two cases are timed:
+    per-field : each field is projected by its own MeshVariable_Projection
+    batched   : all the fields are projected together by the
+                BatchedProjector of the Model mesh
+
+The maximum difference between the per-field and batched projections is
+also reported.
+
+Usage:
+    mpirun -np 4 python batched_projection.py
+"""
+from __future__ import print_function
+import time
+import numpy as np
+import underworld as uw
+import UWGeodynamics as GEO
+from mpi4py import MPI
+
+u = GEO.UnitRegistry
+
+fields = ["materialField", "plasticStrain", "meltField", "timeField",
+          "_viscosityField", "_densityField"]
+
+
+def build_model(resolution):
+    Model = GEO.Model(elementRes=resolution,
+                      minCoord=(0. * u.kilometer, 0. * u.kilometer),
+                      maxCoord=(400. * u.kilometer, 100. * u.kilometer))
+    for index in range(4):
+        shape = GEO.shapes.Layer(top=(index + 1) * 25. * u.kilometer,
+                                 bottom=index * 25. * u.kilometer)
+        material = Model.add_material(name="Layer%i" % index, shape=shape)
+        material.density = 3000. * u.kilogram / u.metre**3
+        material.viscosity = 1e21 * u.pascal * u.second
+    for name in fields:
+        data = getattr(Model, name).data
+        data[...] = np.random.random(data.shape) * 10
+    return Model
+
+
+def projected_name(name):
+    return "_proj" + name.lstrip("_")[0].upper() + name.lstrip("_")[1:]
+
+
+def time_per_field(Model, repeat=3):
+    projectors = [uw.utils.MeshVariable_Projection(
+        getattr(Model, projected_name(name)), getattr(Model, name),
+        voronoi_swarm=Model.swarm, type=0) for name in fields]
+    timings = []
+    for _ in range(repeat):
+        uw.barrier()
+        start = time.time()
+        for projector in projectors:
+            projector.solve()
+        uw.barrier()
+        timings.append(time.time() - start)
+    reference = [np.copy(getattr(Model, projected_name(name)).data)
+                 for name in fields]
+    return min(timings), reference
+
+
+def time_batched(Model, repeat=3):
+    projector = Model._get_batched_projector(Model.mesh)
+    names = [projected_name(name)[1:] for name in fields]
+    timings = []
+    for _ in range(repeat):
+        uw.barrier()
+        start = time.time()
+        projector.solve(names)
+        uw.barrier()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    if uw.rank() == 0:
+        print("{0:>10} {1:>14} {2:>12} {3:>12}".format(
+            "mesh", "per-field (s)", "batched (s)", "max diff"))
+    for resolution in [(64, 16), (128, 32), (256, 64), (512, 128)]:
+        Model = build_model(resolution)
+        per_field, reference = time_per_field(Model)
+        batched = time_batched(Model)
+        diff = max([np.abs(getattr(Model, projected_name(name)).data -
+                           values).max()
+                    for name, values in zip(fields, reference)])
+        diff = MPI.COMM_WORLD.allreduce(diff, op=MPI.MAX)
+        if uw.rank() == 0:
+            print("{0:>10} {1:>14.4f} {2:>12.4f} {3:>12.2e}".format(
+                "%ix%i" % resolution, per_field, batched, diff))
@@ -0,0 +1,91 @@
+"""
+Benchmark: throughput and size of the checkpoint files for the different
+dataset storage options (see the checkpoint.* rcParams).
+
+Each configuration saves the fields and the swarm of the same model. The
+time reported is the time spent in Model.checkpoint_fields and
+Model.checkpoint_swarms, the size is the total size of the files written.
+
+Usage:
+    mpirun -np 4 python checkpoint_compression.py
+"""
+from __future__ import print_function
+import os
+import shutil
+import time
+import underworld as uw
+import UWGeodynamics as GEO
+
+u = GEO.UnitRegistry
+rcParams = GEO.rcParams
+
+configurations = [
+    ("contiguous", {}),
+    ("chunked", {"checkpoint.chunk.size": 65536}),
+    ("gzip", {"checkpoint.compression": "gzip",
+              "checkpoint.compression.level": 4}),
+    ("gzip-1", {"checkpoint.compression": "gzip",
+                "checkpoint.compression.level": 1}),
+    ("lzf", {"checkpoint.compression": "lzf"}),
+    ("gzip+float32", {"checkpoint.compression": "gzip",
+                      "checkpoint.float32.fields": ["velocityField",
+                                                    "pressureField",
+                                                    "strainRateField",
+                                                    "plasticStrain"]}),
+]
+
+
+def build_model(resolution):
+    Model = GEO.Model(elementRes=resolution,
+                      minCoord=(0. * u.kilometer, 0. * u.kilometer),
+                      maxCoord=(400. * u.kilometer, 100. * u.kilometer))
+    for index in range(4):
+        shape = GEO.shapes.Layer(top=(index + 1) * 25. * u.kilometer,
+                                 bottom=index * 25. * u.kilometer)
+        material = Model.add_material(name="Layer%i" % index, shape=shape)
+        material.density = 3000. * u.kilogram / u.metre**3
+        material.viscosity = 1e21 * u.pascal * u.second
+    Model.set_velocityBCs(left=[-1.0 * u.centimeter / u.year, None],
+                          right=[1.0 * u.centimeter / u.year, None],
+                          bottom=[None, 0.])
+    Model.solve()
+    return Model
+
+
+def directory_size(path):
+    return sum([os.path.getsize(os.path.join(path, filename))
+                for filename in os.listdir(path)])
+
+
+def time_checkpoint(Model, name, options, repeat=3):
+    outputDir = os.path.join("checkpoint_compression", name)
+    defaults = dict([(key, rcParams[key]) for key in options])
+    for key, value in options.items():
+        rcParams[key] = value
+    timings = []
+    for _ in range(repeat):
+        if uw.rank() == 0 and os.path.exists(outputDir):
+            shutil.rmtree(outputDir)
+        uw.barrier()
+        Model._mesh_saved = False
+        start = time.time()
+        Model.checkpoint_fields(checkpointID=0, outputDir=outputDir)
+        Model.checkpoint_swarms(checkpointID=0, outputDir=outputDir)
+        uw.barrier()
+        timings.append(time.time() - start)
+    for key, value in defaults.items():
+        rcParams[key] = value
+    return min(timings), directory_size(outputDir)
+
+
+if __name__ == "__main__":
+    Model = build_model((256, 64))
+    if uw.rank() == 0:
+        print("{0:>14} {1:>10} {2:>12} {3:>12}".format(
+            "configuration", "time (s)", "size (MB)", "MB/s"))
+    for name, options in configurations:
+        elapsed, size = time_checkpoint(Model, name, options)
+        size = size / 1024.**2
+        if uw.rank() == 0:
+            print("{0:>14} {1:>10.3f} {2:>12.2f} {3:>12.2f}".format(
+                name, elapsed, size, size / elapsed))
@@ -0,0 +1,52 @@
+"""
+Micro-benchmark: cost of nonDimensionalize and Dimensionalize with the
+cached scaling factors versus the uncached conversion (base units of the
+value and of the five scaling coefficients computed at each call).
+
+The cached conversions should be two orders of magnitude faster.
+
+Usage:
+    python scaling_cache.py
+"""
+from __future__ import print_function
+import time
+import UWGeodynamics as GEO
+from UWGeodynamics.scaling import _scaling
+
+u = GEO.UnitRegistry
+
+values = [9.81 * u.meter / u.second**2,
+          3300. * u.kilogram / u.metre**3,
+          1e21 * u.pascal * u.second,
+          1.0 * u.centimeter / u.year,
+          u.Quantity(25., u.degC)]
+units = [u.kilometer, u.megayears, u.pascal * u.second, u.degK]
+
+
+def time_calls(function, args, repeat=2000):
+    start = time.time()
+    for _ in range(repeat):
+        for arg in args:
+            function(*arg)
+    return (time.time() - start) / (repeat * len(args))
+
+
+if __name__ == "__main__":
+    scaling = GEO.scaling.COEFFICIENTS
+    scaling["[length]"] = 100. * u.kilometer
+    scaling["[time]"] = 1. * u.megayears
+    scaling["[mass]"] = (1e21 * u.pascal * u.second * 100. * u.kilometer *
+                         u.megayears)
+    scaling["[temperature]"] = 1330. * u.degK
+
+    print("{0:>20} {1:>14} {2:>14} {3:>10}".format(
+        "function", "uncached (us)", "cached (us)", "speedup"))
+    cases = [("nonDimensionalize", _scaling._nonDimensionalize,
+              _scaling.nonDimensionalize, [(val,) for val in values]),
+             ("Dimensionalize", _scaling._Dimensionalize,
+              _scaling.Dimensionalize, [(0.5, unit) for unit in units])]
+    for name, uncached, cached, args in cases:
+        slow = time_calls(uncached, args, repeat=50)
+        fast = time_calls(cached, args)
+        print("{0:>20} {1:>14.2f} {2:>14.2f} {3:>10.0f}".format(
+            name, slow * 1e6, fast * 1e6, slow / fast))
@@ -0,0 +1,56 @@
+"""
+Micro-benchmark: time needed to build the stress function graph
+(Model._stressFn) as a function of the number of materials.
+
+The build time should scale linearly with the number of materials.
+
+Usage:
+    python stress_function_build.py
+"""
+from __future__ import print_function
+import time
+import UWGeodynamics as GEO
+
+u = GEO.UnitRegistry
+
+
+def build_model(nmaterials):
+    Model = GEO.Model(elementRes=(16, 16),
+                      minCoord=(0. * u.kilometer, 0. * u.kilometer),
+                      maxCoord=(100. * u.kilometer, 100. * u.kilometer))
+    thickness = 100. / nmaterials
+    for index in range(nmaterials):
+        shape = GEO.shapes.Layer(top=(index + 1) * thickness * u.kilometer,
+                                 bottom=index * thickness * u.kilometer)
+        material = Model.add_material(name="Layer%i" % index, shape=shape)
+        material.density = 3000. * u.kilogram / u.metre**3
+        material.viscosity = 1e21 * u.pascal * u.second
+        material.plasticity = GEO.DruckerPrager(
+            cohesion=20. * u.megapascal,
+            cohesionAfterSoftening=2. * u.megapascal,
+            frictionCoefficient=0.5,
+            frictionAfterSoftening=0.1)
+        material.elasticity = GEO.Elasticity(
+            shear_modulus=1e10 * u.pascal,
+            observation_time=10000. * u.year)
+    return Model
+
+
+def time_build(Model, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        Model.invalidate_rheology()
+        start = time.time()
+        Model._stressFn
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    print("{0:>12} {1:>12} {2:>18}".format("materials", "time (s)",
+                                           "time / material"))
+    for nmaterials in [2, 4, 8, 16, 32, 64]:
+        Model = build_model(nmaterials)
+        elapsed = time_build(Model)
+        print("{0:>12} {1:>12.4f} {2:>18.6f}".format(
+            nmaterials, elapsed, elapsed / nmaterials))
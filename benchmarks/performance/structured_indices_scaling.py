@@ -0,0 +1,48 @@
+"""
+Benchmark: mapping of the node global ids to their structured (I, J, K)
+indices, as used by LithostaticPressure and LecodeIsostasy on 3D meshes.
+
+The previous implementation ran np.where over the whole global index
+array for each node (O(N^2)). It is only timed on a sample of nodes and
+extrapolated to the full mesh.
+
+Usage:
+    python structured_indices_scaling.py
+"""
+from __future__ import print_function
+import time
+import numpy as np
+from UWGeodynamics.Underworld_extended import structured_node_indices
+
+sample = 20
+
+
+def legacy_indices(node_gids, nx, ny, nz):
+    GlobalIndices3d = np.arange((nx + 1) * (ny + 1) * (nz + 1)).reshape(
+        nz + 1, ny + 1, nx + 1)
+    Ipositions = np.array([int(np.where(GlobalIndices3d == i)[2])
+                           for i in node_gids])
+    Jpositions = np.array([int(np.where(GlobalIndices3d == i)[1])
+                           for i in node_gids])
+    Kpositions = np.array([int(np.where(GlobalIndices3d == i)[0])
+                           for i in node_gids])
+    return Ipositions, Jpositions, Kpositions
+
+
+if __name__ == "__main__":
+    print("{0:>10} {1:>12} {2:>14} {3:>16}".format(
+        "mesh", "nodes", "new (s)", "legacy est. (s)"))
+    for n in [32, 64, 128, 256]:
+        nodes = (n + 1)**3
+        node_gids = np.arange(nodes)
+
+        start = time.time()
+        structured_node_indices(node_gids, (n, n, n), "Q1")
+        new = time.time() - start
+
+        start = time.time()
+        legacy_indices(node_gids[:sample], n, n, n)
+        legacy = (time.time() - start) / sample * nodes
+
+        print("{0:>10} {1:>12} {2:>14.4f} {3:>16.1f}".format(
+            "%i^3" % n, nodes, new, legacy))
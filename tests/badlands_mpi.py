@@ -0,0 +1,48 @@
+""" Lagged Badlands coupling on several processors
+
+Run with mpirun (see test_simple.test_lagged_badlands_coupling_mpi): the
+Badlands driver runs in a worker spawned by rank 0 while all the ranks run
+the Model. The materials must match the ones of the coupling without lag at
+the end of run_for. The script exits with a non zero status on failure.
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.abspath(os.path.join(TEST_DIR, os.pardir))
+sys.path.insert(0, PROJECT_DIR)
+
+import numpy as np
+from mpi4py import MPI
+from tests.test_simple import u, test_scaling, _badlands_coupled_model
+
+comm = MPI.COMM_WORLD
+
+
+def main():
+    test_scaling()
+    outputDir = tempfile.mkdtemp() if comm.rank == 0 else None
+    outputDir = comm.bcast(outputDir, root=0)
+    dt = 0.5 * u.megayear
+    try:
+        Model = _badlands_coupled_model(os.path.join(outputDir, "reference"),
+                                        False)
+        Model.run_for(nstep=2, dt=dt, restartStep=None)
+
+        lagged = _badlands_coupled_model(os.path.join(outputDir, "lagged"),
+                                         True)
+        lagged.run_for(nstep=2, dt=dt, restartStep=None)
+        success = np.array_equal(lagged.materialField.data,
+                                 Model.materialField.data)
+        lagged.surfaceProcesses.close()
+    finally:
+        comm.Barrier()
+        if comm.rank == 0:
+            shutil.rmtree(outputDir, ignore_errors=True)
+    return comm.allreduce(success, op=MPI.LAND)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -82,6 +82,17 @@ def test_shapes():
     material = Model.add_material(name="Material", shape=shape2)
     #material = Model.add_material(name="Material", shape=shape3)
 
+def test_polygon_vertices():
+    import pytest
+    with pytest.raises(ValueError):
+        GEO.shapes.Polygon(vertices=[(0. * u.kilometer, 0. * u.kilometer,
+                                      0. * u.kilometer),
+                                     (1. * u.kilometer, 0. * u.kilometer,
+                                      0. * u.kilometer),
+                                     (0. * u.kilometer, 1. * u.kilometer,
+                                      0. * u.kilometer)])
+
+
 def test_plastic_registry():
     pl = GEO.PlasticityRegistry()
     Material = GEO.Material(name="Material")
@@ -162,3 +173,1521 @@ def test_set_velocity_boundary_conditions_in_3D():
         front=[None, 0., None],
         back=[None, 0., None])
     assert(isinstance(velocityBCs, GEO._velocity_boundaries.VelocityBCs))
+
+
+def test_viscosity_function_cache():
+    Model = GEO.Model()
+    material = Model.add_material(name="Material",
+                                  shape=GEO.shapes.Layer(top=Model.top,
+                                                         bottom=Model.bottom))
+    material.viscosity = 1e21 * u.pascal * u.second
+    viscosityFn = Model._viscosityFn
+    assert(Model._viscosityFn is viscosityFn)
+    assert(not Model.rheology_dirty)
+
+    material.viscosity = 1e22 * u.pascal * u.second
+    assert(Model.rheology_dirty)
+    viscosityFn = Model._viscosityFn
+    assert(Model._viscosityFn is viscosityFn)
+
+    Model.invalidate_rheology()
+    assert(Model._viscosityFn is not viscosityFn)
+
+
+def test_stress_function_values():
+    import numpy as np
+    import underworld.function as fn
+    Model = GEO.Model(elementRes=(8, 8))
+    upper = Model.add_material(name="Upper",
+                               shape=GEO.shapes.Layer(top=Model.top,
+                                                      bottom=40. * u.km))
+    middle = Model.add_material(name="Middle",
+                                shape=GEO.shapes.Layer(top=40. * u.km,
+                                                       bottom=20. * u.km))
+    lower = Model.add_material(name="Lower",
+                               shape=GEO.shapes.Layer(top=20. * u.km,
+                                                      bottom=Model.bottom))
+    upper.viscosity = 1e21 * u.pascal * u.second
+    middle.viscosity = 1e22 * u.pascal * u.second
+    lower.viscosity = 1e23 * u.pascal * u.second
+    middle.elasticity = GEO.Elasticity(
+        shear_modulus=10e9 * u.pascal,
+        observation_time=10000. * u.year)
+
+    coords = Model.mesh.data
+    Model.velocityField.data[:, 0] = np.sin(np.pi * coords[:, 1])
+    Model.velocityField.data[:, 1] = coords[:, 0] * coords[:, 1]
+    Model._previousStressField.data[...] = np.random.RandomState(0).uniform(
+        size=Model._previousStressField.data.shape)
+
+    stress = Model._stressFn.evaluate(Model.swarm)
+    assert Model._stressFn is Model._stressFn
+
+    # Viscous and elastic parts computed separately
+    viscous = (2. * Model._viscosityFn * Model.strainRate).evaluate(
+        Model.swarm)
+    elastic = np.zeros_like(viscous)
+    isMiddle = Model.materialField.data[:, 0] == middle.index
+    middle.elasticity.viscosity = Model._viscosityFn
+    middle.elasticity.previousStress = Model._previousStressField
+    elastic[isMiddle] = middle.elasticity.elastic_stress.evaluate(
+        Model.swarm)[isMiddle]
+    assert np.any(elastic[isMiddle] != 0.)
+    assert np.allclose(stress, viscous + elastic)
+
+    # Previous construction: one branch per material
+    stressMap = dict([(material.index, Model._viscous_stressFn() +
+                       Model._elastic_stressFn)
+                      for material in Model.materials])
+    previous = fn.branching.map(fn_key=Model.materialField,
+                                mapping=stressMap)
+    assert np.allclose(stress, previous.evaluate(Model.swarm))
+
+
+def test_viscosity_function_cache_model_limiters():
+    Model = GEO.Model()
+    material = Model.add_material(name="Material",
+                                  shape=GEO.shapes.Layer(top=Model.top,
+                                                         bottom=Model.bottom))
+    material.viscosity = 1e21 * u.pascal * u.second
+    viscosityFn = Model._viscosityFn
+    assert(not Model.rheology_dirty)
+
+    # The material has no limiter, the model limits apply
+    Model.minViscosity = 1e19 * u.pascal * u.second
+    assert(Model.rheology_dirty)
+    assert(Model._viscosityFn is not viscosityFn)
+    viscosityFn = Model._viscosityFn
+
+    Model.maxViscosity = 1e24 * u.pascal * u.second
+    assert(Model.rheology_dirty)
+    assert(Model._viscosityFn is not viscosityFn)
+    viscosityFn = Model._viscosityFn
+
+    Model.stressLimiter = 300. * u.megapascal
+    assert(Model.rheology_dirty)
+    assert(Model._viscosityFn is not viscosityFn)
+
+
+def _thermal_model(outputDir=None):
+    Model = GEO.Model(elementRes=(8, 8), outputDir=outputDir)
+    material = Model.add_material(name="Material",
+                                  shape=GEO.shapes.Layer(top=Model.top,
+                                                         bottom=Model.bottom))
+    material.density = 3000. * u.kilogram / u.metre**3
+    material.viscosity = 1e21 * u.pascal * u.second
+    material.capacity = 1000. * u.joule / (u.kelvin * u.kilogram)
+    material.diffusivity = 1e-6 * u.metre**2 / u.second
+    Model.diffusivity = 1e-6 * u.metre**2 / u.second
+    Model.set_velocityBCs(left=[0., None], right=[0., None],
+                          top=[None, 0.], bottom=[None, 0.])
+    Model.set_temperatureBCs(top=293.15 * u.degK, bottom=1573.15 * u.degK)
+    Model.init_model()
+    return Model, material
+
+
+def test_advection_diffusion_system_reuse(tmpdir):
+    Model, material = _thermal_model(str(tmpdir))
+
+    # The system is reused across the steps
+    Model.run_for(nstep=1, dt=0.1 * u.megayear, restartStep=None)
+    system = Model._advdiffSystemCache
+    assert system is not None
+    Model.run_for(nstep=1, dt=0.1 * u.megayear, restartStep=None)
+    assert Model._advdiffSystemCache is system
+    assert Model._advdiffSystem is system
+
+    # Thermal boundary conditions
+    Model.set_temperatureBCs(top=273.15 * u.degK, bottom=1573.15 * u.degK)
+    assert Model._advdiffSystem is not system
+    system = Model._advdiffSystem
+    assert Model._advdiffSystem is system
+
+    # Diffusivity
+    material.diffusivity = 2e-6 * u.metre**2 / u.second
+    assert Model._advdiffSystem is not system
+    system = Model._advdiffSystem
+    Model.diffusivity = 2e-6 * u.metre**2 / u.second
+    assert Model._advdiffSystem is not system
+    system = Model._advdiffSystem
+
+    # Heat source
+    material.radiogenicHeatProd = 0.7 * u.microwatt / u.metre**3
+    assert Model._advdiffSystem is not system
+    system = Model._advdiffSystem
+    assert Model._advdiffSystem is system
+
+    # The rebuilt system is used by the following steps
+    Model.run_for(nstep=1, dt=0.1 * u.megayear, restartStep=None)
+    assert Model._advdiffSystemCache is system
+
+
+def test_temperature_boundary_values_reapplied(tmpdir):
+    import numpy as np
+    Model, material = _thermal_model(str(tmpdir))
+    mesh = Model.mesh
+    middle = np.where(np.isclose(mesh.data[:, -1],
+                                 GEO.nd(32. * u.kilometer)))[0]
+    nodes = mesh.data_nodegId[middle].ravel()
+    nodeSets = [(nodes, 800. * u.degK)]
+    Model.set_temperatureBCs(top=293.15 * u.degK, bottom=1573.15 * u.degK,
+                             nodeSets=nodeSets)
+    top = Model.top_wall.data
+    dt = 0.1 * u.megayear
+
+    Model.run_for(nstep=1, dt=dt, restartStep=None)
+    system = Model._advdiffSystemCache
+    assert np.allclose(Model.temperature.data[middle],
+                       GEO.nd(800. * u.degK))
+
+    # New nodeSet value, the wall values are overwritten
+    nodeSets[0] = (nodes, 900. * u.degK)
+    Model.temperature.data[top] = 0.
+    Model.run_for(nstep=1, dt=dt, restartStep=None)
+    assert Model._advdiffSystemCache is system
+    assert np.allclose(Model.temperature.data[middle],
+                       GEO.nd(900. * u.degK))
+    assert np.allclose(Model.temperature.data[top],
+                       GEO.nd(293.15 * u.degK))
+
+
+def test_stokes_solver_reuse():
+    from UWGeodynamics._model import _same_state
+    default = GEO.rcParams["solver.reuse"]
+    GEO.rcParams["solver.reuse"] = True
+    try:
+        Model, material = _thermal_model()
+
+        solver = Model.get_stokes_solver()
+        state = Model._stokesState
+        # The index sets are compared with the ones of the previous call
+        assert not Model._stokes_conditions_changed()
+        assert _same_state(Model._stokes_state(), state)
+        assert Model.get_stokes_solver() is solver
+
+        # Same walls, new values: the system is rebuilt
+        Model.set_velocityBCs(left=[1. * u.centimetre / u.year, None],
+                              right=[0., None],
+                              top=[None, 0.], bottom=[None, 0.])
+        assert Model.get_stokes_solver() is not solver
+        solver = Model.get_stokes_solver()
+        assert Model.get_stokes_solver() is solver
+
+        # New walls: the index sets change
+        Model.set_velocityBCs(left=[0., 0.], right=[0., None],
+                              top=[None, 0.], bottom=[None, 0.])
+        Model.velocityBCs.get_conditions()
+        assert Model._stokes_conditions_changed()
+        assert not Model._stokes_conditions_changed()
+        assert Model.get_stokes_solver() is not solver
+        solver = Model.get_stokes_solver()
+
+        # Rheology
+        material.viscosity = 1e22 * u.pascal * u.second
+        assert not _same_state(Model._stokes_state(), Model._stokesState)
+        assert Model.get_stokes_solver() is not solver
+        solver = Model.get_stokes_solver()
+        assert Model.get_stokes_solver() is solver
+    finally:
+        GEO.rcParams["solver.reuse"] = default
+
+
+def test_stokes_solver_no_reuse():
+    default = GEO.rcParams["solver.reuse"]
+    GEO.rcParams["solver.reuse"] = False
+    try:
+        Model, material = _thermal_model()
+        solver = Model.get_stokes_solver()
+        assert Model._stokesState is None
+        assert Model._stokesConditions is None
+        assert Model.get_stokes_solver() is not solver
+    finally:
+        GEO.rcParams["solver.reuse"] = default
+
+
+def test_asynchronous_checkpoint_matches_synchronous_save(tmpdir):
+    import numpy as np
+    import h5py
+    from UWGeodynamics._checkpoint import CheckpointWriter
+    from UWGeodynamics._checkpoint import save_mesh_variable
+    from UWGeodynamics._checkpoint import save_swarm_variable
+    Model = GEO.Model(elementRes=(16, 16))
+    Model.add_material(name="Material",
+                       shape=GEO.shapes.Layer(top=Model.top,
+                                              bottom=Model.bottom))
+    Model.materialField.data[::2] = 3
+    Model.temperature = True
+    Model.temperature.data[:, 0] = np.arange(Model.temperature.data.shape[0])
+
+    writer = CheckpointWriter(budget=1e9)
+    fields = [(save_swarm_variable, Model.materialField, None),
+              (save_mesh_variable, Model.temperature, u.degK)]
+    for save, obj, units in fields:
+        sync = str(tmpdir.join("sync.h5"))
+        async_ = str(tmpdir.join("async.h5"))
+        save(None, obj, sync, units=units)
+        save(writer, obj, async_, units=units)
+        writer.finalize(block=True)
+        with h5py.File(sync, "r") as f1, h5py.File(async_, "r") as f2:
+            assert f1["data"].dtype == f2["data"].dtype
+            assert np.array_equal(f1["data"][...], f2["data"][...])
+
+
+def test_asynchronous_checkpoint_error(tmpdir):
+    import numpy as np
+    import pytest
+    from UWGeodynamics._checkpoint import CheckpointWriter
+    writer = CheckpointWriter(budget=1e9)
+    filename = str(tmpdir.join("missing", "data.h5"))
+    writer.write(filename, {"data": np.zeros(4)}, {}, 32)
+    with pytest.raises(RuntimeError):
+        writer.finalize(block=True)
+    # The error is only reported once
+    writer.finalize(block=True)
+
+
+def test_asynchronous_checkpoint_budget(tmpdir):
+    import numpy as np
+    import h5py
+    from UWGeodynamics._checkpoint import CheckpointWriter
+    from UWGeodynamics._checkpoint import save_mesh_variable
+    Model = GEO.Model(elementRes=(16, 16))
+    Model.temperature = True
+    Model.temperature.data[:, 0] = np.arange(Model.temperature.data.shape[0])
+    nbytes = Model.mesh.nodesGlobal * Model.temperature.data.itemsize
+
+    # Files larger than the budget are saved synchronously (mpio)
+    writer = CheckpointWriter(budget=nbytes - 1)
+    filename = str(tmpdir.join("sync.h5"))
+    save_mesh_variable(writer, Model.temperature, filename)
+    assert writer.pending == 0 and writer._submitted == 0
+
+    # The buffers are released once written
+    writer = CheckpointWriter(budget=nbytes)
+    save_mesh_variable(writer, Model.temperature,
+                       str(tmpdir.join("async.h5")))
+    writer.finalize(block=True)
+    assert writer._submitted == 1
+    if writer.comm.rank == 0:
+        assert writer._pending_bytes == 0 and writer._reserved == 0
+    with h5py.File(filename, "r") as f1, \
+            h5py.File(str(tmpdir.join("async.h5")), "r") as f2:
+        assert np.array_equal(f1["data"][...], f2["data"][...])
+
+
+def test_single_file_checkpoint(tmpdir):
+    import h5py
+    import numpy as np
+    Model = GEO.Model(elementRes=(16, 16))
+    Model.add_material(name="Material",
+                       shape=GEO.shapes.Layer(top=Model.top,
+                                              bottom=Model.bottom))
+    Model.velocityField.data[...] = np.random.random(
+        Model.velocityField.data.shape)
+    outputDir = str(tmpdir)
+    default = GEO.rcParams["checkpoint.single.file"]
+    GEO.rcParams["checkpoint.single.file"] = True
+    try:
+        Model.checkpoint_fields(fields=["velocityField", "pressureField"],
+                                checkpointID=0, outputDir=outputDir)
+        Model.checkpoint_swarms(fields=["materialField", "plasticStrain"],
+                                checkpointID=0, outputDir=outputDir)
+        Model.wait_for_checkpoints()
+    finally:
+        GEO.rcParams["checkpoint.single.file"] = default
+    with h5py.File(str(tmpdir.join("fields-0.h5")), "r") as h5f:
+        assert "velocityField" in h5f and "pressureField" in h5f
+        assert h5f["velocityField/data"].shape == (
+            Model.mesh.nodesGlobal, 2)
+    with h5py.File(str(tmpdir.join("swarm-0.h5")), "r") as h5f:
+        assert "data" in h5f
+        for field in ["materialField", "plasticStrain"]:
+            assert field in h5f
+            assert "proc_offset" in h5f[field].attrs
+            assert np.array_equal(h5f[field + "/data"][...],
+                                  getattr(Model, field).data)
+
+
+def test_compressed_checkpoint_round_trip(tmpdir):
+    import numpy as np
+    import h5py
+    from UWGeodynamics._checkpoint import dataset_options
+    from UWGeodynamics.Underworld_extended import MeshVariable
+    Model = GEO.Model(elementRes=(16, 16))
+    Model.velocityField.data[...] = np.random.random(
+        Model.velocityField.data.shape)
+    keys = ["checkpoint.compression", "checkpoint.shuffle",
+            "checkpoint.chunk.size", "checkpoint.float32.fields"]
+    defaults = dict([(key, GEO.rcParams[key]) for key in keys])
+    GEO.rcParams["checkpoint.compression"] = "lzf"
+    GEO.rcParams["checkpoint.shuffle"] = True
+    GEO.rcParams["checkpoint.chunk.size"] = 50
+    GEO.rcParams["checkpoint.float32.fields"] = ["velocityField"]
+    try:
+        options = dataset_options("velocityField")
+    finally:
+        for key, value in defaults.items():
+            GEO.rcParams[key] = value
+    filename = str(tmpdir.join("velocityField.h5"))
+    Model.velocityField.save(filename, dataset_options=options)
+
+    with h5py.File(filename, "r") as h5f:
+        dset = h5f["data"]
+        # Parallel HDF5 can not write lzf
+        assert dset.compression == "gzip"
+        assert dset.shuffle
+        assert dset.chunks == (50, 2)
+        assert dset.dtype == np.float32
+
+    field = MeshVariable(mesh=Model.mesh, nodeDofCount=2)
+    field.load(filename)
+    expected = Model.velocityField.data.astype(np.float32)
+    assert np.array_equal(field.data, expected)
+
+
+def test_projections_after_restart(tmpdir):
+    import numpy as np
+    outputDir = str(tmpdir)
+    Model = GEO.Model(elementRes=(16, 16))
+    Model.add_material(name="Material",
+                       shape=GEO.shapes.Layer(top=Model.top,
+                                              bottom=Model.bottom))
+    Model.plasticStrain.data[...] = 1.0
+    Model.checkpoint_fields(checkpointID=0, outputDir=outputDir)
+    Model.checkpoint_swarms(checkpointID=0, outputDir=outputDir)
+    Model.wait_for_checkpoints()
+
+    Model.restart(step=0, restartDir=outputDir)
+    assert all([projector.swarm is Model.swarm
+                for projector in Model._swarmProjectors])
+    Model.plasticStrain.data[...] = 2.0
+    Model.invalidate_projections()
+    assert np.allclose(Model.projPlasticStrain.data, 2.0)
+
+
+def test_user_field_projection(tmpdir):
+    import numpy as np
+    import h5py
+    Model = GEO.Model(elementRes=(16, 16))
+    Model.add_material(name="Material",
+                       shape=GEO.shapes.Layer(top=Model.top,
+                                              bottom=Model.bottom))
+    field = Model.add_swarm_field("myField")
+    field.data[...] = 1.0
+    Model._update_projections(["projMyField"])
+    assert np.allclose(Model._projMyField.data, 1.0)
+
+    # The projection is up to date until the swarm fields are invalidated
+    field.data[...] = 2.0
+    Model._update_projections(["projMyField"])
+    assert np.allclose(Model._projMyField.data, 1.0)
+    Model.invalidate_projections()
+
+    # and is updated when checkpointed
+    default = GEO.rcParams["mesh.variables"]
+    GEO.rcParams["mesh.variables"] = default + ["projMyField"]
+    try:
+        Model.checkpoint_fields(fields=["projMyField"], checkpointID=0,
+                                outputDir=str(tmpdir))
+        Model.wait_for_checkpoints()
+    finally:
+        GEO.rcParams["mesh.variables"] = default
+    assert np.allclose(Model._projMyField.data, 2.0)
+    with h5py.File(str(tmpdir.join("projMyField-0.h5")), "r") as h5f:
+        assert np.allclose(h5f["data"][...], 2.0)
+
+
+def test_threshold_band_matches_full_pass():
+    import numpy as np
+    Model = GEO.Model(elementRes=(16, 16))
+    air = Model.add_material(name="Air",
+                             shape=GEO.shapes.Layer(top=Model.top,
+                                                    bottom=40. * u.kilometer))
+    Model.add_material(name="Crust",
+                       shape=GEO.shapes.Layer(top=40. * u.kilometer,
+                                              bottom=Model.bottom))
+    sediment = Model.add_material(name="Sediment")
+    processes = GEO.surfaceProcesses
+    Model.surfaceProcesses = processes.ErosionAndSedimentationThreshold(
+        air=[air], sediment=[sediment], threshold=32. * u.kilometer)
+
+    threshold = GEO.nd(32. * u.kilometer)
+    dt = 1.0
+    Model.surfaceProcesses.solve(dt)
+
+    # Move the particles up and down by less than the band margin
+    height = GEO.nd(64. * u.kilometer)
+    velocity = 0.5 * height / 16.
+    Model.velocityField.data[...] = 0.
+    Model.velocityField.data[:, -1] = velocity
+    coords = Model.swarm.particleCoordinates.data
+    near = np.abs(coords[:, -1] - threshold) < 0.25 * height
+    shift = 0.9 * velocity * dt * np.cos(20. * coords[:, 0]) * near
+    with Model.swarm.deform_swarm():
+        Model.swarm.particleCoordinates.data[:, -1] += shift
+    # The particles have been advected as during a Model time step
+    Model._advectedState = Model.swarm.stateId
+
+    # Full pass over all the particles
+    expected = np.copy(Model.materialField.data)
+    z = Model.swarm.particleCoordinates.data[:, -1]
+    isAir = expected[:, 0] == air.index
+    expected[~isAir & (z > threshold)] = air.index
+    expected[isAir & (z < threshold)] = sediment.index
+
+    Model.surfaceProcesses.solve(dt)
+    assert np.array_equal(Model.materialField.data, expected)
+
+
+def test_threshold_band_after_material_changes():
+    import numpy as np
+    import underworld.function as fn
+    Model = GEO.Model(elementRes=(16, 16))
+    air = Model.add_material(name="Air",
+                             shape=GEO.shapes.Layer(top=Model.top,
+                                                    bottom=40. * u.kilometer))
+    crust = Model.add_material(name="Crust",
+                               shape=GEO.shapes.Layer(top=40. * u.kilometer,
+                                                      bottom=Model.bottom))
+    sediment = Model.add_material(name="Sediment")
+    processes = GEO.surfaceProcesses
+    Model.surfaceProcesses = processes.ErosionAndSedimentationThreshold(
+        air=[air], sediment=[sediment], threshold=32. * u.kilometer)
+
+    threshold = GEO.nd(32. * u.kilometer)
+    dt = 1.0
+    Model.velocityField.data[...] = 0.
+    Model.surfaceProcesses.solve(dt)
+
+    # Change the materials far from the threshold: air at the bottom
+    # (phase change) and a new material at the top (add_material)
+    crust.phase_changes = GEO.PhaseChange(
+        condition=fn.input()[1] < GEO.nd(10. * u.kilometer),
+        result=air.index)
+    Model._phaseChangeFn()
+    Model.add_material(name="Top",
+                       shape=GEO.shapes.Layer(top=Model.top,
+                                              bottom=56. * u.kilometer))
+
+    # Full pass over all the particles
+    expected = np.copy(Model.materialField.data)
+    z = Model.swarm.particleCoordinates.data[:, -1]
+    isAir = expected[:, 0] == air.index
+    expected[~isAir & (z > threshold)] = air.index
+    expected[isAir & (z < threshold)] = sediment.index
+
+    Model.surfaceProcesses.solve(dt)
+    assert np.array_equal(Model.materialField.data, expected)
+    assert np.any(Model.materialField.data[z < GEO.nd(10. * u.kilometer)] ==
+                  sediment.index)
+
+
+def test_threshold_3D():
+    import numpy as np
+    Model = GEO.Model(elementRes=(6, 6, 8),
+                      minCoord=(0. * u.kilometer,) * 3,
+                      maxCoord=(64. * u.kilometer, 128. * u.kilometer,
+                                64. * u.kilometer))
+    air = Model.add_material(
+        name="Air",
+        shape=GEO.shapes.Layer3D(top=Model.top, bottom=40. * u.kilometer))
+    Model.add_material(
+        name="Crust",
+        shape=GEO.shapes.Layer3D(top=40. * u.kilometer, bottom=Model.bottom))
+    sediment = Model.add_material(name="Sediment")
+    processes = GEO.surfaceProcesses
+    Model.surfaceProcesses = processes.ErosionAndSedimentationThreshold(
+        air=[air], sediment=[sediment], threshold=32. * u.kilometer)
+
+    # The threshold applies to the vertical (z) coordinate
+    threshold = GEO.nd(32. * u.kilometer)
+    dt = 1.0
+    Model.velocityField.data[...] = 0.
+    Model.surfaceProcesses.solve(dt)
+    coords = Model.swarm.particleCoordinates.data
+    isAir = Model.materialField.data[:, 0] == air.index
+    assert np.array_equal(isAir, coords[:, -1] > threshold)
+    assert np.any(~isAir & (coords[:, 1] > threshold))
+
+    # Move the particles up and down by less than the band margin
+    height = GEO.nd(64. * u.kilometer)
+    velocity = 0.5 * height / 8.
+    Model.velocityField.data[:, -1] = velocity
+    near = np.abs(coords[:, -1] - threshold) < 0.25 * height
+    shift = 0.9 * velocity * dt * np.cos(20. * coords[:, 0]) * near
+    with Model.swarm.deform_swarm():
+        Model.swarm.particleCoordinates.data[:, -1] += shift
+    Model._advectedState = Model.swarm.stateId
+
+    # Full pass over all the particles
+    expected = np.copy(Model.materialField.data)
+    z = Model.swarm.particleCoordinates.data[:, -1]
+    isAir = expected[:, 0] == air.index
+    expected[~isAir & (z > threshold)] = air.index
+    expected[isAir & (z < threshold)] = sediment.index
+
+    Model.surfaceProcesses.solve(dt)
+    assert np.array_equal(Model.materialField.data, expected)
+
+
+def test_mesh_geometry_counter():
+    Model = GEO.Model(elementRes=(8, 8))
+    geometryId = Model.mesh.geometryId
+    with Model.mesh.deform_mesh():
+        Model.mesh.data[:, -1] *= 1.01
+    assert Model.mesh.geometryId == geometryId + 1
+
+
+def test_phase_changes_after_restart(tmpdir):
+    import numpy as np
+    import underworld.function as fn
+    outputDir = str(tmpdir)
+    Model = GEO.Model(elementRes=(16, 16))
+    material = Model.add_material(name="Material",
+                                  shape=GEO.shapes.Layer(top=Model.top,
+                                                         bottom=Model.bottom))
+    other = Model.add_material(name="Other")
+    depth = GEO.nd(32. * u.kilometer)
+    material.phase_changes = GEO.PhaseChange(condition=fn.input()[1] < depth,
+                                             result=other.index)
+    Model._phaseChangeFn()
+    Model.checkpoint_fields(checkpointID=0, outputDir=outputDir)
+    Model.checkpoint_swarms(checkpointID=0, outputDir=outputDir)
+    Model.wait_for_checkpoints()
+
+    Model.restart(step=0, restartDir=outputDir)
+    Model.materialField.data[...] = material.index
+    Model._phaseChangeFn()
+    below = Model.swarm.particleCoordinates.data[:, -1] < depth
+    assert np.all(Model.materialField.data[below, 0] == other.index)
+    assert np.all(Model.materialField.data[~below, 0] == material.index)
+
+
+def _check_batched_projection(elementRes, minCoord, maxCoord):
+    import numpy as np
+    import underworld as uw
+    from UWGeodynamics._utils import BatchedProjector
+    mesh = uw.mesh.FeMesh_Cartesian(elementType="Q1/dQ0",
+                                    elementRes=elementRes,
+                                    minCoord=minCoord, maxCoord=maxCoord)
+    dim = mesh.dim
+    swarm = uw.swarm.Swarm(mesh=mesh)
+    swarm.populate_using_layout(
+        uw.swarm.layouts.PerCellSpaceFillerLayout(swarm, particlesPerCell=20))
+    scalar = swarm.add_variable("double", 1)
+    vector = swarm.add_variable("double", dim)
+    coords = swarm.particleCoordinates.data
+    scalar.data[:, 0] = np.sin(coords[:, 0]) + coords[:, -1]
+    vector.data[...] = coords ** 2
+
+    batched = BatchedProjector(mesh, voronoi_swarm=swarm)
+    results = []
+    for variable in [scalar, vector]:
+        count = variable.data.shape[1]
+        reference = mesh.add_variable(count)
+        projector = uw.utils.MeshVariable_Projection(
+            reference, variable, voronoi_swarm=swarm, type=0)
+        projected = mesh.add_variable(count)
+        batched.add(str(len(results)), projected, variable)
+        results.append((projector, reference, projected))
+
+    def check():
+        for projector, reference, projected in results:
+            projector.solve()
+            assert np.allclose(reference.data, projected.data)
+
+    batched.solve()
+    check()
+
+    # The projector is reused when only the values change
+    stacked = batched._get_projector(("0", "1"))
+    scalar.data[:, 0] = np.cos(3. * coords[:, 0]) * coords[:, -1]
+    vector.data[...] = 1.0 - coords
+    batched.solve()
+    assert batched._get_projector(("0", "1")) is stacked
+    check()
+
+    # A single field is projected by its view
+    projector, reference, projected = results[0]
+    projected.data[...] = 0.
+    results[1][2].data[...] = 0.
+    batched.view("0").solve()
+    assert np.allclose(results[1][2].data, 0.)
+    projector.solve()
+    assert np.allclose(reference.data, projected.data)
+
+    # Advect the particles: the Voronoi weights and the mass change
+    with swarm.deform_swarm():
+        swarm.particleCoordinates.data[:, 0] += 0.1 * np.sin(
+            np.pi * swarm.particleCoordinates.data[:, -1]) * (
+            swarm.particleCoordinates.data[:, 0] *
+            (1.0 - swarm.particleCoordinates.data[:, 0]))
+    batched.solve()
+    check()
+
+    # Deform the mesh
+    with mesh.deform_mesh():
+        mesh.data[:, -1] *= 1.0 + 0.05 * mesh.data[:, 0]
+    batched.solve()
+    check()
+
+
+def test_batched_projection_2D():
+    _check_batched_projection((8, 8), (0., 0.), (1., 1.))
+
+
+def test_batched_projection_3D():
+    _check_batched_projection((4, 4, 4), (0., 0., 0.), (1., 1., 1.))
+
+
+def test_batched_projection_empty_cells():
+    import numpy as np
+    import underworld as uw
+    from UWGeodynamics._utils import BatchedProjector
+    mesh = uw.mesh.FeMesh_Cartesian(elementType="Q1/dQ0",
+                                    elementRes=(8, 8),
+                                    minCoord=(0., 0.), maxCoord=(1., 1.))
+    # Particles in the left half of the mesh only
+    swarm = uw.swarm.Swarm(mesh=mesh)
+    x, y = np.meshgrid(np.linspace(0.01, 0.49, 20),
+                       np.linspace(0.01, 0.99, 40))
+    swarm.add_particles_with_coordinates(np.column_stack((x.ravel(),
+                                                          y.ravel())))
+    variable = swarm.add_variable("double", 1)
+    variable.data[:, 0] = swarm.particleCoordinates.data[:, 1]
+
+    projected = mesh.add_variable(1)
+    projected.data[...] = -1.
+    batched = BatchedProjector(mesh, voronoi_swarm=swarm)
+    batched.add("field", projected, variable)
+    batched.solve()
+
+    # The nodes far from the particles keep a finite value
+    assert np.all(np.isfinite(projected.data))
+    left = mesh.data[:, 0] < 0.4
+    reference = mesh.add_variable(1)
+    uw.utils.MeshVariable_Projection(
+        reference, variable, voronoi_swarm=swarm, type=0).solve()
+    assert np.allclose(projected.data[left], reference.data[left])
+
+
+def _check_nearest_projection(projected, mesh, swarm, variable):
+    import numpy as np
+    from scipy import spatial
+    tree = spatial.cKDTree(swarm.particleCoordinates.data)
+    _, nearest = tree.query(mesh.data)
+    assert np.allclose(projected.data, variable.data[nearest])
+
+
+def test_nearest_neighbors_projection_after_advection():
+    import numpy as np
+    import underworld as uw
+    from UWGeodynamics._utils import Nearest_neighbors_projector
+    mesh = uw.mesh.FeMesh_Cartesian(elementType="Q1/dQ0",
+                                    elementRes=(8, 8),
+                                    minCoord=(0., 0.), maxCoord=(1., 1.))
+    swarm = uw.swarm.Swarm(mesh=mesh)
+    swarm.populate_using_layout(
+        uw.swarm.layouts.PerCellSpaceFillerLayout(swarm, particlesPerCell=20))
+    variable = swarm.add_variable("double", 1)
+    coords = swarm.particleCoordinates.data
+    variable.data[:, 0] = np.sin(coords[:, 0]) + coords[:, -1]
+
+    projected = mesh.add_variable(1)
+    projector = Nearest_neighbors_projector(mesh, swarm)
+    projector.add("variable", projected, variable)
+    projector.solve()
+    _check_nearest_projection(projected, mesh, swarm, variable)
+
+    # Advect the particles: the node to particle map must be rebuilt
+    with swarm.deform_swarm():
+        swarm.particleCoordinates.data[:, 0] += 0.03 * np.sin(
+            np.pi * swarm.particleCoordinates.data[:, 1])
+    projector.solve()
+    _check_nearest_projection(projected, mesh, swarm, variable)
+
+    # Deform the mesh: the map must follow the new node positions
+    with mesh.deform_mesh():
+        mesh.data[:, 1] *= 1.0 + 0.05 * mesh.data[:, 0]
+    projector.solve()
+    _check_nearest_projection(projected, mesh, swarm, variable)
+
+
+def _save_scaling():
+    return dict([(key, GEO.scaling_coefficients[key])
+                 for key in GEO.scaling_coefficients])
+
+
+def _restore_scaling(coefficients):
+    for key, value in coefficients.items():
+        GEO.scaling_coefficients[key] = value
+
+
+def test_cached_nondimensionalize_offset_units():
+    import numpy as np
+    from UWGeodynamics.scaling._scaling import _nonDimensionalize
+    from UWGeodynamics.scaling._scaling import _Dimensionalize
+    coefficients = _save_scaling()
+    try:
+        GEO.scaling_coefficients["[temperature]"] = 1200. * u.degK
+        for value in [u.Quantity(25., u.degC), u.Quantity(-10., u.degC),
+                      300. * u.degK, 10. * u.kilometer]:
+            # Twice: the second call uses the cached factors
+            for _ in range(2):
+                assert np.isclose(GEO.nd(value), _nonDimensionalize(value))
+        values = np.linspace(0., 1., 5)
+        for units in [u.degK, u.degC]:
+            expected = _Dimensionalize(values, units).magnitude
+            for _ in range(2):
+                result = GEO.Dimensionalize(values, units)
+                assert np.allclose(result.magnitude, expected)
+    finally:
+        _restore_scaling(coefficients)
+
+
+def test_nondimensionalize_cache_invalidation():
+    import numpy as np
+    coefficients = _save_scaling()
+    try:
+        GEO.scaling_coefficients["[length]"] = 1. * u.kilometer
+        assert np.isclose(GEO.nd(1. * u.kilometer), 1.0)
+        assert np.isclose(
+            GEO.Dimensionalize(1.0, u.kilometer).magnitude, 1.0)
+        GEO.scaling_coefficients["[length]"] = 10. * u.kilometer
+        assert np.isclose(GEO.nd(1. * u.kilometer), 0.1)
+        assert np.isclose(
+            GEO.Dimensionalize(1.0, u.kilometer).magnitude, 10.0)
+    finally:
+        _restore_scaling(coefficients)
+
+
+def test_nondimensionalize_array():
+    import numpy as np
+    from UWGeodynamics.scaling import nonDimensionalize_array
+    coefficients = _save_scaling()
+    try:
+        GEO.scaling_coefficients["[length]"] = 1. * u.kilometer
+        values = [[1. * u.kilometer, 2000. * u.meter],
+                  [3. * u.kilometer, 4. * u.kilometer]]
+        result = nonDimensionalize_array(values)
+        assert result.shape == (2, 2)
+        assert np.allclose(result, [[1., 2.], [3., 4.]])
+        expected = [[GEO.nd(value) for value in row] for row in values]
+        assert np.allclose(result, expected)
+
+        array = np.linspace(0., 10., 11) * u.kilometer
+        assert np.allclose(nonDimensionalize_array(array),
+                           np.linspace(0., 10., 11))
+        assert np.allclose(nonDimensionalize_array([1., 2.]), [1., 2.])
+    finally:
+        _restore_scaling(coefficients)
+
+
+def test_timings_output(tmpdir):
+    import csv
+    import json
+    import time
+    from UWGeodynamics._utils import Timings
+    timings = Timings(["Stokes solve", "Swarm advection"])
+    for step in [1, 2]:
+        with timings.record("Stokes solve"):
+            time.sleep(0.01)
+        with timings.record("Swarm advection"):
+            pass
+        timings.end_step(step=step, dt=0.5)
+
+    csvfile = str(tmpdir.join("timings.csv"))
+    for record in timings.steps:
+        timings.write_csv(csvfile, record)
+    with open(csvfile) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["dt", "step",
+                       "Stokes_solve_min", "Stokes_solve_max",
+                       "Stokes_solve_mean",
+                       "Swarm_advection_min", "Swarm_advection_max",
+                       "Swarm_advection_mean"]
+    assert len(rows) == 3
+    assert [row[1] for row in rows[1:]] == ["1", "2"]
+    for row in rows[1:]:
+        assert float(row[2]) >= 0.01
+        assert float(row[3]) >= float(row[2])
+
+    jsonfile = str(tmpdir.join("timings.json"))
+    timings.write_json(jsonfile)
+    with open(jsonfile) as f:
+        records = json.load(f)
+    assert [record["step"] for record in records] == [1, 2]
+    for record in records:
+        assert record["dt"] == 0.5
+        assert record["Stokes solve"]["max"] >= 0.01
+        assert set(record["Swarm advection"].keys()) == set(["min", "max",
+                                                            "mean"])
+    totals = timings.totals()
+    assert totals["Stokes solve"] == sum([record["Stokes solve"]["max"]
+                                         for record in records])
+
+
+def test_timings_csv_new_output(tmpdir):
+    import csv
+    from UWGeodynamics._utils import Timings
+    csvfile = str(tmpdir.join("timings.csv"))
+    with open(csvfile, "w") as f:
+        f.write("old,header\n1,2\n")
+
+    # The file of a previous run is truncated on the first write
+    timings = Timings(["Stokes solve"])
+    for step in [1, 2]:
+        with timings.record("Stokes solve"):
+            pass
+        timings.end_step(step=step)
+        timings.write_csv(csvfile)
+
+    # A new phase changes the header: the rows are rewritten
+    with timings.record("Isostasy"):
+        pass
+    timings.end_step(step=3)
+    timings.write_csv(csvfile)
+    with open(csvfile) as f:
+        rows = list(csv.DictReader(f))
+    assert [row["step"] for row in rows] == ["1", "2", "3"]
+    assert [float(row["Isostasy_max"]) for row in rows[:2]] == [0., 0.]
+    assert len(rows[0]) == 7
+
+    # A new run (run_for, restart) starts the file again
+    timings.new_output()
+    timings.end_step(step=4)
+    timings.write_csv(csvfile)
+    with open(csvfile) as f:
+        rows = list(csv.DictReader(f))
+    assert [row["step"] for row in rows] == ["4"]
+
+
+def test_visugrid_advection():
+    import numpy as np
+    Model = GEO.Model(elementRes=(16, 16))
+    coords = Model.mesh.data
+    Model.velocityField.data[:, 0] = coords[:, 1]
+    Model.velocityField.data[:, 1] = -coords[:, 0]
+    # The grid extends beyond the Model: the outside nodes take the
+    # velocity of the nearest boundary node
+    Model.add_visugrid(elementRes=(12, 12),
+                       minCoord=(-4. * u.kilometer, -4. * u.kilometer),
+                       maxCoord=(68. * u.kilometer, 68. * u.kilometer))
+    visugrid = Model._visugrid
+
+    # Point by point evaluation
+    dt = 0.1
+    expected = np.array(visugrid.mesh.data)
+    for index, point in enumerate(np.array(visugrid.mesh.data)):
+        try:
+            velocity = Model.velocityField.evaluate(np.array([point]))[0]
+        except Exception:
+            _, loc = visugrid.tree.query(point)
+            velocity = Model.velocityField.data[visugrid.boundaries[loc]]
+        expected[index] += velocity * dt
+
+    visugrid.advect(dt)
+    assert np.allclose(visugrid.mesh.data, expected)
+
+
+def _check_lithostatic_pressure_columns(elementRes, maxCoord):
+    import numpy as np
+    import underworld as uw
+    import underworld.function as fn
+    from UWGeodynamics.lithopress import LithostaticPressure
+    mesh = uw.mesh.FeMesh_Cartesian(elementType="Q1/dQ0",
+                                    elementRes=elementRes,
+                                    minCoord=(0.,) * len(elementRes),
+                                    maxCoord=maxCoord)
+    # Deform the mesh so that the elements have different heights
+    with mesh.deform_mesh():
+        mesh.data[:, -1] *= 1.0 + 0.1 * np.sin(mesh.data[:, 0])
+    density = 1.0 + fn.input()[0] + 2.0 * fn.input()[mesh.dim - 1]
+    solver = LithostaticPressure(mesh, density, 9.81)
+
+    assert solver._column_layout() is not None
+    pressure, bottom = solver.solve()
+
+    # Global cumulative sum
+    if mesh.dim == 2:
+        expected, expected_bottom = solver._lithoPressure2D()
+    else:
+        expected, expected_bottom = solver._lithoPressure3D()
+    assert np.allclose(pressure, expected)
+    assert np.allclose(bottom, expected_bottom)
+
+
+def test_lithostatic_pressure_columns_2D():
+    _check_lithostatic_pressure_columns((8, 6), (2., 1.))
+
+
+def test_lithostatic_pressure_columns_3D():
+    _check_lithostatic_pressure_columns((4, 3, 5), (2., 1., 1.))
+
+
+def test_lithostatic_pressure_global_fallback():
+    import numpy as np
+    import underworld as uw
+    from UWGeodynamics.lithopress import LithostaticPressure
+    from UWGeodynamics.lithopress.lithopress import _local_block
+    mesh = uw.mesh.FeMesh_Cartesian(elementType="Q2/dQ1",
+                                    elementRes=(4, 4),
+                                    minCoord=(0., 0.), maxCoord=(1., 1.))
+    solver = LithostaticPressure(mesh, 1.0, 9.81)
+    assert solver._column_layout() is None
+    pressure, _ = solver.solve()
+    assert np.allclose(pressure, solver._lithoPressure2D()[0])
+
+    # The elements of a processor must form a block covered by its nodes
+    I, J = np.meshgrid(np.arange(3), np.arange(3), indexing="ij")
+    nodes = (I.ravel(), J.ravel())
+    assert _local_block((np.array([0, 1, 0, 1]), np.array([0, 0, 1, 1])),
+                        nodes) is not None
+    # Not a block
+    assert _local_block((np.array([0, 1, 1]), np.array([0, 0, 1])),
+                        nodes) is None
+    # Block not covered by the nodes
+    assert _local_block((np.array([0, 1, 2]), np.array([0, 0, 0])),
+                        nodes) is None
+
+
+def _isostasy_model(elementRes):
+    import numpy as np
+    dim = len(elementRes)
+    Model = GEO.Model(elementRes=elementRes,
+                      minCoord=(0. * u.kilometer,) * dim,
+                      maxCoord=(100. * u.kilometer,) * (dim - 1) +
+                      (50. * u.kilometer,))
+    air = Model.add_material(name="Air",
+                             shape=GEO.shapes.Layer(top=Model.top,
+                                                    bottom=40. * u.kilometer))
+    mantle = Model.add_material(name="Mantle",
+                                shape=GEO.shapes.Layer(
+                                    top=40. * u.kilometer,
+                                    bottom=Model.bottom))
+    extent = {"minX": 20. * u.kilometer, "maxX": 60. * u.kilometer}
+    if dim == 3:
+        extent.update({"minY": 30. * u.kilometer, "maxY": 70. * u.kilometer})
+    crust = Model.add_material(name="Crust",
+                               shape=GEO.shapes.Box(top=40. * u.kilometer,
+                                                    bottom=20. * u.kilometer,
+                                                    **extent))
+    air.density = 1. * u.kilogram / u.metre**3
+    mantle.density = 3300. * u.kilogram / u.metre**3
+    crust.density = 2800. * u.kilogram / u.metre**3
+
+    walls = {"left": [0., None], "right": [0., None], "top": [None, 0.]}
+    if dim == 3:
+        walls = {"left": [0., None, None], "right": [0., None, None],
+                 "front": [None, 0., None], "back": [None, 0., None],
+                 "top": [None, None, 0.]}
+    isostasy = GEO.LecodeIsostasy(reference_mat=mantle.index,
+                                  maskedMat=[air.index])
+    Model.set_velocityBCs(bottom=isostasy, **walls)
+
+    coords = Model.mesh.data
+    Model.velocityField.data[:, -1] = (np.sin(coords[:, 0]) *
+                                       (coords[:, -1] + 1.0))
+    isostasy._check_all_defined()
+    isostasy.MaterialIndexFieldFloat.data[...] = np.rint(
+        isostasy.materialIndexField.data.astype("float"))
+    isostasy.projectorDensity.solve()
+    isostasy.projectorMaterial.solve()
+    return Model, isostasy
+
+
+def _previous_isostasy_densities(isostasy):
+    """ Serial version of the previous implementation (global arrays) """
+    import numpy as np
+    mesh = isostasy.mesh
+    shape = tuple(np.array(mesh.elementRes) + 1)[::-1]
+    gids = mesh.data_nodegId[:mesh.nodesLocal].ravel()
+    densities = np.zeros(np.prod(shape))
+    materials = np.zeros(np.prod(shape))
+    densities[gids] = isostasy.DensityVar.data[:mesh.nodesLocal, 0]
+    materials[gids] = isostasy.MaterialVar.data[:mesh.nodesLocal, 0]
+    densities = densities.reshape(shape)
+    materials = materials.reshape(shape)
+    if mesh.dim == 2:
+        materials = materials.astype("int")
+    else:
+        materials = np.rint(materials).astype("int")
+
+    mask = np.isin(materials, isostasy.maskedMat)
+    means = np.ma.masked_array(densities, mask).mean(axis=0)
+    means0 = np.ma.array(densities,
+                         mask=(materials != isostasy.reference_mat))
+    means0 = np.array(means0.mean(axis=0))
+    if mesh.dim == 2:
+        means = (np.roll(means, -1) + means + np.roll(means, 1)) / 3.0
+        means0 = (np.roll(means0, -1) + means0 + np.roll(means0, 1)) / 3.0
+    return np.array(means), means0
+
+
+def _previous_isostasy_velocities(isostasy):
+    """ Serial version of the previous implementation (loops over the
+    top and bottom nodes) """
+    import numpy as np
+    mesh = isostasy.mesh
+    shape = tuple(np.array(mesh.elementRes) + 1)[::-1]
+    top = np.zeros(shape[1:])
+    bottom = np.zeros(shape[1:])
+    for index in range(mesh.nodesLocal):
+        position = np.unravel_index(int(mesh.data_nodegId[index][0]), shape)
+        if position[0] == shape[0] - 1:
+            top[position[1:]] = isostasy.velocityField.data[index, -1]
+        if position[0] == 0:
+            bottom[position[1:]] = isostasy.velocityField.data[index, -1]
+    if mesh.dim == 2:
+        top = (np.roll(top, -1) + top + np.roll(top, 1)) / 3.0
+        bottom = (np.roll(bottom, -1) + bottom + np.roll(bottom, 1)) / 3.0
+    return top - bottom
+
+
+def _check_isostasy_densities(elementRes):
+    import numpy as np
+    _, isostasy = _isostasy_model(elementRes)
+    expected, expected0 = _previous_isostasy_densities(isostasy)
+    if len(elementRes) == 2:
+        means, means0 = isostasy._get_average_densities2D()
+    else:
+        means, means0 = isostasy._get_average_densities3D()
+    assert np.allclose(means, expected)
+    assert np.allclose(means0, expected0)
+
+
+def test_isostasy_column_densities_2D():
+    _check_isostasy_densities((16, 8))
+
+
+def test_isostasy_column_densities_3D():
+    _check_isostasy_densities((6, 5, 4))
+
+
+def _check_isostasy_basal_velocities(elementRes):
+    import numpy as np
+    Model, isostasy = _isostasy_model(elementRes)
+    means, means0 = _previous_isostasy_densities(isostasy)
+    separation = _previous_isostasy_velocities(isostasy)
+    expected = (-1.0 * means * separation / means0).ravel()
+
+    if len(elementRes) == 2:
+        velocities, _ = isostasy._get_sep_velocities2D()
+    else:
+        velocities, _ = isostasy._get_sep_velocities3D()
+    assert np.allclose(velocities, separation)
+
+    isostasy.solve()
+    assert np.allclose(isostasy._basal_velocities.ravel(), expected)
+    mesh = Model.mesh
+    base = mesh.specialSets["Min%s_VertexSet" % "IJK"[mesh.dim - 1]].data
+    base = base[base < mesh.nodesLocal]
+    gids = mesh.data_nodegId[base].ravel()
+    assert np.allclose(Model.velocityField.data[base, -1], expected[gids])
+
+
+def test_isostasy_basal_velocities_2D():
+    _check_isostasy_basal_velocities((16, 8))
+
+
+def test_isostasy_basal_velocities_3D():
+    _check_isostasy_basal_velocities((6, 5, 4))
+
+
+class _FakeIsostasy(object):
+
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.basal_velocity_change = None
+        self.solves = 0
+
+    def solve(self):
+        self.solves += 1
+        self.basal_velocity_change = self.changes.pop(0)
+
+
+def _count_isostasy_solves(policy, tolerance=1e-3):
+    """ Number of isostasy solves for two Stokes solves of 4 iterations"""
+    keys = ["isostasy.update", "isostasy.update.tolerance"]
+    defaults = dict([(key, GEO.rcParams[key]) for key in keys])
+    GEO.rcParams["isostasy.update"] = policy
+    GEO.rcParams["isostasy.update.tolerance"] = tolerance
+    try:
+        Model = GEO.Model(elementRes=(4, 4))
+        Model._isostasy = _FakeIsostasy([1., 1e-2, 1e-4, 1e-5] * 2)
+        counts = []
+        for solve in range(2):
+            # Reset at the start of each solve (Model.solve)
+            Model._isostasySolves = 0
+            for iteration in range(4):
+                Model._solve_isostasy()
+            counts.append(Model._isostasySolves)
+        assert sum(counts) == Model._isostasy.solves
+        return counts
+    finally:
+        for key, value in defaults.items():
+            GEO.rcParams[key] = value
+
+
+def test_isostasy_update_policies():
+    import pytest
+    assert _count_isostasy_solves("iteration") == [4, 4]
+    assert _count_isostasy_solves("step") == [1, 1]
+    # Updates stop once the change drops below the tolerance
+    assert _count_isostasy_solves("tolerance") == [3, 1]
+    assert _count_isostasy_solves("tolerance", 1e-1) == [2, 1]
+    assert _count_isostasy_solves("tolerance", 0.) == [4, 4]
+
+    with pytest.raises(ValueError):
+        GEO.rcParams["isostasy.update"] = "never"
+
+
+class _FakeBadlandsGrid(object):
+
+    def __init__(self, vertices, regX, regY):
+        self.tinMesh = {"vertices": vertices}
+        self.regX = regX
+        self.regY = regY
+
+
+class _FakeBadlandsModel(object):
+
+    def __init__(self, vertices, elevation, regX, regY):
+        self.recGrid = _FakeBadlandsGrid(vertices, regX, regY)
+        self.elevation = elevation
+
+
+def test_surface_velocities():
+    import numpy as np
+    import underworld as uw
+    from UWGeodynamics.linkage.uw_utilities import SurfaceVelocities
+    mesh = uw.mesh.FeMesh_Cartesian(elementType="Q1/dQ0",
+                                    elementRes=(16, 16),
+                                    minCoord=(0., 0.), maxCoord=(1., 1.))
+    velocityField = uw.mesh.MeshVariable(mesh=mesh, nodeDofCount=2)
+    velocityField.data[:, 0] = np.sin(np.pi * mesh.data[:, 0])
+    velocityField.data[:, 1] = mesh.data[:, 0] * mesh.data[:, 1]
+
+    xs = np.linspace(0., 1., 101)
+    points = np.column_stack((xs, 0.5 + 0.1 * np.sin(4. * xs)))
+    velocities = SurfaceVelocities(velocityField)
+
+    def check(points):
+        expected = velocityField.evaluate(points)
+        assert np.allclose(velocities(points), expected)
+
+    # First call: all the points are located
+    check(points)
+    state = velocities._state
+    # Repeat call: only the points owned are evaluated
+    check(points)
+    assert velocities._state == state
+    # The surface has moved vertically
+    points[:, 1] += 0.05
+    check(points)
+
+    # The points are located again after a deformation of the mesh
+    with mesh.deform_mesh():
+        mesh.data[:, 1] *= 1.0 + 0.2 * mesh.data[:, 0]
+    check(points)
+    assert velocities._state != state
+    check(points)
+
+
+def _badlands_materials(elementRes, minCoord, maxCoord):
+    """ SPM coupled to a fake Badlands surface (TIN on the nodes of the
+    regular grid, as built by Badlands from the DEM) and the flags of the
+    particles computed with the previous implementation (griddata over the
+    TIN vertices on every processor)"""
+    import numpy as np
+    import underworld as uw
+    from scipy.interpolate import griddata, interp1d
+    from UWGeodynamics.linkage.linkage import SPM, BadlandsDriver
+
+    mesh = uw.mesh.FeMesh_Cartesian(elementType="Q1/dQ0",
+                                    elementRes=elementRes,
+                                    minCoord=minCoord, maxCoord=maxCoord)
+    swarm = uw.swarm.Swarm(mesh=mesh)
+    swarm.populate_using_layout(
+        uw.swarm.layouts.PerCellSpaceFillerLayout(swarm, particlesPerCell=20))
+    material = swarm.add_variable("int", 1)
+    material.data[:, 0] = np.arange(swarm.particleLocalCount) % 4
+
+    # Badlands surface, the y axis spans the x range in 2D. The grid
+    # spacing is not commensurate with the cells so that no particle is
+    # equidistant from two nodes
+    rng = np.random.RandomState(0)
+    xs = np.linspace(minCoord[0], maxCoord[0], 43)
+    ys = np.linspace(minCoord[1], maxCoord[1], 43) if mesh.dim == 3 else xs
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    vertices = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+    vertices = vertices[rng.permutation(len(vertices))]
+    elevation = 0.3 * np.sin(4. * vertices[:, 0]) + 0.2 * vertices[:, 1]
+
+    spm = SPM.__new__(SPM)
+    spm.mesh = mesh
+    spm.swarm = swarm
+    spm.material_index = material
+    spm.airIndex = [0, 3]
+    spm.sedimentIndex = 2
+    spm.scaleDIM = 1.0
+    spm._badlands = BadlandsDriver(
+        _FakeBadlandsModel(vertices, elevation, xs, ys))
+    spm._surface = None
+
+    volume = swarm.particleCoordinates.data
+    if mesh.dim == 2:
+        grid_x, grid_y = np.meshgrid(xs, ys)
+        interpolate_z = griddata(vertices, elevation, (grid_x, grid_y),
+                                 method='nearest').T.mean(axis=1)
+        surface = interp1d(xs, interpolate_z)(volume[:, 0])
+    else:
+        surface = griddata(points=vertices, values=elevation,
+                           xi=volume[:, [0, 1]], method='nearest')
+    flags = volume[:, -1] < surface
+
+    expected = np.copy(material.data)
+    isAir = np.isin(expected[:, 0], spm.airIndex)
+    expected[isAir & flags] = spm.sedimentIndex
+    expected[~flags] = spm.airIndex[0]
+
+    spm._update_material_types()
+    return spm, expected
+
+
+def test_badlands_dem_file(tmpdir):
+    import numpy as np
+    from UWGeodynamics.linkage.linkage import BadlandsDriver
+    x, y = np.meshgrid(np.linspace(0., 128e3, 129), np.linspace(0., 64e3, 65))
+    dem = np.column_stack((x.ravel(), y.ravel(),
+                           np.random.uniform(-2e3, 2e3, x.size)))
+    filename = str(tmpdir.join("dem.csv"))
+    BadlandsDriver._write_dem(filename, dem)
+    written = np.loadtxt(filename)
+    assert written.shape == dem.shape
+    assert np.allclose(written, dem, rtol=1e-8, atol=1e-3)
+    assert written[1, 0] - written[0, 0] == 1e3
+
+
+def test_badlands_materials_2D():
+    import numpy as np
+    spm, expected = _badlands_materials((16, 16), (0., -1.), (1., 1.))
+    assert np.array_equal(spm.material_index.data, expected)
+
+
+def test_badlands_materials_3D():
+    import numpy as np
+    spm, expected = _badlands_materials((8, 8, 8), (0., 0., -1.),
+                                        (1., 1., 1.))
+    assert np.array_equal(spm.material_index.data, expected)
+
+
+def test_badlands_grid_surface():
+    import numpy as np
+    from scipy.spatial import cKDTree
+    from UWGeodynamics.linkage.linkage import _GridSurface
+    rng = np.random.RandomState(0)
+    xs = np.linspace(0., 1., 41)
+    ys = np.linspace(0., 2., 61)
+    elevations = rng.uniform(size=(len(xs), len(ys)))
+    surface = _GridSurface(xs, ys, elevations)
+
+    # Closest node of the grid, points outside of the grid included
+    grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+    tree = cKDTree(np.column_stack((grid_x.ravel(), grid_y.ravel())))
+    points = rng.uniform([-0.1, -0.1, 0.], [1.1, 2.1, 1.], (10000, 3))
+    _, nearest = tree.query(points[:, :2])
+    assert np.array_equal(surface.elevation(points),
+                          elevations.ravel()[nearest])
+
+    # The bounds contain the elevation of any point of the cells
+    lower = rng.uniform(0., 0.9, (100, 2))
+    upper = lower + rng.uniform(0., 0.1, (100, 2))
+    cells = np.stack([lower, upper, np.column_stack((lower[:, 0],
+                                                     upper[:, 1]))], axis=1)
+    cells = np.concatenate([cells, np.zeros((100, 3, 1))], axis=2)
+    low, high = surface.bounds(cells)
+    for cell in range(len(cells)):
+        points = lower[cell] + (upper[cell] - lower[cell]) * rng.uniform(
+            size=(500, 2))
+        values = surface.elevation(points)
+        assert low[cell] <= values.min()
+        assert high[cell] >= values.max()
+
+
+def test_badlands_band_matches_full_pass_3D():
+    import numpy as np
+    import underworld as uw
+    from UWGeodynamics._utils import SurfaceBand
+    spm, _ = _badlands_materials((8, 8, 8), (0., 0., -1.), (1., 1., 1.))
+    spm.velocityField = uw.mesh.MeshVariable(mesh=spm.mesh, nodeDofCount=3)
+    spm.velocityField.data[...] = 0.
+    spm._band = SurfaceBand(spm.mesh, spm.swarm)
+    spm._checkAll = False
+
+    # Raise the surface on one side and lower it on the other
+    model = spm._badlands.model
+    vertices = model.recGrid.tinMesh["vertices"]
+    model.elevation = model.elevation + 0.2 * np.sign(vertices[:, 0] - 0.5)
+
+    # Full pass over all the particles
+    volume = spm.swarm.particleCoordinates.data
+    flags = volume[:, -1] < spm._get_surface().elevation(volume)
+    expected = np.copy(spm.material_index.data)
+    isAir = np.isin(expected[:, 0], spm.airIndex)
+    expected[isAir & flags] = spm.sedimentIndex
+    expected[~flags] = spm.airIndex[0]
+
+    spm._update_material_types(1.0)
+    assert np.array_equal(spm.material_index.data, expected)
+
+
+class _RisingSurfaceDriver(object):
+    """ Badlands driver (2D) whose surface rises at a constant rate """
+
+    rate = 2e-3  # metres per year
+
+    def __init__(self, XML, dem, checkpoint_interval, time_years,
+                 restartFolder=None, restartStep=None):
+        import numpy as np
+        self.xs = np.unique(dem[:, 0])
+        self.ys = np.unique(dem[:, 1])
+        self.z0 = dem[0, 2]
+        self.time = time_years
+
+    def call(self, name, *args):
+        return getattr(self, name)(*args)
+
+    start = call
+
+    def wait(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _elevations(self):
+        return (self.z0 + self.rate * self.time +
+                0.05 * (self.xs - self.xs[0]))
+
+    def surface(self, dim):
+        import numpy as np
+        return np.column_stack((self.xs, self._elevations()))
+
+    def surface_elevations(self, dim):
+        return self.xs, self._elevations()
+
+    def inject_displacement(self, time, dt, disp, sigma, dim):
+        pass
+
+    def run_to_time(self, time):
+        self.time = time
+
+
+def _badlands_coupled_model(outputDir, lagged):
+    Model = GEO.Model(elementRes=(16, 16), outputDir=outputDir)
+    air = Model.add_material(name="Air",
+                             shape=GEO.shapes.Layer(top=Model.top,
+                                                    bottom=30. * u.kilometer))
+    crust = Model.add_material(name="Crust",
+                               shape=GEO.shapes.Layer(top=30. * u.kilometer,
+                                                      bottom=Model.bottom))
+    sediment = Model.add_material(name="Sediment")
+    for material in [air, crust, sediment]:
+        material.density = 3000. * u.kilogram / u.metre**3
+        material.viscosity = 1e21 * u.pascal * u.second
+    Model.set_velocityBCs(left=[0., None], right=[0., None],
+                          top=[None, 0.], bottom=[None, 0.])
+    Model.surfaceProcesses = GEO.surfaceProcesses.Badlands(
+        airIndex=[air.index], sedimentIndex=sediment.index, XML=None,
+        resolution=1. * u.kilometer, checkpoint_interval=1. * u.megayear,
+        surfElevation=30. * u.kilometer, verbose=False, lagged=lagged,
+        driver=_RisingSurfaceDriver)
+    return Model
+
+
+def test_lagged_badlands_coupling(tmpdir):
+    import numpy as np
+    import h5py
+    dt = 0.5 * u.megayear
+
+    # Reference: the surface is applied at each step
+    Model = _badlands_coupled_model(str(tmpdir.mkdir("reference")), False)
+    initial = np.copy(Model.materialField.data)
+    Model.surfaceProcesses.solve(GEO.nd(dt))
+    first = np.copy(Model.materialField.data)
+    Model.surfaceProcesses.solve(GEO.nd(dt))
+    assert not np.array_equal(initial, first)
+    assert not np.array_equal(first, Model.materialField.data)
+
+    # The lagged surface matches the reference one step later
+    lagged = _badlands_coupled_model(str(tmpdir.mkdir("lagged")), True)
+    lagged.surfaceProcesses.solve(GEO.nd(dt))
+    assert np.array_equal(lagged.materialField.data, initial)
+    lagged.surfaceProcesses.solve(GEO.nd(dt))
+    assert np.array_equal(lagged.materialField.data, first)
+
+    # and is applied before the checkpoints
+    outputDir = str(tmpdir.mkdir("checkpoint"))
+    lagged.checkpoint_swarms(fields=["materialField"], checkpointID=0,
+                             outputDir=outputDir)
+    lagged.wait_for_checkpoints()
+    assert np.array_equal(lagged.materialField.data,
+                          Model.materialField.data)
+    with h5py.File(str(tmpdir.join("checkpoint", "materialField-0.h5")),
+                   "r") as h5f:
+        assert np.array_equal(h5f["data"][...], Model.materialField.data)
+    lagged.surfaceProcesses.close()
+
+
+def test_lagged_badlands_run_for(tmpdir):
+    import numpy as np
+    dt = 0.5 * u.megayear
+    Model = _badlands_coupled_model(str(tmpdir.mkdir("reference")), False)
+    Model.run_for(nstep=1, dt=dt, restartStep=None)
+
+    # The lagged surface is applied at the end of run_for
+    lagged = _badlands_coupled_model(str(tmpdir.mkdir("lagged")), True)
+    lagged.run_for(nstep=1, dt=dt, restartStep=None)
+    assert np.array_equal(lagged.materialField.data,
+                          Model.materialField.data)
+    lagged.surfaceProcesses.close()
+
+
+def test_lagged_badlands_coupling_mpi():
+    import os
+    import subprocess
+    import sys
+    import pytest
+    try:
+        from shutil import which
+    except ImportError:
+        # python 2
+        from distutils.spawn import find_executable as which
+    mpirun = which("mpirun")
+    if not mpirun:
+        pytest.skip("mpirun is not available")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "badlands_mpi.py")
+    subprocess.check_call([mpirun, "-np", "2", sys.executable, script])
+
+
+def test_lagged_badlands_spawn_failure(tmpdir, monkeypatch):
+    import pickle
+    import pytest
+    from mpi4py import MPI
+    from UWGeodynamics.linkage import linkage
+
+    # The default driver factory can be sent to the Badlands process
+    factory = pickle.loads(pickle.dumps(linkage.build_badlands_driver))
+    assert factory is linkage.build_badlands_driver
+
+    def spawn_failure(factory, *args):
+        raise MPI.Exception(MPI.ERR_SPAWN)
+
+    monkeypatch.setattr(linkage, "BadlandsProcess", spawn_failure)
+    with pytest.warns(UserWarning):
+        Model = _badlands_coupled_model(str(tmpdir), True)
+    spm = Model.surfaceProcesses._BadlandsModel
+    assert not spm.lagged
+    assert isinstance(spm._badlands, _RisingSurfaceDriver)